@@ -0,0 +1,208 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Коды ответа, которыми сервер просит снизить нагрузку
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+def parse_retry_after(value):
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата) в секунды"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_status_and_retry_after(error):
+    """Извлекает HTTP-код и подсказку Retry-After из исключения при скачивании.
+
+    Поддерживает исключения requests (error.response), PyiCloudAPIResponseException
+    (error.code) и собственные ошибки с атрибутами status_code/retry_after.
+    """
+    status = getattr(error, 'status_code', None)
+    retry_after = getattr(error, 'retry_after', None)
+    response = getattr(error, 'response', None)
+    if response is not None:
+        status = status or getattr(response, 'status_code', None)
+        if retry_after is None:
+            retry_after = parse_retry_after(getattr(response, 'headers', {}).get('Retry-After'))
+    if status is None and isinstance(getattr(error, 'code', None), int):
+        status = error.code
+    return status, retry_after
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    """Экспоненциальная задержка с полным джиттером.
+
+    Если сервер прислал Retry-After, ждем не меньше указанного времени
+    и добавляем небольшой джиттер, чтобы потоки не проснулись одновременно.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveConcurrencyLimiter:
+    """Ограничитель параллельных скачиваний по схеме AIMD.
+
+    Лимит растет на единицу за каждое окно успешных скачиваний, пока растет
+    суммарная пропускная способность (без прироста - держится), и уменьшается
+    в decrease_factor раз при ответах 429/503 или высокой доле ошибок. Подсказка Retry-After
+    приостанавливает выдачу новых слотов всем потокам.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, decrease_factor=0.5,
+                 error_rate_threshold=0.1, plateau_tolerance=0.05):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.decrease_factor = decrease_factor
+        self.error_rate_threshold = error_rate_threshold
+        self.plateau_tolerance = plateau_tolerance
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._cond = threading.Condition()
+
+        # Статистика текущего окна
+        self._window_started = time.monotonic()
+        self._window_bytes = 0
+        self._window_successes = 0
+        self._window_errors = 0
+        self._last_throughput = None
+        self._last_decrease = 0.0
+
+        # Итоговые счетчики и история лимита (для отчетов и бенчмарков)
+        self.total_successes = 0
+        self.total_errors = 0
+        self.total_throttled = 0
+        self.total_bytes = 0
+        self.history = [(0.0, self.limit)]
+        self._started = time.monotonic()
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    @contextmanager
+    def slot(self):
+        """Занимает слот для одного скачивания, ожидая свободного места и конца паузы"""
+        with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def _record_limit(self):
+        if self.history[-1][1] != self.limit:
+            self.history.append((time.monotonic() - self._started, self.limit))
+
+    def _decrease(self):
+        # Не уменьшаем лимит чаще раза в окно: одна волна 429 не должна обрушить его до минимума
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self.limit = float(max(self.min_limit, int(self.limit * self.decrease_factor)))
+        self._last_throughput = None
+        self._record_limit()
+        self._reset_window()
+
+    def _reset_window(self):
+        # Новое окно начинается после паузы Retry-After, иначе пауза исказит замер скорости
+        self._window_started = max(time.monotonic(), self.paused_until)
+        self._window_bytes = 0
+        self._window_successes = 0
+        self._window_errors = 0
+
+    def _close_window(self):
+        finished = self._window_successes + self._window_errors
+        # Окно - не меньше двух "поколений" скачиваний, иначе замеры слишком шумные
+        if finished < max(8, 2 * int(self.limit)):
+            return
+        elapsed = max(time.monotonic() - self._window_started, 1e-6)
+        throughput = self._window_bytes / elapsed
+        error_rate = self._window_errors / finished
+        if self._last_throughput is not None:
+            # Сглаживаем замер, чтобы единичный медленный файл не откатывал лимит
+            throughput = 0.5 * throughput + 0.5 * self._last_throughput
+
+        if error_rate > self.error_rate_threshold:
+            self._decrease()
+        elif self._last_throughput is None or throughput >= self._last_throughput * (1 - self.plateau_tolerance):
+            # Пропускная способность растет (или держится) - пробуем еще один поток
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1)
+                self._record_limit()
+            self._last_throughput = throughput
+        else:
+            # Лишний поток не дал прироста - канал насыщен, держим текущий лимит
+            self._last_throughput = throughput
+
+        self._reset_window()
+
+    def on_success(self, nbytes):
+        """Учитывает успешное скачивание"""
+        with self._cond:
+            self.total_successes += 1
+            self.total_bytes += nbytes
+            # Скачивания, завершившиеся во время паузы, относятся к прошлому окну
+            if time.monotonic() >= self._window_started:
+                self._window_successes += 1
+                self._window_bytes += nbytes
+                self._close_window()
+            self._cond.notify_all()
+
+    def on_error(self, status=None, retry_after=None):
+        """Учитывает ошибку; ответы 429/503 сразу уменьшают лимит"""
+        with self._cond:
+            self.total_errors += 1
+            self._window_errors += 1
+            if status in THROTTLE_STATUS_CODES:
+                self.total_throttled += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self._decrease()
+            else:
+                self._close_window()
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            elapsed = max(time.monotonic() - self._started, 1e-6)
+            return {
+                'limit': self.current_limit,
+                'successes': self.total_successes,
+                'errors': self.total_errors,
+                'throttled': self.total_throttled,
+                'bytes': self.total_bytes,
+                'bytes_per_second': self.total_bytes / elapsed,
+            }
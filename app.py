@@ -1,14 +1,22 @@
-from flask import Flask, render_template, jsonify, request, send_file, Response
+from flask import Flask, render_template, jsonify, request, send_file, Response, g
 import os
-from search_images import ImageSearchEngine
+from search_images import ImageSearchEngine, normalize_filters
 from pathlib import Path
 from icloud_sync import ICloudSync
+from ingest_pipeline import IndexingPipeline
+from media_catalog import MediaCatalog
+from job_scheduler import JobScheduler
+from photo_watcher import PhotoWatcher
+from model_registry import MODELS, get_model_spec, set_active_model
+from sync_manifest import SyncManifest
+from storage_layout import LAYOUT_SHARDED, StorageMigration
+from hot_reload import reload_config
 import threading
+import contextlib
 import json
 import time
-import sys
-import subprocess
 from datetime import datetime
+from functools import lru_cache
 from PIL import Image
 import pillow_heif
 import shutil
@@ -18,6 +26,13 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from logger_config import setup_logger
+import metrics
+from profiling import TRACER, SamplingProfiler
+from config import (
+    PROFILE_SAMPLE_INTERVAL_MS, TRACES_DIR, SESSION_FILE,
+    WATCH_PHOTOS, WATCH_DEBOUNCE, WATCH_BATCH_SIZE, WATCH_SCAN_INTERVAL,
+    STORAGE_LAYOUT, STORAGE_MIGRATION_BATCH
+)
 import logging
 
 # Настройка логирования
@@ -45,6 +60,8 @@ logger.info(f"Директория для фотографий: {app.config['IMA
 
 # Путь к файлу с сохраненными учетными данными
 CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'credentials.enc')
+# Зашифрованная сессия iCloud: после перезапуска подключение восстанавливается без входа и 2FA
+SESSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), SESSION_FILE)
 
 def get_device_id():
     """Получает или создает уникальный идентификатор устройства"""
@@ -62,8 +79,9 @@ def get_device_id():
         f.write(device_id)
     return device_id
 
+@lru_cache(maxsize=1)
 def get_encryption_key():
-    """Генерирует ключ шифрования на основе идентификатора устройства"""
+    """Генерирует ключ шифрования на основе идентификатора устройства (100 000 раундов PBKDF2 - один раз за запуск)"""
     device_id = get_device_id().encode()
     # Используем PBKDF2 для генерации ключа из идентификатора устройства
     kdf = PBKDF2HMAC(
@@ -115,12 +133,16 @@ def load_credentials():
         return None
 
 def delete_credentials():
-    """Удаляет сохраненные учетные данные"""
+    """Удаляет сохраненные учетные данные и сессию iCloud"""
     try:
         if os.path.exists(CREDENTIALS_FILE):
             logger.debug("Удаление файла с учетными данными")
             os.remove(CREDENTIALS_FILE)
             logger.info("Файл с учетными данными успешно удален")
+        if icloud_sync:
+            icloud_sync.forget_session()
+        elif os.path.exists(SESSION_PATH):
+            os.remove(SESSION_PATH)
         return True
     except Exception as e:
         logger.error(f"Ошибка при удалении учетных данных: {str(e)}")
@@ -132,12 +154,42 @@ def initialize_engine():
     except EOFError:
         logger.warning("Ошибка при загрузке индекса. Создаем новый индекс...")
         # Если индекс поврежден, удаляем его и создаем новый
-        index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_index.pkl')
+        index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), get_model_spec().index_path)
         if os.path.exists(index_path):
             os.remove(index_path)
         return ImageSearchEngine()
 
-engine = initialize_engine()
+# Процессы пула конвертации HEIC (spawn) заново исполняют главный модуль под именем __mp_main__:
+# в них приложение не запускается (индекс не загружается, фоновые задачи не стартуют)
+MAIN_PROCESS = __name__ != '__mp_main__'
+
+engine = initialize_engine() if MAIN_PROCESS else None
+# Каталог медиафайлов: статистика без обхода директории с фотографиями
+catalog = MediaCatalog(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_catalog.db'),
+    app.config['IMAGES_DIR']
+)
+if MAIN_PROCESS:
+    engine.catalog = catalog
+
+def bootstrap_catalog():
+    """Первичное заполнение каталога для медиатеки, скачанной до его появления"""
+    try:
+        added, _ = catalog.scan()
+        if added:
+            catalog.mark_indexed(engine.snapshot.paths)
+            logger.info(f"Каталог медиафайлов заполнен: {added} файлов")
+    except Exception as e:
+        logger.error(f"Ошибка при заполнении каталога медиафайлов: {str(e)}")
+
+if MAIN_PROCESS and catalog.counts()['total'] == 0:
+    threading.Thread(target=bootstrap_catalog, name='CatalogBootstrap', daemon=True).start()
+
+# Фоновые задачи: по одной синхронизации и индексации одновременно
+job_scheduler = JobScheduler(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs_state.json'))
+# Размер индекса считается при каждом чтении /metrics
+metrics.INDEX_IMAGES.set_function(lambda: len(engine.snapshot))
+metrics.INDEX_MEMORY_BYTES.set_function(lambda: engine.index_memory_bytes())
 icloud_sync = None
 sync_progress = {
     "status": "idle",
@@ -149,6 +201,35 @@ sync_progress = {
     "failed_photos": []
 }
 sync_lock = threading.Lock()
+# Перенос в шарды и синхронизация не должны одновременно менять пути в манифесте
+storage_lock = threading.Lock()
+# Задачи, которые пишут в текущий движок: пока движок заменяется, новые не запускаются,
+# а идущие дорабатывают (миграция модели) или перезапускаются после замены (перезагрузка)
+ENGINE_JOB_KINDS = ('index', 'sync', 'migrate_storage')
+# Замены движка выполняются по одной
+engine_swap_lock = threading.Lock()
+
+@app.before_request
+def acquire_engine():
+    # Обработчики берут движок из g.engine: поколение, замененное во время запроса,
+    # закрывается после его окончания, а весь запрос идет через один движок
+    g.engine = engine.acquire()
+
+@app.teardown_request
+def release_engine(exception=None):
+    pinned = g.pop('engine', None)
+    if pinned is not None:
+        pinned.release()
+
+def using_engine(handler):
+    """Задача держит текущий движок: его поколение не закрывается, пока она выполняется"""
+    def run(job, **params):
+        pinned = engine.acquire()
+        try:
+            return handler(job, **params)
+        finally:
+            pinned.release()
+    return run
 
 # Добавляем глобальную переменную для отслеживания прогресса индексации
 indexing_progress = {
@@ -175,7 +256,7 @@ def generate_progress_events():
                 'status': f"Загружено {sync_progress['downloaded']} из {sync_progress['total']} фотографий. Новых: {sync_progress['new_photos']}"
             }
         yield f"data: {json.dumps(data)}\n\n"
-        if sync_progress['progress'] >= 100:
+        if sync_progress['progress'] >= 100 or sync_progress['status'] in ('stopped', 'error'):
             break
         time.sleep(0.2)
 
@@ -194,8 +275,6 @@ def generate_indexing_events():
                 'status': indexing_progress["message"],
                 'state': indexing_progress["status"]
             }
-            logger.debug(f"Отправка события индексации: {data}")
-            
             if indexing_progress["status"] in ["completed", "stopped", "no_new_files"]:
                 data['progress'] = 100
                 logger.info(f"Завершение индексации со статусом: {indexing_progress['status']}")
@@ -228,7 +307,8 @@ def icloud_connect():
         return jsonify({"success": False, "error": "Не указан логин или пароль"})
     
     logger.info(f"Инициализация подключения к iCloud для пользователя: {username}")
-    icloud_sync = ICloudSync(username, password)
+    replace_icloud_sync(ICloudSync(username, password, catalog=catalog,
+                                   session_key=get_encryption_key(), session_file=SESSION_PATH))
     success, message = icloud_sync.connect()
     
     if success:
@@ -242,8 +322,7 @@ def icloud_connect():
         
         if not message.startswith('2fa'):
             logger.info("Запуск автоматической синхронизации")
-            thread = threading.Thread(target=lambda: start_sync_process())
-            thread.start()
+            start_sync_process()
     else:
         logger.error(f"Ошибка подключения к iCloud: {message}")
     
@@ -263,8 +342,7 @@ def verify_2fa():
     
     # Если двухфакторная аутентификация успешна, запускаем синхронизацию
     if success:
-        thread = threading.Thread(target=lambda: start_sync_process())
-        thread.start()
+        start_sync_process()
     
     return jsonify({"success": success})
 
@@ -282,14 +360,31 @@ def remove_credentials():
     success = delete_credentials()
     return jsonify({"success": success})
 
-def start_sync_process():
-    """Вспомогательная функция для запуска процесса синхронизации"""
+def replace_icloud_sync(sync):
+    """Делает sync текущим подключением к iCloud.
+
+    Расшифрованная сессия прежнего подключения удаляется сразу, а если на нем
+    идет синхронизация - по ее окончании.
+    """
+    global icloud_sync
+    previous, icloud_sync = icloud_sync, sync
+    if previous is not None and previous is not sync and job_scheduler.active('sync') is None:
+        previous.close()
+
+def run_sync_job(job):
+    """Задача синхронизации: скачанные файлы сразу уходят в индексацию, не дожидаясь конца"""
+    sync = icloud_sync
+    try:
+        return _run_sync(job, sync)
+    finally:
+        if sync is not icloud_sync:
+            # Подключение заменили новым входом, пока шла синхронизация
+            sync.close()
+
+def _run_sync(job, sync):
     global sync_progress
     
     with sync_lock:
-        if sync_progress["status"] == "syncing":
-            return
-        
         sync_progress = {
             "status": "syncing",
             "progress": 0,
@@ -297,26 +392,92 @@ def start_sync_process():
             "total": 0,
             "downloaded": 0,
             "new_photos": 0,
-            "failed_photos": []
+            "failed_photos": [],
+            "job_id": job.id
         }
+
+    def on_progress(progress, downloaded, total, new_photos):
+        progress_callback(progress, downloaded, total, new_photos)
+        job.save_checkpoint(downloaded=downloaded, total=total, new_photos=new_photos)
     
+    # Медиатека, скачанная в плоскую Photos, сначала переносится в шарды
+    def on_migration_progress(current, total):
+        with sync_lock:
+            sync_progress["message"] = f"Перенос файлов в шарды: {current}/{total}"
+
+    migrate_storage(sync.manifest, job.cancel_event, on_migration_progress)
+
+    pipeline = IndexingPipeline(engine).start()
     try:
-        success, message, failed_photos = icloud_sync.sync_photos(progress_callback)
+        try:
+            success, message, failed_photos = sync.sync_photos(
+                on_progress, on_downloaded=pipeline.submit, cancel_event=job.cancel_event
+            )
+        finally:
+            pipeline.close()
         with sync_lock:
-            sync_progress["status"] = "completed" if success else "error"
+            if job.cancelled:
+                sync_progress["status"] = "stopped"
+            else:
+                sync_progress["status"] = "completed" if success else "error"
             sync_progress["message"] = message
             sync_progress["failed_photos"] = failed_photos
             if success:
                 sync_progress["progress"] = 100
-        
-        # Обновляем индекс после успешной синхронизации
-        if success:
-            engine.update_index(app.config['IMAGES_DIR'])
+        return {"success": success, "message": message, "failed": len(failed_photos)}
             
     except Exception as e:
         with sync_lock:
             sync_progress["status"] = "error"
             sync_progress["message"] = str(e)
+        raise
+
+def watcher_paused():
+    """Приостановка наблюдателя за Photos: перемещенные файлы не индексируются им заново"""
+    return photo_watcher.paused() if photo_watcher is not None else contextlib.nullcontext()
+
+def migrate_storage(manifest, cancel_event=None, progress_callback=None):
+    """Переносит файлы из плоской Photos в шарды, если включена шардированная раскладка"""
+    if STORAGE_LAYOUT != LAYOUT_SHARDED:
+        return None
+    with storage_lock, watcher_paused():
+        migration = StorageMigration(manifest, app.config['IMAGES_DIR'], engine, catalog,
+                                     batch_size=STORAGE_MIGRATION_BATCH)
+        return migration.run(cancel_event, progress_callback)
+
+def run_migrate_storage_job(job):
+    """Задача переноса медиатеки в шарды при запуске (без подключения к iCloud)"""
+    sync = icloud_sync
+    manifest = sync.manifest if sync else SyncManifest("sync_manifest.db")
+    try:
+        return migrate_storage(
+            manifest, job.cancel_event, lambda current, total: job.save_checkpoint(processed=current, total=total)
+        )
+    finally:
+        if sync is None:
+            manifest.close()
+
+def restore_icloud_session():
+    """Подключается к iCloud по сохраненной сессии, чтобы синхронизация шла без участия пользователя"""
+    if not os.path.exists(SESSION_PATH):
+        return
+    credentials = load_credentials() or {}
+    sync = ICloudSync(credentials.get('username'), credentials.get('password'), catalog=catalog,
+                      session_key=get_encryption_key(), session_file=SESSION_PATH)
+    success, message = sync.connect()
+    if not success:
+        logger.warning(f"Сохраненная сессия iCloud недействительна, нужен вход: {message}")
+        sync.close()
+        return
+    replace_icloud_sync(sync)
+    logger.info(f"Подключение к iCloud восстановлено для пользователя: {sync.username}")
+    # Синхронизация, прерванная перезапуском, продолжается сразу
+    job_scheduler.resume_interrupted(kinds=('sync',))
+
+def start_sync_process():
+    """Запускает синхронизацию (или возвращает уже идущую)"""
+    job, _ = job_scheduler.submit('sync')
+    return job
 
 @app.route('/sync_icloud', methods=['POST'])
 def start_sync():
@@ -325,10 +486,57 @@ def start_sync():
     if not icloud_sync:
         return jsonify({"success": False, "error": "Нет активного подключения"})
     
-    thread = threading.Thread(target=lambda: start_sync_process())
-    thread.start()
+    job = start_sync_process()
+    
+    return jsonify({"success": True, "message": "Синхронизация начата", "job_id": job.id})
+
+def _flag_enabled(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def profiling_requested():
+    """Профилирование запроса включается заголовком X-Profile: 1 или параметром ?profile=1"""
+    return _flag_enabled(request.headers.get('X-Profile', '')) or _flag_enabled(request.args.get('profile', ''))
+
+def _search_response(query, page, per_page, timings=None, filters=None):
+    # Получаем все результаты
+    logger.debug(f"Выполнение поиска с параметрами: query='{query}', top_k=200, filters={filters}")
+    all_results = g.engine.search_images(query, top_k=200, timings=timings, filters=filters)
+    
+    # Разбиваем на страницы
+    start_idx = (page - 1) * per_page
+    end_idx = start_idx + per_page
+    page_results = all_results[start_idx:end_idx]
+    
+    logger.info(f"Найдено результатов: {len(all_results)}, отображается: {len(page_results)}")
     
-    return jsonify({"success": True, "message": "Синхронизация начата"})
+    return {
+        "results": page_results,
+        "has_more": end_idx < len(all_results)
+    }
+
+def _profiled_search(query, page, per_page, filters=None):
+    """Выполняет поиск под сэмплирующим профайлером и добавляет профиль в ответ"""
+    timings = {}
+    # Сэмплируем поток запроса и поток текстового энкодера, в котором работает модель
+    profiler = SamplingProfiler(
+        interval=PROFILE_SAMPLE_INTERVAL_MS / 1000.0,
+        thread_ids=[threading.get_ident()],
+        thread_names=['TextBatcher']
+    )
+    started = time.perf_counter()
+    with profiler:
+        payload = _search_response(query, page, per_page, timings, filters)
+        serialize_started = time.perf_counter()
+        json.dumps(payload)
+        timings['serialize'] = time.perf_counter() - serialize_started
+    timings['total'] = time.perf_counter() - started
+    payload['profile'] = {
+        'phases_ms': {phase: seconds * 1000.0 for phase, seconds in timings.items()},
+        'sampling': profiler.summary()
+    }
+    logger.info("Профиль поиска: " + ", ".join(
+        f"{phase} {ms:.1f} мс" for phase, ms in payload['profile']['phases_ms'].items()))
+    return payload
 
 @app.route('/search', methods=['POST'])
 def search():
@@ -342,86 +550,116 @@ def search():
         logger.warning("Получен пустой поисковый запрос")
         return jsonify({"results": [], "has_more": False})
     
+    # Фильтры: {"filters": {"date_from": "2023-06-01", "date_to": "2023-08-31", "media_type": "video", "folder": "..."}}
     try:
-        # Получаем все результаты
-        logger.debug(f"Выполнение поиска с параметрами: query='{query}', top_k=200")
-        all_results = engine.search_images(query, top_k=200)
-        
-        # Разбиваем на страницы
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        page_results = all_results[start_idx:end_idx]
-        
-        logger.info(f"Найдено результатов: {len(all_results)}, отображается: {len(page_results)}")
-        
-        return jsonify({
-            "results": page_results,
-            "has_more": end_idx < len(all_results)
-        })
+        filters = normalize_filters(request.json.get('filters'))
+    except ValueError as e:
+        logger.warning(f"Некорректные фильтры поиска: {str(e)}")
+        return jsonify({"results": [], "has_more": False, "error": str(e)}), 400
+    
+    try:
+        if profiling_requested():
+            return jsonify(_profiled_search(query, page, per_page, filters))
+        return jsonify(_search_response(query, page, per_page, filters=filters))
     except Exception as e:
         logger.error(f"Ошибка при выполнении поиска: {str(e)}")
         return jsonify({"results": [], "has_more": False, "error": str(e)})
 
-@app.route('/update_index', methods=['POST'])
-def update_index():
-    try:
-        global indexing_progress
-        logger.info("Начало процесса индексации")
+def run_index_job(job, trace=False):
+    """Задача индексации: останавливается по флагу отмены между файлами"""
+    global indexing_progress
+    logger.info("Начало процесса индексации")
+    with sync_lock:
         indexing_progress = {
             "status": "running",
             "current": 0,
-            "total": len(os.listdir(app.config['IMAGES_DIR'])),
-            "message": ""
+            # Число файлов к индексации известно только после сверки папки
+            "total": 0,
+            "message": "",
+            "job_id": job.id
         }
-        
-        def update_progress(current, total):
-            global indexing_progress
-            with sync_lock:
-                # Проверяем валидность значений
-                if total <= 0:
-                    logger.warning("Получено некорректное значение total: %d", total)
-                    return
-                    
-                if current > total:
-                    logger.warning("current (%d) больше total (%d), корректируем", current, total)
-                    current = total
-                    
-                indexing_progress["current"] = current
-                indexing_progress["total"] = total
-                progress = round((current / total * 100))
+    
+    last_progress_log = [0.0]
+
+    def update_progress(current, total):
+        global indexing_progress
+        with sync_lock:
+            # Проверяем валидность значений
+            if total < 0:
+                logger.warning("Получено некорректное значение total: %d", total)
+                return
                 
-                logger.info(f"Прогресс индексации: {current}/{total} ({progress}%)")
+            if current > total:
+                logger.warning("current (%d) больше total (%d), корректируем", current, total)
+                current = total
                 
-                # Обновляем статус и сообщение
-                if total == 0:
-                    indexing_progress["status"] = "no_new_files"
-                    indexing_progress["message"] = "Новых файлов для индексации не найдено"
-                else:
-                    indexing_progress["message"] = f"Обработано {current} из {total} файлов ({progress}%)"
-                    if current >= total:
-                        logger.info("Индексация завершена")
-                        indexing_progress["status"] = "completed"
-        
-        # Запускаем индексацию в отдельном потоке
-        def index_thread():
-            try:
-                logger.info("Запуск индексации в отдельном потоке")
-                result = engine.update_index(progress_callback=update_progress)
-                logger.info(f"Результат индексации: {'Новых файлов нет' if result else 'Файлы обработаны'}")
-                if result:  # True если новых файлов нет
-                    with sync_lock:
-                        indexing_progress["status"] = "no_new_files"
-                        indexing_progress["message"] = "Новых файлов для индексации не найдено"
-            except Exception as e:
-                logger.error(f"Ошибка в потоке индексации: {str(e)}")
-                with sync_lock:
-                    indexing_progress["status"] = "error"
-                    indexing_progress["message"] = f"Ошибка: {str(e)}"
-        
-        threading.Thread(target=index_thread).start()
-        logger.info("Поток индексации запущен")
-        
-        return jsonify({"success": True})
+            indexing_progress["current"] = current
+            indexing_progress["total"] = total
+            
+            # Обновляем статус и сообщение
+            if total == 0:
+                indexing_progress["status"] = "no_new_files"
+                indexing_progress["message"] = "Новых файлов для индексации не найдено"
+            else:
+                progress = round((current / total * 100))
+                # Пишем прогресс в лог не чаще раза в 10 секунд, а не на каждый файл
+                now = time.monotonic()
+                if now - last_progress_log[0] >= 10 or current >= total:
+                    last_progress_log[0] = now
+                    logger.info(f"Прогресс индексации: {current}/{total} ({progress}%)")
+                indexing_progress["message"] = f"Обработано {current} из {total} файлов ({progress}%)"
+                if current >= total:
+                    logger.info("Индексация завершена")
+                    indexing_progress["status"] = "completed"
+        job.save_checkpoint(processed=current, total=total)
+    
+    if trace:
+        # Трассировка стадий индексации, файл открывается в Perfetto
+        TRACER.start()
+        logger.info("Трассировка индексации включена")
+
+    def export_trace():
+        TRACER.stop()
+        trace_path = TRACES_DIR / f"index-{datetime.now():%Y%m%d-%H%M%S}.json"
+        try:
+            spans = TRACER.export(trace_path)
+            logger.info(f"Трассировка индексации сохранена: {trace_path} ({spans} интервалов)")
+            with sync_lock:
+                indexing_progress["trace_file"] = str(trace_path)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении трассировки: {str(e)}")
+
+    try:
+        result = engine.update_index(progress_callback=update_progress, cancel_event=job.cancel_event)
+        if job.cancelled:
+            with sync_lock:
+                indexing_progress["status"] = "stopped"
+                indexing_progress["message"] = "Индексация остановлена пользователем"
+            return {"stopped": True}
+        logger.info(f"Результат индексации: {'Новых файлов нет' if result else 'Файлы обработаны'}")
+        if result:  # True если новых файлов нет
+            with sync_lock:
+                indexing_progress["status"] = "no_new_files"
+                indexing_progress["message"] = "Новых файлов для индексации не найдено"
+        return {"new_files": not result, "indexed": len(engine.snapshot)}
+    except Exception as e:
+        logger.error(f"Ошибка в задаче индексации: {str(e)}")
+        with sync_lock:
+            indexing_progress["status"] = "error"
+            indexing_progress["message"] = f"Ошибка: {str(e)}"
+        raise
+    finally:
+        if trace:
+            export_trace()
+
+@app.route('/update_index', methods=['POST'])
+def update_index():
+    try:
+        params = request.get_json(silent=True) or {}
+        trace = _flag_enabled(params.get('trace', '')) or _flag_enabled(request.args.get('trace', ''))
+        # Повторный запрос во время индексации не запускает вторую копию
+        job, created = job_scheduler.submit('index', params={'trace': trace})
+        return jsonify({"success": True, "job_id": job.id, "already_running": not created})
     except Exception as e:
         logger.error(f"Ошибка при запуске индексации: {str(e)}")
         return jsonify({"success": False, "error": str(e)})
@@ -432,7 +670,8 @@ def indexing_status():
     global indexing_progress
     with sync_lock:
         # Если процесс индексации активен, но прогресс равен 100%, считаем его завершенным
-        if indexing_progress["status"] == "running" and indexing_progress["current"] >= indexing_progress["total"]:
+        if (indexing_progress["status"] == "running" and indexing_progress["total"] > 0
+                and indexing_progress["current"] >= indexing_progress["total"]):
             indexing_progress["status"] = "completed"
         return jsonify(indexing_progress)
 
@@ -516,12 +755,12 @@ def check_auth():
 def stop_sync():
     global icloud_sync, sync_progress
     try:
-        with sync_lock:
-            if sync_progress["status"] == "syncing":
-                sync_progress["status"] = "stopped"
-                sync_progress["message"] = "Синхронизация остановлена пользователем"
-                return jsonify({"success": True})
-            return jsonify({"success": False, "error": "Синхронизация не выполняется"})
+        # Задача остановится, как только текущие скачивания завершатся
+        if job_scheduler.cancel_key('sync'):
+            with sync_lock:
+                sync_progress["message"] = "Синхронизация останавливается..."
+            return jsonify({"success": True})
+        return jsonify({"success": False, "error": "Синхронизация не выполняется"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -536,7 +775,7 @@ def sync_progress_stream():
 @app.route('/check_index')
 def check_index():
     try:
-        index_exists = engine.check_index_exists()
+        index_exists = g.engine.check_index_exists()
         return jsonify({"exists": index_exists})
     except Exception as e:
         logger.error(f"Error checking index: {str(e)}")
@@ -545,27 +784,13 @@ def check_index():
 @app.route('/stats')
 def get_stats():
     try:
-        # Считаем файлы изображений и видео
-        image_extensions = {'.jpg', '.jpeg', '.png', '.heic', '.HEIC', '.PNG'}
-        video_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.MP4', '.MOV'}
-        
-        total_files = 0
-        total_images = 0
-        total_videos = 0
-        
-        if os.path.exists(app.config['IMAGES_DIR']):
-            for f in os.listdir(app.config['IMAGES_DIR']):
-                if os.path.isfile(os.path.join(app.config['IMAGES_DIR'], f)):
-                    ext = os.path.splitext(f)[1].lower()
-                    if ext in image_extensions:
-                        total_images += 1
-                    elif ext in video_extensions:
-                        total_videos += 1
-        
-        total_files = total_images + total_videos
+        # Количество файлов берется из каталога (счетчики кэшируются до следующего изменения)
+        counts = catalog.counts()
+        total_videos = counts['videos']
+        total_files = counts['total']
         
         # Получаем время последнего обновления
-        last_update_time = engine.get_last_update_time()
+        last_update_time = g.engine.get_last_update_time()
         if last_update_time == "Никогда":
             last_update = "Никогда" if request.accept_languages.best_match(['ru']) else "Never"
         else:
@@ -603,6 +828,8 @@ def get_stats():
             "total_files": total_files,
                 "total_images": total_files,  # Теперь total_images включает все файлы
             "total_videos": total_videos,
+            "indexed_files": counts['indexed'],
+            "total_bytes": counts['bytes'],
             "last_update": last_update,
             "sync_status": sync_status
         })
@@ -617,29 +844,166 @@ def get_stats():
             "sync_status": "Ошибка" if is_ru else "Error"
         })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/trace/latest')
+def latest_trace():
+    """Отдает последнюю сохраненную трассировку индексации"""
+    traces = sorted(TRACES_DIR.glob('index-*.json')) if TRACES_DIR.exists() else []
+    if not traces:
+        return jsonify({"error": "Трассировок нет, запустите индексацию с trace=1"}), 404
+    return send_file(traces[-1].resolve(), mimetype='application/json', as_attachment=True,
+                     download_name=traces[-1].name)
+
+@app.route('/search_batching_stats')
+def search_batching_stats():
+    """Возвращает метрики объединения поисковых запросов в батчи"""
+    return jsonify(g.engine.text_batcher.get_stats())
+
 @app.route('/stop_indexing', methods=['POST'])
 def stop_indexing():
     global indexing_progress
     try:
-        with sync_lock:
-            if indexing_progress["status"] == "running":
-                indexing_progress["status"] = "stopped"
-                indexing_progress["message"] = "Индексация остановлена пользователем"
-                return jsonify({"success": True})
-            return jsonify({"success": False, "error": "Индексация не выполняется"})
+        # Индексация остановится после текущего файла и сохранит сделанное
+        if job_scheduler.cancel_key('index'):
+            with sync_lock:
+                indexing_progress["message"] = "Индексация останавливается..."
+            return jsonify({"success": True})
+        return jsonify({"success": False, "error": "Индексация не выполняется"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route('/jobs')
+def list_jobs():
+    """Список фоновых задач (последние сверху)"""
+    return jsonify({"jobs": job_scheduler.list()})
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    return jsonify({"success": job_scheduler.cancel(job_id)})
+
+def run_migrate_model_job(job, model):
+    """Переводит индекс на другую модель, пока текущий индекс продолжает обслуживать поиск.
+
+    Новая модель индексирует медиатеку в свой файл индекса (векторы разных
+    моделей несовместимы). Индексация, синхронизация и перенос в шарды пишут
+    в текущий движок, поэтому перед переключением новые такие задачи
+    придерживаются в очереди, а идущие дорабатывают; затем при
+    приостановленном наблюдателе выполняется догоняющий проход для файлов,
+    добавленных за время миграции. После
+    переключения поиск и индексация идут через новый движок, а прежний
+    индекс остается на диске.
+    """
+    global engine
+    if model == engine.model_spec.key:
+        return {"model": model, "switched": False}
+    logger.info(f"Миграция индекса с {engine.model_spec.key} на {model}")
+    target = ImageSearchEngine(model_key=model)
+    target.catalog = catalog
+
+    def update_progress(current, total):
+        job.save_checkpoint(processed=current, total=total)
+
+    def stopped():
+        logger.info(f"Миграция на {model} остановлена, продолжится при следующем запуске")
+        return {"model": model, "switched": False, "stopped": True}
+
+    target.update_index(progress_callback=update_progress, cancel_event=job.cancel_event)
+    if job.cancelled:
+        return stopped()
+
+    with engine_swap_lock, job_scheduler.holding(ENGINE_JOB_KINDS, job.cancel_event) as idle:
+        if not idle:
+            return stopped()
+        previous = engine
+        # Наблюдатель за Photos не пишет в прежний движок до переключения
+        with watcher_paused(), previous._index_lock:
+            target.update_index(progress_callback=update_progress, cancel_event=job.cancel_event)
+            if job.cancelled:
+                return stopped()
+            # Поиск читает engine при каждом запросе: переключение - замена ссылки
+            engine = target
+        previous.retire()
+    set_active_model(model)
+    logger.info(f"Индекс переведен на модель {model} ({len(target.snapshot)} файлов), "
+                f"прежний индекс сохранен в {previous.index_path}")
+    return {"model": model, "switched": True, "indexed": len(target.snapshot)}
+
+@app.route('/models')
+def list_models():
+    """Доступные модели, активная модель и идущая миграция"""
+    migration = job_scheduler.active('migrate_model')
+    return jsonify({
+        "active": g.engine.model_spec.key,
+        "models": [dict(spec.to_dict(), index_exists=os.path.exists(spec.index_path)) for spec in MODELS.values()],
+        "migration": migration.to_dict() if migration else None,
+    })
+
+@app.route('/models/migrate', methods=['POST'])
+def migrate_model():
+    params = request.get_json(silent=True) or {}
+    model = params.get('model')
+    if model not in MODELS:
+        return jsonify({"success": False, "error": f"Неизвестная модель: {model}"}), 400
+    job, created = job_scheduler.submit('migrate_model', params={'model': model})
+    return jsonify({"success": True, "job_id": job.id, "already_running": not created})
+
+def run_reload_job(job):
+    """Перечитывает конфигурацию и подменяет движок новым поколением, собранным из индекса на диске.
+
+    Пока поколение собирается, поиск обслуживает прежнее; загруженная модель
+    переиспользуется. Модель не меняется (для этого есть миграция через
+    /models/migrate: у другой модели может еще не быть индекса). Индексация,
+    синхронизация и перенос в шарды пишут в движок, поэтому на все время
+    перезагрузки новые такие задачи придерживаются в очереди, а идущие
+    останавливаются и после перезагрузки продолжаются на новом поколении;
+    прежнее поколение закрывается, когда его отпустят начатые на нем запросы.
+    """
+    global engine, photo_watcher
+    # Идущая миграция модели сама заменит движок: перезагрузка дожидается ее окончания
+    while job_scheduler.active('migrate_model'):
+        if job.cancel_event.wait(0.5):
+            return {"reloaded": False, "stopped": True}
+
+    with engine_swap_lock, job_scheduler.holding(ENGINE_JOB_KINDS, job.cancel_event, preempt=True) as idle:
+        if not idle:
+            return {"reloaded": False, "stopped": True}
+        changed = reload_config()
+        previous = engine
+        # Наблюдатель за Photos не пишет в прежнее поколение во время подмены
+        with watcher_paused(), previous._index_lock:
+            target = ImageSearchEngine(model_key=previous.model_spec.key)
+            target.catalog = catalog
+            target.adopt_model(previous)
+            if target.retag():
+                target.save_index()
+            engine = target
+        previous.retire()
+
+    if any(name.startswith('WATCH_') for name in changed):
+        if photo_watcher is not None:
+            photo_watcher.stop()
+        photo_watcher = start_photo_watcher()
+    logger.info(f"Движок перезагружен: модель {target.model_spec.key}, {len(target.snapshot)} файлов в индексе")
+    return {"reloaded": True, "changed": changed, "model": target.model_spec.key, "indexed": len(target.snapshot)}
+
+@app.route('/reload', methods=['POST'])
+# Прежний адрес: перезапуск процесса обрывал идущие задачи и запросы, теперь это та же перезагрузка
 @app.route('/restart_server', methods=['POST'])
-def restart_server():
-    try:
-        # Запускаем новый процесс с текущим скриптом
-        subprocess.Popen([sys.executable, __file__])
-        # Завершаем текущий процесс
-        os._exit(0)
-    except Exception as e:
-        logger.error(f"Ошибка при перезапуске сервера: {str(e)}")
-        return jsonify({"success": False, "error": str(e)})
+def reload_server():
+    """Перезагрузка конфигурации и индекса без перезапуска процесса"""
+    job, created = job_scheduler.submit('reload')
+    return jsonify({"success": True, "job_id": job.id, "already_running": not created})
 
 def convert_heic_to_jpeg(heic_path):
     """Конвертирует HEIC файл в JPEG формат"""
@@ -673,5 +1037,37 @@ def convert_heic_to_jpeg(heic_path):
         logger.error(f"Ошибка при конвертации {heic_path}: {str(e)}")
         return None
 
+def start_photo_watcher():
+    """Запускает наблюдение за Photos с текущими настройками (None, если оно выключено)"""
+    if not WATCH_PHOTOS:
+        return None
+    return PhotoWatcher(
+        lambda: engine,
+        root='Photos',
+        rescan=lambda: job_scheduler.submit('index'),
+        debounce=WATCH_DEBOUNCE,
+        batch_size=WATCH_BATCH_SIZE,
+        scan_interval=WATCH_SCAN_INTERVAL
+    ).start()
+
+# Файлы, скопированные в Photos в обход синхронизации, индексируются без нажатия «Обновить»
+photo_watcher = start_photo_watcher() if MAIN_PROCESS else None
+
+# Обработчики задач регистрируются после объявления функций
+job_scheduler.register('index', using_engine(run_index_job))
+job_scheduler.register('sync', using_engine(run_sync_job))
+job_scheduler.register('migrate_model', run_migrate_model_job)
+job_scheduler.register('migrate_storage', using_engine(run_migrate_storage_job))
+job_scheduler.register('reload', run_reload_job)
+if MAIN_PROCESS:
+    # Индексация и миграция модели, прерванные падением процесса, продолжаются сразу; синхронизация -
+    # после восстановления сессии iCloud или при следующем подключении
+    job_scheduler.resume_interrupted(kinds=('index', 'migrate_model'))
+    threading.Thread(target=restore_icloud_session, name='ICloudSessionRestore', daemon=True).start()
+    # Медиатека, синхронизированная до появления шардов, переносится в фоне; поиск при этом работает.
+    # Наблюдатель к этому моменту уже запущен: на время переноса он приостанавливается
+    if STORAGE_LAYOUT == LAYOUT_SHARDED and os.path.exists("sync_manifest.db"):
+        job_scheduler.submit('migrate_storage')
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False) 
\ No newline at end of file
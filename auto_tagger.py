@@ -0,0 +1,181 @@
+import hashlib
+import os
+import re
+import numpy as np
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Температура softmax по словарю, как в zero-shot классификации CLIP (logit_scale модели ~100)
+LOGIT_SCALE = 100.0
+
+# Тег и его синонимы для запросов (только переводы и точные синонимы: запрос-синоним
+# отвечается по тегу); в подсказку модели подставляется сам тег
+DEFAULT_VOCABULARY = [
+    ("dog", "собака", "пес", "собаки", "dogs"),
+    ("cat", "кот", "кошка", "коты", "cats"),
+    ("bird", "птица", "птицы", "birds"),
+    ("horse", "лошадь", "конь", "horses"),
+    ("fish", "рыба"),
+    ("beach", "пляж"),
+    ("mountains", "горы", "mountain"),
+    ("forest", "лес"),
+    ("lake", "озеро"),
+    ("river", "река"),
+    ("snow", "снег"),
+    ("sunset", "закат"),
+    ("sky", "небо"),
+    ("flowers", "цветы", "flower"),
+    ("tree", "дерево", "деревья", "trees"),
+    ("garden", "сад"),
+    ("park", "парк"),
+    ("city", "город"),
+    ("street", "улица"),
+    ("building", "здание"),
+    ("church", "церковь", "храм"),
+    ("bridge", "мост"),
+    ("car", "машина", "автомобиль", "cars"),
+    ("bicycle", "велосипед", "bike"),
+    ("motorcycle", "мотоцикл"),
+    ("bus", "автобус"),
+    ("train", "поезд"),
+    ("airplane", "самолет", "plane"),
+    ("boat", "лодка"),
+    ("person", "человек", "люди", "people"),
+    ("child", "ребенок", "дети", "kids", "children"),
+    ("baby", "младенец", "малыш"),
+    ("selfie", "селфи"),
+    ("group photo", "групповое фото"),
+    ("wedding", "свадьба"),
+    ("birthday cake", "торт на день рождения"),
+    ("food", "еда"),
+    ("pizza", "пицца"),
+    ("coffee", "кофе"),
+    ("drink", "напиток", "напитки"),
+    ("fruit", "фрукты"),
+    ("restaurant", "ресторан"),
+    ("kitchen", "кухня"),
+    ("bedroom", "спальня"),
+    ("living room", "гостиная"),
+    ("office", "офис"),
+    ("computer", "компьютер"),
+    ("phone", "телефон"),
+    ("screenshot", "скриншот", "снимок экрана"),
+    ("document", "документ", "документы"),
+    ("receipt", "чек", "квитанция"),
+    ("book", "книга", "книги"),
+    ("text", "текст", "надпись"),
+    ("whiteboard", "доска"),
+    ("map", "карта"),
+    ("painting", "картина", "живопись"),
+    ("toy", "игрушка", "игрушки"),
+    ("christmas tree", "елка"),
+    ("fireworks", "салют", "фейерверк"),
+    ("concert", "концерт"),
+    ("sport", "спорт"),
+    ("football", "футбол", "soccer"),
+    ("swimming pool", "бассейн"),
+    ("night", "ночь"),
+    ("rain", "дождь"),
+    ("clouds", "облака"),
+    ("desert", "пустыня"),
+    ("field", "поле"),
+    ("waterfall", "водопад"),
+    ("statue", "статуя"),
+    ("museum", "музей"),
+    ("shoes", "обувь"),
+    ("clothes", "одежда"),
+]
+
+
+def _normalize(text):
+    """Запрос в виде для сравнения с тегами: без регистра, лишних пробелов и знаков препинания"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r"[^\w\s-]", " ", text)
+    return " ".join(text.split())
+
+
+def load_vocabulary(path=None):
+    """Словарь тегов из файла (строка: тег, синоним, ...; # - комментарий) или встроенный"""
+    if not path or not os.path.exists(path):
+        return [tuple(entry) for entry in DEFAULT_VOCABULARY]
+    vocabulary = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            names = tuple(name.strip() for name in line.split(',') if name.strip())
+            if names:
+                vocabulary.append(names)
+    return vocabulary
+
+
+class AutoTagger:
+    """Zero-shot теги изображений по словарю.
+
+    Эмбеддинги подсказок "a photo of a <тег>" считаются текстовым энкодером
+    один раз при загрузке модели. Вектор изображения сравнивается со всеми
+    тегами, по сходству считается softmax по словарю, и изображению
+    достаются теги с вероятностью не ниже threshold (не больше max_tags).
+    Для каждого тега запоминается косинусное сходство: по нему
+    упорядочивается список изображений тега в инвертированном индексе.
+    Для тегов и синонимов заранее считаются эмбеддинги самих слов: запрос,
+    совпавший с тегом, ранжируется по ним без текстового энкодера.
+    """
+
+    def __init__(self, model_key, vocabulary, prompt="a photo of a {}.", threshold=0.2, max_tags=5):
+        self.vocabulary = [tuple(entry) for entry in vocabulary]
+        self.tags = [entry[0] for entry in self.vocabulary]
+        self.prompt = prompt
+        self.threshold = threshold
+        self.max_tags = max_tags
+        # Синонимы и сами теги -> тег
+        self.aliases = {}
+        for entry in self.vocabulary:
+            for name in entry:
+                self.aliases.setdefault(_normalize(name), entry[0])
+        # Теги, посчитанные с другим словарем, порогом или моделью, пересчитываются
+        signature = repr((model_key, self.tags, prompt, threshold, max_tags))
+        self.signature = hashlib.blake2b(signature.encode('utf-8'), digest_size=8).hexdigest()
+        self.embeddings = None
+        # Нормализованный тег или синоним -> эмбеддинг запроса
+        self.query_embeddings = None
+
+    @property
+    def ready(self):
+        return self.embeddings is not None
+
+    def prepare(self, encode_texts, batch_size=64):
+        """Считает эмбеддинги подсказок тегов (encode_texts - текстовый энкодер движка)"""
+        prompts = [self.prompt.format(tag) for tag in self.tags]
+        chunks = [encode_texts(prompts[i:i + batch_size]) for i in range(0, len(prompts), batch_size)]
+        names = sorted(self.aliases)
+        vectors = np.concatenate([encode_texts(names[i:i + batch_size]) for i in range(0, len(names), batch_size)])
+        self.query_embeddings = dict(zip(names, np.asarray(vectors, dtype=np.float32)))
+        self.embeddings = np.ascontiguousarray(np.concatenate(chunks), dtype=np.float32)
+        logger.info(f"Подготовлено {len(self.tags)} тегов для автотегирования")
+
+    def score(self, vectors):
+        """Теги для каждого вектора (N, dim): список словарей тег -> косинусное сходство"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        similarity = vectors @ self.embeddings.T
+        logits = similarity * LOGIT_SCALE
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        results = []
+        for row_similarity, row_probabilities in zip(similarity, probabilities):
+            selected = np.flatnonzero(row_probabilities >= self.threshold)
+            selected = selected[np.argsort(-row_probabilities[selected], kind='stable')][:self.max_tags]
+            results.append({self.tags[i]: float(row_similarity[i]) for i in selected})
+        return results
+
+    def match(self, query):
+        """Тег, которому в точности соответствует запрос, или None"""
+        return self.aliases.get(_normalize(query))
+
+    def query_embedding(self, query):
+        """Эмбеддинг запроса, совпавшего с тегом или синонимом (None, если совпадения нет)"""
+        if self.query_embeddings is None:
+            return None
+        return self.query_embeddings.get(_normalize(query))
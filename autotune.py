@@ -0,0 +1,238 @@
+"""Автонастройка параметров индексации под конкретную машину.
+
+Прогоняет короткие замеры индексации на выборке файлов из медиатеки,
+перебирая размер батча, число потоков torch (intra-op и inter-op) и число
+потоков декодирования, и сохраняет лучшую конфигурацию в профиль.
+ImageSearchEngine загружает профиль при создании и перечитывает его перед
+каждым update_index, если файл изменился.
+
+    python autotune.py run --photos Photos --sample 64
+    python autotune.py show
+
+Каждый замер выполняется в отдельном процессе: число inter-op потоков torch
+можно задать только до начала параллельной работы, а заодно замеры не
+влияют друг на друга через прогретые пулы и кэши. Замеры работают во
+временной директории со своим кэшем эмбеддингов, поэтому индекс и кэш
+медиатеки не меняются и каждый файл действительно проходит через модель.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from logger_config import setup_logger
+from config import TUNING_PROFILE_PATH, INDEX_BATCH_SIZE, DECODE_WORKERS
+from model_registry import active_model_key
+
+logger = setup_logger(__name__)
+
+SETTINGS = ('intra_op_threads', 'batch_size', 'decode_workers', 'inter_op_threads')
+
+
+def host_fingerprint():
+    """Описание машины: профиль с другой машины не применяется"""
+    return {
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+
+
+def load_profile(path=TUNING_PROFILE_PATH, model_key=None):
+    """Настройки из профиля или None, если профиля нет или он снят на другой машине или для другой модели"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            profile = json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке профиля настройки: {str(e)}")
+        return None
+    if profile.get('host') != host_fingerprint():
+        logger.warning("Профиль настройки снят на другой машине и не применяется")
+        return None
+    if model_key is not None and profile.get('model', model_key) != model_key:
+        logger.warning(f"Профиль настройки снят для модели {profile.get('model')} и не применяется")
+        return None
+    return {key: value for key, value in profile.get('settings', {}).items() if key in SETTINGS}
+
+
+def save_profile(settings, trials, path=TUNING_PROFILE_PATH, model_key=None):
+    profile = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': host_fingerprint(),
+        'model': model_key,
+        'settings': settings,
+        'trials': trials,
+    }
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def sample_library(photos_dir, size, seed=0):
+    """Случайная выборка файлов, которые индексирует update_index (HEIC индексируется через JPEG-копию)"""
+    from media_catalog import media_type
+
+    files = sorted(str(path.resolve()) for path in Path(photos_dir).rglob('*')
+                   if path.is_file() and not path.name.startswith('.')
+                   and media_type(path) is not None and path.suffix.lower() != '.heic')
+    random.Random(seed).shuffle(files)
+    return files[:size]
+
+
+def run_trial(settings, files, model_key=None):
+    """Один замер в текущем процессе: файлов в секунду без учета загрузки модели и прогрева"""
+    from search_images import ImageSearchEngine
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Пустая рабочая директория: без индекса, кэша эмбеддингов и профиля медиатеки
+        os.chdir(tmp_dir)
+        engine = ImageSearchEngine(model_key=model_key)
+        engine.configure(**settings)
+        started = time.perf_counter()
+        engine.load_model()
+        model_seconds = time.perf_counter() - started
+
+        # Прогрев на одном батче (аллокации, ленивые инициализации torch)
+        engine._embed_files(files[:engine.batch_size])
+        engine.embedding_cache.unlink(files)
+        engine.embedding_cache.gc()
+
+        started = time.perf_counter()
+        embedded = engine._embed_files(files)
+        elapsed = time.perf_counter() - started
+    return {
+        'settings': settings,
+        'files': len(files),
+        'embedded': len(embedded),
+        'seconds': elapsed,
+        'files_per_second': len(embedded) / elapsed if elapsed > 0 else 0.0,
+        'model_load_seconds': model_seconds,
+    }
+
+
+def _spawn_trial(settings, files_path, timeout, model_key):
+    """Запускает замер в отдельном процессе; None, если замер упал или не уложился во время"""
+    result_path = files_path + '.result.json'
+    command = [sys.executable, os.path.abspath(__file__), 'trial',
+               '--settings', json.dumps(settings), '--files', files_path, '--result', result_path,
+               '--model', model_key]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        logger.error(f"Замер {settings} не уложился в {timeout} с")
+        return None
+    if completed.returncode != 0 or not os.path.exists(result_path):
+        logger.error(f"Замер {settings} завершился с ошибкой: {completed.stderr.strip()[-500:]}")
+        return None
+    # Результат пишется в файл: stdout процесса занят логами
+    with open(result_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)
+    os.remove(result_path)
+    return result
+
+
+def candidates(cpu_count):
+    """Значения каждого параметра для перебора"""
+    threads = sorted({1, max(1, cpu_count // 4), max(1, cpu_count // 2), cpu_count})
+    return {
+        'intra_op_threads': threads,
+        'batch_size': [1, 4, 8, 16, 32],
+        'decode_workers': sorted({1, 2, 4, min(8, cpu_count), min(16, cpu_count)}),
+        'inter_op_threads': sorted({1, 2, max(1, cpu_count // 4)}),
+    }
+
+
+def autotune(photos_dir="Photos", sample=64, output=TUNING_PROFILE_PATH, timeout=600, seed=0, grid=None):
+    """Подбирает параметры покоординатным спуском и сохраняет лучшие в профиль.
+
+    Параметры перебираются по одному (в порядке SETTINGS), остальные
+    фиксируются на лучших найденных значениях; полный перебор сетки занял
+    бы часы. Возвращает лучшие настройки.
+    """
+    files = sample_library(photos_dir, sample, seed)
+    if not files:
+        raise ValueError(f"В {photos_dir} нет файлов для замеров")
+    cpu_count = os.cpu_count() or 1
+    grid = grid or candidates(cpu_count)
+    best = {'intra_op_threads': cpu_count, 'batch_size': INDEX_BATCH_SIZE,
+            'decode_workers': DECODE_WORKERS, 'inter_op_threads': max(1, cpu_count // 4)}
+    # Замеры идут во временной директории, поэтому модель определяется здесь
+    model_key = active_model_key()
+    logger.info(f"Автонастройка модели {model_key} на {len(files)} файлах, {cpu_count} ядер")
+
+    trials = []
+    measured = {}
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+        f.write('\n'.join(files))
+        files_path = f.name
+    try:
+        for setting in SETTINGS:
+            best_rate = None
+            for value in grid[setting]:
+                settings = dict(best, **{setting: value})
+                key = json.dumps(settings, sort_keys=True)
+                if key not in measured:
+                    result = _spawn_trial(settings, files_path, timeout, model_key)
+                    measured[key] = result
+                    if result is not None:
+                        trials.append(result)
+                        logger.info(f"{settings}: {result['files_per_second']:.2f} файлов/с")
+                result = measured[key]
+                if result is not None and (best_rate is None or result['files_per_second'] > best_rate):
+                    best_rate = result['files_per_second']
+                    best = settings
+    finally:
+        os.remove(files_path)
+
+    if not trials:
+        raise RuntimeError("Ни один замер не завершился успешно")
+    save_profile(best, trials, output, model_key)
+    logger.info(f"Лучшие настройки {best} сохранены в {output}")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Автонастройка параметров индексации")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Подобрать параметры и сохранить профиль")
+    run_parser.add_argument('--photos', default="Photos")
+    run_parser.add_argument('--sample', type=int, default=64, help="Файлов в каждом замере")
+    run_parser.add_argument('--output', default=TUNING_PROFILE_PATH)
+    run_parser.add_argument('--timeout', type=float, default=600, help="Лимит на один замер (сек)")
+    run_parser.add_argument('--seed', type=int, default=0)
+
+    subparsers.add_parser('show', help="Показать текущий профиль")
+
+    trial_parser = subparsers.add_parser('trial', help=argparse.SUPPRESS)
+    trial_parser.add_argument('--settings', required=True)
+    trial_parser.add_argument('--files', required=True)
+    trial_parser.add_argument('--result', required=True)
+    trial_parser.add_argument('--model', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        autotune(args.photos, args.sample, args.output, args.timeout, args.seed)
+    elif args.command == 'show':
+        profile = load_profile()
+        print(json.dumps(profile, ensure_ascii=False, indent=2) if profile else "Профиль не найден")
+    else:
+        with open(args.files, 'r', encoding='utf-8') as f:
+            files = [line for line in f.read().splitlines() if line]
+        result = run_trial(json.loads(args.settings), files, args.model)
+        with open(args.result, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+"""Воспроизводимые бенчмарки индексации, поиска и синхронизации.
+
+Все данные синтетические и генерируются из seed, поэтому прогоны на разных
+коммитах сравнимы между собой. Каждый прогон пишет JSON с результатами,
+параметрами, коммитом и описанием машины в benchmarks/results.
+
+    python benchmark.py search --rows 10000 100000 1000000
+    python benchmark.py index --jpeg 200 --png 50 --heic 50 --video 10
+    python benchmark.py sync --jpeg 500 --heic 100 --latency-ms 30
+    python benchmark.py preprocess --images 128 --threads 1 4 8
+    python benchmark.py all
+
+Бенчмарк index использует настоящую модель CLIP, search и sync работают без нее
+(текстовый энкодер заменяется детерминированной заглушкой). preprocess сравнивает
+пакетную предобработку с CLIPProcessor (нужна только его конфигурация).
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from model_registry import MODELS, DEFAULT_MODEL
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'benchmarks' / 'results'
+EMBEDDING_DIM = MODELS[DEFAULT_MODEL].dim
+CLIP_MODEL = MODELS[DEFAULT_MODEL].name
+
+
+def percentiles(values):
+    """p50/p95/p99/max в миллисекундах для списка длительностей в секундах"""
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    ordered = sorted(values)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))] * 1000.0
+
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': ordered[-1] * 1000.0}
+
+
+@contextlib.contextmanager
+def working_dir(path):
+    """Временно меняет рабочую директорию (индекс и прогресс движка пишутся относительно нее)"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield Path(path)
+    finally:
+        os.chdir(previous)
+
+
+# Синтетические данные
+
+def _synthetic_frame(rng, width, height):
+    """Градиент с шумом: сжимается примерно как обычная фотография, а не как чистый шум"""
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)),
+        np.broadcast_to((x + y) / 2, (height, width)),
+    ], axis=-1)
+    base = (base + rng.uniform(0, 255, size=3)) % 256
+    noise = rng.normal(0, 12, size=(height, width, 3))
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def generate_library(root, jpeg=100, png=20, heic=20, video=5, width=1024, height=768,
+                     video_frames=48, seed=0):
+    """Создает синтетическую медиатеку и возвращает список путей к файлам"""
+    from PIL import Image
+    import pillow_heif
+    import cv2
+
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+
+    for i in range(jpeg):
+        path = root / f"IMG_{i:05d}.JPG"
+        Image.fromarray(_synthetic_frame(rng, width, height)).save(path, 'JPEG', quality=90)
+        paths.append(path)
+    for i in range(png):
+        path = root / f"SCREEN_{i:05d}.PNG"
+        Image.fromarray(_synthetic_frame(rng, width, height)).save(path, 'PNG')
+        paths.append(path)
+    for i in range(heic):
+        path = root / f"IMG_H{i:05d}.HEIC"
+        image = Image.fromarray(_synthetic_frame(rng, width, height))
+        pillow_heif.from_pillow(image).save(str(path), quality=90)
+        paths.append(path)
+    for i in range(video):
+        path = root / f"MOV_{i:05d}.mp4"
+        writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 24, (width, height))
+        try:
+            for _ in range(video_frames):
+                writer.write(_synthetic_frame(rng, width, height)[:, :, ::-1])
+        finally:
+            writer.release()
+        paths.append(path)
+    return paths
+
+
+def synthetic_index(rows, dim=EMBEDDING_DIM, seed=0):
+    """Словарь путь -> нормализованный вектор того же вида, что и image_features движка.
+
+    Векторы - строки одной матрицы, поэтому построение не тратит память на копии.
+    """
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((rows, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return {f"Photos/bench/IMG_{i:07d}.JPG": matrix[i] for i in range(rows)}
+
+
+def synthetic_metadata(paths, seed=0, video_ratio=0.1):
+    """Метаданные для фильтров: даты съемки за три года и доля видео"""
+    rng = np.random.default_rng(seed + 1)
+    start = datetime(2021, 1, 1).timestamp()
+    captured = start + rng.uniform(0, 3 * 365 * 86400, size=len(paths))
+    is_video = rng.random(len(paths)) < video_ratio
+    return {
+        path: {'media_type': 'video' if video else 'image', 'captured_at': float(ts)}
+        for path, ts, video in zip(paths, captured, is_video)
+    }
+
+
+class StubTextEncoder:
+    """Детерминированная замена текстового энкодера CLIP: вектор зависит только от текста"""
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def __call__(self, queries):
+        vectors = np.empty((len(queries), self.dim), dtype=np.float32)
+        for i, query in enumerate(queries):
+            seed = int.from_bytes(hashlib.blake2b(query.encode(), digest_size=8).digest(), 'little')
+            vectors[i] = np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _metric_values(metric):
+    """Текущие значения счетчика по меткам (для разницы до/после прогона)"""
+    return {key[0] if len(key) == 1 else key: child.value for key, child in list(metric._children.items())}
+
+
+# Бенчмарки
+
+def bench_search(rows_list=(10_000, 100_000, 1_000_000), dim=EMBEDDING_DIM, queries=20, top_k=30,
+                 concurrency=1, seed=0):
+    """Задержка search_images на синтетических индексах разного размера (без фильтров и с ними)"""
+    from search_images import ImageSearchEngine, normalize_filters
+
+    filter_cases = {
+        'none': None,
+        'videos': normalize_filters({'media_type': 'video'}),
+        'summer_2023': normalize_filters({'date_from': '2023-06-01', 'date_to': '2023-08-31'}),
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, working_dir(tmp_dir):
+        engine = ImageSearchEngine()
+        engine.text_batcher.encode_fn = StubTextEncoder(dim)
+        texts = [f"benchmark query {i}" for i in range(queries)]
+
+        for rows in rows_list:
+            started = time.perf_counter()
+            engine.image_features = synthetic_index(rows, dim, seed)
+            engine.image_metadata = synthetic_metadata(list(engine.image_features), seed)
+            build_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            engine.rebuild_snapshot()
+            snapshot_seconds = time.perf_counter() - started
+            engine.search_images("warmup", top_k)
+
+            for case, filters in filter_cases.items():
+                def timed(text):
+                    query_started = time.perf_counter()
+                    engine.search_images(text, top_k, filters=filters)
+                    return time.perf_counter() - query_started
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    latencies = list(executor.map(timed, texts))
+                elapsed = time.perf_counter() - started
+
+                result = {
+                    'rows': rows,
+                    'dim': dim,
+                    'filters': case,
+                    'queries': queries,
+                    'concurrency': concurrency,
+                    'build_seconds': build_seconds,
+                    'snapshot_seconds': snapshot_seconds,
+                    'index_memory_bytes': engine.index_memory_bytes(),
+                    'queries_per_second': queries / elapsed if elapsed > 0 else 0.0,
+                    'latency_ms': percentiles(latencies),
+                }
+                results.append(result)
+                print(f"search rows={rows} filters={case}: p50 {result['latency_ms']['p50']:.1f} ms, "
+                      f"p95 {result['latency_ms']['p95']:.1f} ms, {result['queries_per_second']:.1f} qps")
+            engine.image_features = {}
+            engine.image_metadata = {}
+            engine.rebuild_snapshot()
+    return results
+
+
+def bench_index(jpeg=100, png=20, heic=20, video=5, width=1024, height=768, seed=0, model=DEFAULT_MODEL):
+    """Полная индексация синтетической медиатеки через update_index"""
+    from search_images import ImageSearchEngine
+    from metrics import INDEXING_STAGE_SECONDS, INDEXING_STAGE_ITEMS
+
+    with tempfile.TemporaryDirectory() as tmp_dir, working_dir(tmp_dir):
+        started = time.perf_counter()
+        paths = generate_library('Photos', jpeg, png, heic, video, width, height, seed=seed)
+        generate_seconds = time.perf_counter() - started
+        library_bytes = sum(path.stat().st_size for path in paths)
+
+        engine = ImageSearchEngine(model_key=model)
+        started = time.perf_counter()
+        engine.load_model()
+        model_seconds = time.perf_counter() - started
+
+        stage_seconds = _metric_values(INDEXING_STAGE_SECONDS)
+        stage_items = _metric_values(INDEXING_STAGE_ITEMS)
+        started = time.perf_counter()
+        engine.update_index('Photos')
+        elapsed = time.perf_counter() - started
+
+        indexed = len(engine.snapshot)
+        result = {
+            'model': model,
+            'files': len(paths),
+            'library_bytes': library_bytes,
+            'indexed': indexed,
+            'generate_seconds': generate_seconds,
+            'model_load_seconds': model_seconds,
+            'index_seconds': elapsed,
+            'files_per_second': indexed / elapsed if elapsed > 0 else 0.0,
+            'stage_seconds': {stage: value - stage_seconds.get(stage, 0.0)
+                              for stage, value in _metric_values(INDEXING_STAGE_SECONDS).items()},
+            'stage_items': {stage: value - stage_items.get(stage, 0.0)
+                            for stage, value in _metric_values(INDEXING_STAGE_ITEMS).items()},
+        }
+    print(f"index: {indexed} файлов за {elapsed:.1f} с ({result['files_per_second']:.1f} файлов/с)")
+    return result
+
+
+def bench_preprocess(images=64, width=1024, height=768, threads=None, rounds=3, seed=0):
+    """Пакетная предобработка против CLIPProcessor: расхождение и изображения в секунду на ядро"""
+    from PIL import Image
+    from transformers import CLIPProcessor
+    from clip_preprocess import BatchPreprocessor, max_difference
+
+    rng = np.random.default_rng(seed)
+    # Половина кадров портретные: проверяется масштабирование по обеим сторонам
+    frames = [Image.fromarray(_synthetic_frame(rng, width, height) if i % 2 == 0
+                              else _synthetic_frame(rng, height, width))
+              for i in range(images)]
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL)
+    preprocessor = BatchPreprocessor.from_processor(processor, max_batch=images)
+    difference = max_difference(preprocessor, processor, frames)
+
+    def best_of(run):
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    reference_seconds = best_of(lambda: processor(images=frames, return_tensors="pt"))
+    result = {
+        'images': images,
+        'max_abs_difference': difference,
+        'clip_processor': {
+            'seconds': reference_seconds,
+            'images_per_second': images / reference_seconds,
+            'images_per_second_per_core': images / reference_seconds,
+        },
+        'batch_preprocessor': [],
+    }
+    print(f"preprocess: расхождение с CLIPProcessor {difference:.2e}, "
+          f"CLIPProcessor {images / reference_seconds:.1f} изобр./с")
+
+    for workers in threads or sorted({1, os.cpu_count() or 1}):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            seconds = best_of(lambda: preprocessor(list(executor.map(preprocessor.prepare, frames))))
+        entry = {
+            'threads': workers,
+            'seconds': seconds,
+            'images_per_second': images / seconds,
+            'images_per_second_per_core': images / seconds / workers,
+        }
+        result['batch_preprocessor'].append(entry)
+        print(f"preprocess threads={workers}: {entry['images_per_second']:.1f} изобр./с, "
+              f"{entry['images_per_second_per_core']:.1f} на ядро")
+    return result
+
+
+def bench_sync(jpeg=200, png=20, heic=20, video=5, width=1024, height=768, latency_ms=0.0,
+               bandwidth_kbps=None, max_concurrent=None, seed=0):
+    """Первая и повторная (дельта) синхронизация с фейковым iCloud"""
+    from fake_icloud import FakeICloudService, FakePhotoServer
+    from icloud_sync import ICloudSync
+
+    server = None
+    if latency_ms or bandwidth_kbps or max_concurrent:
+        server = FakePhotoServer(
+            latency=latency_ms / 1000,
+            bandwidth=bandwidth_kbps * 1024 if bandwidth_kbps else None,
+            max_concurrent=max_concurrent
+        ).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir, working_dir(tmp_dir):
+            paths = generate_library('source', jpeg, png, heic, video, width, height, seed=seed)
+            library_bytes = sum(path.stat().st_size for path in paths)
+
+            sync = ICloudSync(photos_dir='Photos', manifest_path='manifest.db')
+            sync.api = FakeICloudService.from_files(paths, server=server)
+
+            started = time.perf_counter()
+            success, message, failed = sync.sync_photos()
+            full_seconds = time.perf_counter() - started
+            heic_stats = sync.heic_pool.get_stats()
+            limiter_stats = sync.limiter.get_stats()
+
+            started = time.perf_counter()
+            sync.sync_photos()
+            delta_seconds = time.perf_counter() - started
+
+            result = {
+                'assets': len(paths),
+                'library_bytes': library_bytes,
+                'success': bool(success),
+                'failed': len(failed or []),
+                'server': {
+                    'latency_ms': latency_ms,
+                    'bandwidth_kbps': bandwidth_kbps,
+                    'max_concurrent': max_concurrent,
+                } if server else None,
+                'full_sync_seconds': full_seconds,
+                'files_per_second': len(paths) / full_seconds if full_seconds > 0 else 0.0,
+                'megabytes_per_second': library_bytes / full_seconds / 1024 / 1024 if full_seconds > 0 else 0.0,
+                'delta_sync_seconds': delta_seconds,
+                'heic_conversion': heic_stats,
+                'download_concurrency': limiter_stats,
+            }
+    finally:
+        if server is not None:
+            server.stop()
+    print(f"sync: {len(paths)} файлов за {full_seconds:.1f} с, повторная синхронизация {delta_seconds:.2f} с")
+    return result
+
+
+# Результаты
+
+def _git_info():
+    root = Path(__file__).resolve().parent
+
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=root, capture_output=True, text=True,
+                                  timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ''
+
+    return {
+        'commit': git('rev-parse', 'HEAD') or None,
+        'branch': git('rev-parse', '--abbrev-ref', 'HEAD') or None,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+    }
+
+
+def _host_info():
+    info = {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        info['torch'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+        info['cuda'] = torch.cuda.is_available()
+    return info
+
+
+def write_results(name, params, results, output_dir=RESULTS_DIR):
+    """Сохраняет результаты прогона в JSON и возвращает путь к файлу"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    now = datetime.now()
+    git = _git_info()
+    report = {
+        'benchmark': name,
+        'timestamp': now.isoformat(timespec='seconds'),
+        'git': git,
+        'host': _host_info(),
+        'params': params,
+        'results': results,
+    }
+    short_commit = (git['commit'] or 'nogit')[:8]
+    path = output_dir / f"{now:%Y%m%d-%H%M%S}-{name}-{short_commit}.json"
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки индексации, поиска и синхронизации")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default=str(RESULTS_DIR))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_library_args(subparser, jpeg):
+        subparser.add_argument('--jpeg', type=int, default=jpeg)
+        subparser.add_argument('--png', type=int, default=20)
+        subparser.add_argument('--heic', type=int, default=20)
+        subparser.add_argument('--video', type=int, default=5)
+        subparser.add_argument('--width', type=int, default=1024)
+        subparser.add_argument('--height', type=int, default=768)
+
+    search_parser = subparsers.add_parser('search', help="Задержка поиска на синтетических индексах")
+    search_parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    search_parser.add_argument('--dim', type=int, default=EMBEDDING_DIM)
+    search_parser.add_argument('--queries', type=int, default=20)
+    search_parser.add_argument('--top-k', type=int, default=30)
+    search_parser.add_argument('--concurrency', type=int, default=1)
+
+    index_parser = subparsers.add_parser('index', help="Индексация синтетической медиатеки (нужна модель CLIP)")
+    add_library_args(index_parser, jpeg=100)
+    index_parser.add_argument('--model', choices=sorted(MODELS), default=DEFAULT_MODEL)
+
+    sync_parser = subparsers.add_parser('sync', help="Синхронизация с фейковым iCloud")
+    add_library_args(sync_parser, jpeg=200)
+    sync_parser.add_argument('--latency-ms', type=float, default=0.0)
+    sync_parser.add_argument('--bandwidth-kbps', type=float, default=None)
+    sync_parser.add_argument('--max-concurrent', type=int, default=None)
+
+    preprocess_parser = subparsers.add_parser('preprocess', help="Пакетная предобработка против CLIPProcessor")
+    preprocess_parser.add_argument('--images', type=int, default=64)
+    preprocess_parser.add_argument('--width', type=int, default=1024)
+    preprocess_parser.add_argument('--height', type=int, default=768)
+    preprocess_parser.add_argument('--threads', type=int, nargs='+', default=None)
+    preprocess_parser.add_argument('--rounds', type=int, default=3)
+
+    subparsers.add_parser('all', help="Все бенчмарки с параметрами по умолчанию")
+
+    args = parser.parse_args()
+    params = {key: value for key, value in vars(args).items() if key not in ('output_dir',)}
+    library = {key: getattr(args, key) for key in ('jpeg', 'png', 'heic', 'video', 'width', 'height')
+               if hasattr(args, key)}
+
+    if args.command == 'search':
+        results = bench_search(args.rows, args.dim, args.queries, args.top_k, args.concurrency, args.seed)
+    elif args.command == 'index':
+        results = bench_index(seed=args.seed, model=args.model, **library)
+    elif args.command == 'preprocess':
+        results = bench_preprocess(args.images, args.width, args.height, args.threads, args.rounds, args.seed)
+    elif args.command == 'sync':
+        results = bench_sync(latency_ms=args.latency_ms, bandwidth_kbps=args.bandwidth_kbps,
+                             max_concurrent=args.max_concurrent, seed=args.seed, **library)
+    else:
+        results = {
+            'search': bench_search(seed=args.seed),
+            'index': bench_index(seed=args.seed),
+            'preprocess': bench_preprocess(seed=args.seed),
+            'sync': bench_sync(seed=args.seed),
+        }
+    write_results(args.command, params, results, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import threading
+import numpy as np
+from PIL import Image
+
+# Параметры CLIPImageProcessor для openai/clip-vit-*
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+CLIP_SIZE = 224
+
+# Допустимое расхождение с CLIPProcessor (разный порядок операций с float32)
+EQUIVALENCE_TOLERANCE = 1e-4
+
+
+def _edge(value, key):
+    """Размер из конфигурации процессора: число или словарь {'shortest_edge'|'height': ...}"""
+    if isinstance(value, dict):
+        return value.get(key) or value.get('height')
+    return value
+
+
+class BatchPreprocessor:
+    """Пакетная предобработка изображений для CLIP вместо CLIPProcessor.
+
+    Повторяет CLIPImageProcessor: масштабирование по короткой стороне
+    (бикубическое, как у PIL), центральная обрезка, приведение к [0, 1] и
+    нормализация. Масштабирование и обрезка выполняются по одному
+    изображению в prepare() и потокобезопасны (PIL отпускает GIL), поэтому
+    их можно делать в потоках декодирования. Нормализация выполняется
+    сразу для всего батча одной векторной операцией в заранее выделенный
+    буфер, без создания нового тензора на каждое изображение.
+    """
+
+    def __init__(self, size=CLIP_SIZE, crop_size=CLIP_SIZE, mean=CLIP_MEAN, std=CLIP_STD,
+                 resample=Image.BICUBIC, max_batch=16):
+        self.size = size
+        self.crop_size = crop_size
+        self.resample = resample
+        std = np.asarray(std, dtype=np.float32)
+        # (x / 255 - mean) / std == x * scale - shift
+        self._scale = (1.0 / (255.0 * std)).reshape(3, 1, 1)
+        self._shift = (np.asarray(mean, dtype=np.float32) / std).reshape(3, 1, 1)
+        self._lock = threading.Lock()
+        self._pixels = None
+        self._output = None
+        self._reserve(max_batch)
+
+    @classmethod
+    def from_processor(cls, processor, max_batch=16):
+        """Берет параметры из CLIPProcessor/CLIPImageProcessor модели"""
+        image_processor = getattr(processor, 'image_processor', processor)
+        return cls(
+            size=_edge(image_processor.size, 'shortest_edge'),
+            crop_size=_edge(image_processor.crop_size, 'height'),
+            mean=image_processor.image_mean,
+            std=image_processor.image_std,
+            resample=image_processor.resample,
+            max_batch=max_batch,
+        )
+
+    def _reserve(self, batch):
+        if self._pixels is not None and self._pixels.shape[0] >= batch:
+            return
+        crop = self.crop_size
+        self._pixels = np.empty((batch, crop, crop, 3), dtype=np.uint8)
+        self._output = np.empty((batch, 3, crop, crop), dtype=np.float32)
+
+    def prepare(self, image):
+        """Масштабирует и обрезает одно RGB-изображение PIL, возвращает uint8 (crop, crop, 3)"""
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        width, height = image.size
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = self.size, int(self.size * long / short)
+        new_size = (new_short, new_long) if width <= height else (new_long, new_short)
+        if new_size != image.size:
+            image = image.resize(new_size, resample=self.resample)
+        pixels = np.asarray(image)
+        crop = self.crop_size
+        top = (pixels.shape[0] - crop) // 2
+        left = (pixels.shape[1] - crop) // 2
+        if top < 0 or left < 0:
+            # Обрезка больше изображения: дополняем нулями, как CLIPImageProcessor
+            padded = np.zeros((max(crop, pixels.shape[0]), max(crop, pixels.shape[1]), 3), dtype=np.uint8)
+            pad_top, pad_left = max(0, -top), max(0, -left)
+            padded[pad_top:pad_top + pixels.shape[0], pad_left:pad_left + pixels.shape[1]] = pixels
+            pixels, top, left = padded, max(0, top), max(0, left)
+        return pixels[top:top + crop, left:left + crop]
+
+    def __call__(self, images):
+        """Нормализованный батч float32 (N, 3, crop, crop).
+
+        images - изображения PIL или результаты prepare(). Возвращается
+        представление внутреннего буфера: оно действительно до следующего вызова.
+        """
+        with self._lock:
+            count = len(images)
+            self._reserve(count)
+            pixels = self._pixels[:count]
+            for i, image in enumerate(images):
+                pixels[i] = image if isinstance(image, np.ndarray) else self.prepare(image)
+            output = self._output[:count]
+            np.multiply(pixels.transpose(0, 3, 1, 2), self._scale, out=output)
+            np.subtract(output, self._shift, out=output)
+            return output
+
+
+def max_difference(preprocessor, processor, images):
+    """Максимальное абсолютное расхождение с CLIPProcessor на наборе изображений"""
+    expected = processor(images=images, return_tensors="np")['pixel_values']
+    actual = preprocessor(images)
+    return float(np.abs(expected.astype(np.float32) - actual).max())
+
+
+def verify(preprocessor, processor, images=None):
+    """Проверяет, что предобработка совпадает с CLIPProcessor.
+
+    По умолчанию используются синтетические изображения разной ориентации и
+    размера (включая меньше обрезки). Возвращает максимальное расхождение.
+    """
+    if images is None:
+        rng = np.random.default_rng(0)
+        images = [Image.fromarray(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+                  for width, height in ((640, 480), (480, 640), (301, 517), (224, 224), (120, 90))]
+    return max_difference(preprocessor, processor, images)
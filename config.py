@@ -1,10 +1,63 @@
 import os
 from pathlib import Path
 import base64
-from cryptography.fernet import Fernet
 
-# Генерируем ключ правильного формата
-ENCRYPTION_KEY = Fernet.generate_key()
+# Зашифрованная сессия iCloud (ключ - app.get_encryption_key, производный от идентификатора устройства)
+SESSION_FILE = Path("icloud_session.dat")
 
-# Путь к файлу с сессией
-SESSION_FILE = Path("icloud_session.dat") 
\ No newline at end of file
+# Объединение одновременных поисковых запросов в батчи для текстового энкодера
+TEXT_BATCH_MAX_SIZE = 16  # Максимальный размер батча
+TEXT_BATCH_WAIT_MS = 5  # Окно ожидания попутных запросов (мс)
+
+# Потоковое скачивание из iCloud
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Размер чанка (1 MB)
+DOWNLOAD_BUFFER_BUDGET = 32 * 1024 * 1024  # Общий лимит памяти под буферы всех потоков (32 MB)
+
+# Адаптивная параллельность скачивания (AIMD) и повторные попытки
+DOWNLOAD_MIN_WORKERS = 1
+DOWNLOAD_INITIAL_WORKERS = 4
+DOWNLOAD_MAX_WORKERS = 32
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF_BASE = 0.5  # Базовая задержка экспоненциального отката (сек)
+DOWNLOAD_BACKOFF_CAP = 30  # Максимальная задержка между попытками (сек)
+
+# Конвертация HEIC в отдельных процессах
+HEIC_CONVERSION_WORKERS = os.cpu_count() or 1  # Число процессов
+HEIC_CONVERSION_MAX_PENDING = 2 * HEIC_CONVERSION_WORKERS  # Лимит файлов в очереди (обратное давление)
+
+# Снимки индекса для поиска во время индексации
+SNAPSHOT_PUBLISH_INTERVAL = 2.0  # Как часто новые файлы становятся видны поиску при индексации (сек)
+
+# Профилирование по запросу
+PROFILE_SAMPLE_INTERVAL_MS = 1  # Интервал сэмплирования стеков при профилировании /search (мс)
+TRACES_DIR = Path("traces")  # Куда сохраняются трассировки индексации (Chrome trace-event JSON)
+
+# Кэш эмбеддингов по содержимому файлов
+EMBEDDING_CACHE_PATH = "embedding_cache.db"  # SQLite-база: хэш файла + модель -> вектор
+
+# Пакетная индексация
+INDEX_BATCH_SIZE = 16  # Файлов в одном проходе модели
+DECODE_WORKERS = min(8, os.cpu_count() or 1)  # Потоков декодирования и предобработки
+TUNING_PROFILE_PATH = "tuning_profile.json"  # Профиль автонастройки (python autotune.py run)
+
+# Модель эмбеддингов (ключ из model_registry.MODELS)
+EMBEDDING_MODEL = "clip-b32"  # Модель по умолчанию; после миграции активная модель хранится в MODEL_STATE_PATH
+MODEL_STATE_PATH = "model_state.json"
+
+# Автотеги при индексации: запросы, совпадающие с тегом, отвечаются по инвертированному индексу без CLIP
+AUTO_TAGS_ENABLED = True
+AUTO_TAG_VOCABULARY_PATH = "tag_vocabulary.txt"  # Свой словарь (тег, синоним, ... в строке); без файла - встроенный
+AUTO_TAG_PROMPT = "a photo of a {}."  # Подсказка, по которой считается эмбеддинг тега
+AUTO_TAG_THRESHOLD = 0.2  # Минимальная вероятность тега (softmax по словарю)
+AUTO_TAG_MAX_PER_IMAGE = 5
+
+# Наблюдение за директорией с фотографиями (inotify)
+WATCH_PHOTOS = True  # Индексировать файлы, скопированные в Photos другими программами, сразу
+WATCH_DEBOUNCE = 2.0  # Сколько секунд по файлу не должно быть событий, прежде чем он индексируется
+WATCH_BATCH_SIZE = 16  # Файлов в одном вызове add_files
+WATCH_SCAN_INTERVAL = 600  # Интервал полной проверки, если inotify недоступен (сек)
+
+# Раскладка файлов в Photos: "sharded" - по поддиректориям вида Photos/a/3/ (хэш идентификатора ассета),
+# "flat" - все файлы в одной директории. Плоская медиатека переносится в шарды при запуске
+STORAGE_LAYOUT = "sharded"
+STORAGE_MIGRATION_BATCH = 500  # Файлов между сохранениями индекса при переносе
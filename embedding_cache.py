@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """Быстрый хэш содержимого файла (BLAKE2b, 128 бит)"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Кэш эмбеддингов, адресуемый по содержимому файла.
+
+    Вектор хранится под ключом (хэш содержимого, модель), а записи путей
+    лишь ссылаются на него. Переименованный, перемещенный или повторно
+    скачанный под другим именем файл стоит одного хэширования, а не прохода
+    CLIP. Хэш пути запоминается вместе с размером и mtime, поэтому неизмененные
+    файлы не перечитываются. Векторы, на которые не ссылается ни один путь,
+    удаляет gc().
+    """
+
+    def __init__(self, db_path="embedding_cache.db", model_id="openai/clip-vit-base-patch32"):
+        self.db_path = str(db_path)
+        self.model_id = model_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    digest TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (digest, model_id)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS paths (
+                    path TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL,
+                    PRIMARY KEY (path, model_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_paths_digest ON paths(digest, model_id)")
+
+    def digest(self, path):
+        """Хэш содержимого файла; для неизмененного файла берется из кэша без чтения"""
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest, size, mtime FROM paths WHERE path = ? AND model_id = ?",
+                (str(path), self.model_id)
+            ).fetchone()
+        if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime:
+            return row[0], stat
+        return file_digest(path), stat
+
+    def get(self, digest):
+        """Вектор для содержимого или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dim, vector FROM embeddings WHERE digest = ? AND model_id = ?",
+                (digest, self.model_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[1], dtype=np.float32, count=row[0]).copy()
+
+    def put(self, digest, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (digest, model_id, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                (digest, self.model_id, vector.shape[0], vector.tobytes(), time.time())
+            )
+
+    def link(self, path, digest, stat):
+        """Связывает путь с содержимым"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO paths (path, model_id, digest, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                (str(path), self.model_id, digest, stat.st_size, stat.st_mtime)
+            )
+
+    def rename(self, renames):
+        """Переносит ссылки путей на новые пути (файлы перемещены, содержимое и mtime прежние)"""
+        keys = [(str(new), str(old), self.model_id) for old, new in renames.items()]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE OR REPLACE paths SET path = ? WHERE path = ? AND model_id = ?", keys)
+
+    def unlink(self, paths):
+        """Удаляет ссылки путей (векторы остаются до gc)"""
+        keys = [(str(path), self.model_id) for path in paths]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM paths WHERE path = ? AND model_id = ?", keys)
+
+    def linked_paths(self):
+        """Множество путей, уже связанных с содержимым"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM paths WHERE model_id = ?", (self.model_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def backfill(self, features, workers=4):
+        """Заносит в кэш уже посчитанные векторы (индекс, созданный до появления кэша).
+
+        features - словарь путь -> вектор. Файлы хэшируются параллельно:
+        хэширование больших блоков отпускает GIL.
+        """
+        paths = list(features)
+
+        def hash_one(path):
+            try:
+                digest, stat = self.digest(path)
+                return path, digest, stat
+            except OSError:
+                return path, None, None
+
+        stored = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, digest, stat in executor.map(hash_one, paths):
+                if digest is None:
+                    continue
+                self.put(digest, features[path])
+                self.link(path, digest, stat)
+                stored += 1
+        return stored
+
+    def gc(self):
+        """Удаляет векторы, на которые не ссылается ни один путь. Возвращает их количество"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("""
+                DELETE FROM embeddings WHERE NOT EXISTS (
+                    SELECT 1 FROM paths
+                    WHERE paths.digest = embeddings.digest AND paths.model_id = embeddings.model_id
+                )
+            """)
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            embeddings = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model_id = ?", (self.model_id,)
+            ).fetchone()[0]
+            paths = self._conn.execute(
+                "SELECT COUNT(*) FROM paths WHERE model_id = ?", (self.model_id,)
+            ).fetchone()[0]
+        return {'model_id': self.model_id, 'embeddings': embeddings, 'paths': paths}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,313 @@
+"""Заглушка сервиса iCloud Photos для проверки синхронизации без аккаунта Apple.
+
+Повторяет ту часть интерфейса pyicloud, которой пользуется ICloudSync:
+api.photos.all, а у ассетов - id, filename, size, _master_record и download().
+Пример:
+
+    sync = ICloudSync(photos_dir="/tmp/photos", manifest_path="/tmp/manifest.db")
+    sync.api = FakeICloudService.with_library(1000)
+    sync.sync_photos()
+
+С FakePhotoServer содержимое отдается по настоящему HTTP с задержкой,
+ограничением скорости и ответами 429/503. Проверка адаптивной параллельности:
+
+    python fake_icloud.py --assets 300 --latency-ms 50 --max-concurrent 8
+"""
+import argparse
+import base64
+import hashlib
+import http.client
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeResponse:
+    """Ответ на скачивание, похожий на requests.Response"""
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {'Content-Length': str(len(content))}
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeHTTPResponse:
+    """Потоковый ответ локального сервера с интерфейсом requests.Response"""
+
+    def __init__(self, connection, response):
+        self._connection = connection
+        self._response = response
+        self.status_code = response.status
+        self.headers = dict(response.getheaders())
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        while True:
+            chunk = self._response.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self._response.close()
+        self._connection.close()
+
+
+class FakePhotoServer:
+    """Локальный HTTP-сервер с содержимым ассетов.
+
+    latency - задержка перед ответом (сек), bandwidth - скорость одного соединения
+    (байт/сек), throttle_rate - доля случайных ответов throttle_status,
+    max_concurrent - число одновременных запросов, сверх которого сервер отвечает 503.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, throttle_rate=0.0, throttle_status=429,
+                 retry_after=1, max_concurrent=None, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.throttle_status = throttle_status
+        self.retry_after = retry_after
+        self.max_concurrent = max_concurrent
+        self.assets = {}
+        self.requests = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    def register(self, asset):
+        self.assets[asset.id] = asset
+        asset.server = self
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                asset = server.assets.get(self.path.rsplit('/', 1)[-1])
+                with server._lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                    overloaded = server.max_concurrent is not None and server.in_flight > server.max_concurrent
+                    throttled = overloaded or server._rng.random() < server.throttle_rate
+                    if throttled:
+                        server.throttled += 1
+                try:
+                    if asset is None:
+                        self.send_error(404)
+                        return
+                    if throttled:
+                        self.send_response(503 if overloaded else server.throttle_status)
+                        self.send_header('Retry-After', str(server.retry_after))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    time.sleep(server.latency)
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(asset.content)))
+                    self.end_headers()
+                    step = 64 * 1024
+                    for offset in range(0, len(asset.content), step):
+                        chunk = asset.content[offset:offset + step]
+                        if server.bandwidth:
+                            time.sleep(len(chunk) / server.bandwidth)
+                        self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='FakePhotoServer', daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def fetch(self, asset_id):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        connection.request('GET', f'/assets/{asset_id}')
+        return FakeHTTPResponse(connection, connection.getresponse())
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+class FakePhotoAsset:
+    """Ассет фотографии с метаданными в формате записей CloudKit"""
+
+    def __init__(self, asset_id, filename, content, created=None):
+        self.id = asset_id
+        self.filename = filename
+        self.content = content
+        self.created = created or datetime(2024, 1, 1)
+        self.asset_date = self.created
+        self.added_date = self.created
+        self.download_count = 0
+        self.server = None
+        self._update_master_record()
+
+    def _update_master_record(self):
+        fingerprint = base64.b64encode(hashlib.sha1(self.content).digest()).decode()
+        self._master_record = {
+            'recordName': self.id,
+            'modified': {'timestamp': int(self.added_date.timestamp() * 1000)},
+            'fields': {
+                'filenameEnc': {'value': base64.b64encode(self.filename.encode()).decode()},
+                'resOriginalRes': {'value': {'size': len(self.content)}},
+                'resOriginalFingerprint': {'value': fingerprint},
+            },
+        }
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    def modify(self, content):
+        """Имитирует изменение ассета в iCloud (например, после редактирования)"""
+        self.content = content
+        self.added_date = self.added_date + timedelta(seconds=1)
+        self._update_master_record()
+
+    def download(self, version='original'):
+        self.download_count += 1
+        if self.server is not None:
+            return self.server.fetch(self.id)
+        return FakeResponse(self.content)
+
+
+class FakePhotoAlbum:
+    """Альбом, поддерживающий len() и итерацию, как PhotoAlbum в pyicloud"""
+
+    def __init__(self, assets):
+        self.assets = list(assets)
+
+    def __len__(self):
+        return len(self.assets)
+
+    def __iter__(self):
+        return iter(self.assets)
+
+
+class FakePhotosService:
+    def __init__(self, assets):
+        self.all = FakePhotoAlbum(assets)
+
+
+class FakeICloudService:
+    """Аутентифицированная сессия iCloud с заданной библиотекой"""
+
+    requires_2fa = False
+
+    def __init__(self, assets):
+        self.photos = FakePhotosService(assets)
+        self.devices = []
+
+    def validate_2fa_code(self, code):
+        return True
+
+    @classmethod
+    def with_library(cls, count, duplicate_name_ratio=0.1, min_size=10 * 1024, max_size=200 * 1024, seed=0,
+                     server=None):
+        """Создает библиотеку из count ассетов со случайным содержимым.
+
+        Часть ассетов получает одинаковые имена файлов, как это бывает
+        в реальных библиотеках (IMG_0001.JPG с разных устройств).
+        """
+        rng = random.Random(seed)
+        assets = []
+        for i in range(count):
+            asset_id = hashlib.sha1(f"asset-{seed}-{i}".encode()).hexdigest().upper()
+            if assets and rng.random() < duplicate_name_ratio:
+                filename = rng.choice(assets).filename
+            else:
+                ext = rng.choice(['JPG', 'JPG', 'JPG', 'PNG', 'MOV'])
+                filename = f"IMG_{i:04d}.{ext}"
+            content = rng.randbytes(rng.randint(min_size, max_size))
+            assets.append(FakePhotoAsset(asset_id, filename, content, datetime(2024, 1, 1) + timedelta(minutes=i)))
+            if server is not None:
+                server.register(assets[-1])
+        return cls(assets)
+
+    @classmethod
+    def from_files(cls, paths, server=None):
+        """Создает библиотеку из реальных файлов (например, синтетической библиотеки benchmark.py)"""
+        assets = []
+        for i, path in enumerate(sorted(paths)):
+            with open(path, 'rb') as f:
+                content = f.read()
+            asset_id = hashlib.sha1(f"file-{path}".encode()).hexdigest().upper()
+            filename = os.path.basename(str(path))
+            assets.append(FakePhotoAsset(asset_id, filename, content, datetime(2024, 1, 1) + timedelta(minutes=i)))
+            if server is not None:
+                server.register(assets[-1])
+        return cls(assets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синхронизация с локальным фейковым сервером iCloud")
+    parser.add_argument('--assets', type=int, default=300)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--bandwidth-kbps', type=float, default=2048, help="Скорость одного соединения (KB/s)")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Доля случайных ответов 429")
+    parser.add_argument('--max-concurrent', type=int, default=8, help="Сверх этого числа запросов сервер отвечает 503")
+    parser.add_argument('--retry-after', type=float, default=1)
+    args = parser.parse_args()
+
+    from icloud_sync import ICloudSync
+
+    server = FakePhotoServer(
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_kbps * 1024,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        max_concurrent=args.max_concurrent
+    ).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sync = ICloudSync(photos_dir=f"{tmp_dir}/Photos", manifest_path=f"{tmp_dir}/manifest.db")
+            sync.api = FakeICloudService.with_library(args.assets, server=server)
+            started = time.perf_counter()
+            success, message, failed = sync.sync_photos()
+            elapsed = time.perf_counter() - started
+
+            print(message)
+            print(f"Время: {elapsed:.1f} с, запросов: {server.requests}, 429/503: {server.throttled}, "
+                  f"пик одновременных запросов: {server.peak_in_flight}")
+            print(f"Лимитер: {sync.limiter.get_stats()}")
+            print("История лимита: " + ", ".join(f"{t:.1f}s={limit:.0f}" for t, limit in sync.limiter.history))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pillow_heif
+from PIL import Image
+from logger_config import setup_logger, LogSummary
+from metrics import HEIC_CONVERSIONS, HEIC_CONVERSION_SECONDS
+
+logger = setup_logger(__name__)
+
+# HEIC-файлы, которые сейчас скачивает и конвертирует синхронизация
+_claimed = set()
+_claimed_lock = threading.Lock()
+
+
+def claim_heic(heic_path):
+    """Отмечает HEIC как обрабатываемый синхронизацией до release_heic()"""
+    with _claimed_lock:
+        _claimed.add(os.path.abspath(heic_path))
+
+
+def release_heic(heic_path):
+    with _claimed_lock:
+        _claimed.discard(os.path.abspath(heic_path))
+
+
+def is_heic_claimed(heic_path):
+    """True, если HEIC конвертирует синхронизация и трогать его нельзя"""
+    with _claimed_lock:
+        return os.path.abspath(heic_path) in _claimed
+
+
+def convert_heic_file(heic_path):
+    """Конвертирует HEIC в JPEG и удаляет исходник.
+
+    Выполняется в дочернем процессе, поэтому ничего не логирует, а возвращает
+    кортеж (jpeg_path или None, текст ошибки или None, затраченное время).
+    """
+    started = time.perf_counter()
+    try:
+        jpeg_path = os.path.splitext(str(heic_path))[0] + '.jpg'
+
+        # Если JPEG файл уже существует, пропускаем конвертацию
+        if not os.path.exists(jpeg_path):
+            heif_file = pillow_heif.read_heif(str(heic_path))
+            image = Image.frombytes(
+                heif_file.mode,
+                heif_file.size,
+                heif_file.data,
+                "raw",
+            )
+            # Пишем во временный файл, чтобы индексатор не увидел недописанный JPEG
+            tmp_path = os.path.join(os.path.dirname(jpeg_path), f".{os.path.basename(jpeg_path)}.part")
+            image.save(tmp_path, 'JPEG', quality=95)
+            os.replace(tmp_path, jpeg_path)
+
+        os.remove(str(heic_path))
+        return jpeg_path, None, time.perf_counter() - started
+    except Exception as e:
+        return None, str(e), time.perf_counter() - started
+
+
+class HeicConversionPool:
+    """Пул процессов для конвертации HEIC, отделенный от потоков скачивания.
+
+    Декодирование HEIC и кодирование JPEG занимают CPU и держат GIL, поэтому
+    выполняются в отдельных процессах по числу ядер. Очередь ограничена
+    max_pending файлами: если конвертация не успевает, submit() блокирует
+    поток скачивания, и несконвертированные файлы не копятся на диске.
+
+    Процессы запускаются через spawn, а не fork: fork копирует процесс с уже
+    работающими потоками (torch, Flask, логирование), и блокировка, занятая
+    одним из них в момент fork, навсегда остается занятой в дочернем процессе.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 2
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.converted = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self._started = None
+        self._finished = None
+        self._log = LogSummary(logger, "Конвертация HEIC")
+
+    def submit(self, heic_path, callback):
+        """Ставит файл в очередь на конвертацию.
+
+        callback(jpeg_path или None) вызывается по завершении из служебного потока пула.
+        """
+        waited = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - waited
+
+        with self._lock:
+            self.blocked_seconds += waited
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                if self._started is None:
+                    self._started = time.perf_counter()
+                self._finished = None
+            executor = self._executor
+
+        try:
+            future = executor.submit(convert_heic_file, str(heic_path))
+        except Exception:
+            self._slots.release()
+            raise
+
+        def on_done(future):
+            try:
+                try:
+                    jpeg_path, error, seconds = future.result()
+                except Exception as e:
+                    jpeg_path, error, seconds = None, str(e), 0.0
+                with self._lock:
+                    self.busy_seconds += seconds
+                    if jpeg_path:
+                        self.converted += 1
+                    else:
+                        self.failed += 1
+                HEIC_CONVERSIONS.labels('converted' if jpeg_path else 'failed').inc()
+                HEIC_CONVERSION_SECONDS.inc(seconds)
+                if error:
+                    logger.error(f"Ошибка при конвертации {heic_path}: {error}")
+                else:
+                    self._log.count('сконвертировано')
+                callback(jpeg_path)
+            finally:
+                self._slots.release()
+
+        future.add_done_callback(on_done)
+        return future
+
+    def shutdown(self, wait=True):
+        """Дожидается конвертации всех файлов и останавливает процессы"""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+            self._finished = time.perf_counter()
+        self._log.flush()
+
+    def get_stats(self):
+        """Пропускная способность конвертации (отдельно от скачивания)"""
+        with self._lock:
+            finished = self._finished or time.perf_counter()
+            elapsed = (finished - self._started) if self._started else 0.0
+            done = self.converted + self.failed
+            return {
+                'workers': self.max_workers,
+                'converted': self.converted,
+                'failed': self.failed,
+                'files_per_second': (done / elapsed) if elapsed > 0 else 0.0,
+                'avg_seconds_per_file': (self.busy_seconds / done) if done else 0.0,
+                'download_blocked_seconds': self.blocked_seconds,
+            }
@@ -0,0 +1,42 @@
+import importlib
+import os
+import sys
+import config
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _project_modules():
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and os.path.dirname(os.path.abspath(path)) == _PROJECT_DIR and module is not config:
+            yield module
+
+
+def reload_config():
+    """Перечитывает config.py и обновляет значения, импортированные из него модулями проекта.
+
+    Модули импортируют настройки через from config import ..., поэтому после
+    перечитывания config в каждом модуле заменяются имена, которые ссылаются
+    на прежнее значение из config. Настройки, читаемые при каждом вызове,
+    начинают действовать сразу; настройки, заданные при создании объектов
+    (размер батча, окно text_batcher), - в следующем поколении движка.
+    Возвращает список изменившихся настроек.
+    """
+    previous = {name: value for name, value in vars(config).items() if name.isupper()}
+    importlib.reload(config)
+    current = {name: value for name, value in vars(config).items() if name.isupper()}
+    changed = sorted(name for name in current if name not in previous or current[name] != previous[name])
+    if not changed:
+        return changed
+    for module in _project_modules():
+        namespace = vars(module)
+        for name in changed:
+            # Заменяем только импортированное из config, а не одноименные константы модуля
+            if name in previous and namespace.get(name) is previous[name]:
+                namespace[name] = current[name]
+    logger.info(f"Конфигурация перечитана, изменились: {', '.join(changed)}")
+    return changed
@@ -1,25 +1,122 @@
 from pyicloud import PyiCloudService
+import atexit
 import os
 import time
 from pathlib import Path
-import logging
 import pickle
 import json
-from cryptography.fernet import Fernet
-from config import SESSION_FILE, ENCRYPTION_KEY
-import pillow_heif
-from PIL import Image
+import hashlib
+import threading
+import base64
+import shutil
+import tempfile
+from contextlib import contextmanager
+from cryptography.fernet import Fernet, InvalidToken
+from config import (
+    SESSION_FILE, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_BUFFER_BUDGET,
+    DOWNLOAD_MIN_WORKERS, DOWNLOAD_INITIAL_WORKERS, DOWNLOAD_MAX_WORKERS,
+    DOWNLOAD_MAX_RETRIES, DOWNLOAD_BACKOFF_BASE, DOWNLOAD_BACKOFF_CAP,
+    HEIC_CONVERSION_WORKERS, HEIC_CONVERSION_MAX_PENDING, STORAGE_LAYOUT
+)
+from functools import partial
+from sync_manifest import SyncManifest
+from storage_layout import LAYOUT_SHARDED, shard_dir
+from logger_config import setup_logger, LogSummary
+from metrics import (
+    DOWNLOAD_BYTES, DOWNLOAD_FILES, DOWNLOAD_RETRIES, DOWNLOAD_ERRORS,
+    DOWNLOAD_CONCURRENCY, CACHE_REQUESTS
+)
+from heic_converter import HeicConversionPool, claim_heic, convert_heic_file, release_heic
+from adaptive_scheduler import (
+    AdaptiveConcurrencyLimiter, backoff_delay, get_status_and_retry_after, parse_retry_after
+)
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+logger = setup_logger(__name__)
+
+_MANIFEST_HIT = CACHE_REQUESTS.labels('sync_manifest', 'hit')
+_MANIFEST_MISS = CACHE_REQUESTS.labels('sync_manifest', 'miss')
+
+_SESSION_DIR_PREFIX = 'icloud_session_'
+
+
+def _remove_stale_session_dirs():
+    """Удаляет расшифрованные сессии, оставшиеся от завершившихся аварийно процессов"""
+    for path in Path(tempfile.gettempdir()).glob(f"{_SESSION_DIR_PREFIX}*"):
+        try:
+            pid = int(path.name[len(_SESSION_DIR_PREFIX):].split('_', 1)[0])
+        except ValueError:
+            continue
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # Процесс жив, но принадлежит другому пользователю
+            pass
+
+class ByteBudget:
+    """Общий на все потоки лимит байт, одновременно находящихся в памяти при скачивании"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        # Один чанк больше всего лимита все равно должен пройти, иначе поток зависнет
+        size = min(size, self.limit)
+        with self._cond:
+            while self.in_use + size > self.limit:
+                self._cond.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= size
+                self._cond.notify_all()
+
+class DownloadVerificationError(Exception):
+    """Скачанный файл не совпадает с ожидаемым размером"""
+
+class DownloadHTTPError(Exception):
+    """Сервер ответил ошибкой на запрос скачивания"""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
 
 class ICloudSync:
-    def __init__(self, username=None, password=None):
+    def __init__(self, username=None, password=None, photos_dir="Photos", manifest_path="sync_manifest.db",
+                 catalog=None, layout=STORAGE_LAYOUT, session_key=None, session_file=SESSION_FILE):
         self.username = username
         self.password = password
         self.api = None
-        self.photos_dir = Path("Photos")
+        # Сессия pyicloud (токены и cookie) хранится зашифрованной ключом session_key,
+        # чтобы после перезапуска не входить заново и не вводить код 2FA
+        self.session_key = session_key
+        self.session_file = Path(session_file)
+        self._session_dir = None
+        self.photos_dir = Path(photos_dir)
         self.photos_dir.mkdir(exist_ok=True)
+        # Манифест синхронизации: какие ассеты уже скачаны и в каком состоянии
+        self.manifest = SyncManifest(manifest_path)
+        # Лимит памяти под буферы скачивания, общий для всех потоков
+        self.buffer_budget = ByteBudget(DOWNLOAD_BUFFER_BUDGET)
+        # Адаптивный лимит параллельных скачиваний (пересоздается на каждую синхронизацию)
+        self.limiter = None
+        # Пул процессов для конвертации HEIC (пересоздается на каждую синхронизацию)
+        self.heic_pool = None
+        # Каталог медиафайлов (MediaCatalog), пополняется по мере скачивания
+        self.catalog = catalog
+        # Раскладка файлов: новые ассеты кладутся в поддиректории шардов
+        self.layout = layout
         
     def is_authenticated(self):
         """Проверяет, аутентифицирован ли пользователь"""
@@ -33,15 +130,21 @@ class ICloudSync:
             return False
 
     def connect(self):
-        """Подключается к iCloud"""
+        """Подключается к iCloud (с сохраненной сессией пароль и код 2FA не нужны)"""
         try:
-            if self.username and self.password:
-                self.api = PyiCloudService(self.username, self.password)
+            restored = self._restore_session()
+            if self.username and (self.password or restored):
+                # Без пароля pyicloud ищет его в keyring и падает, не проверив сессию. С пустым
+                # паролем он сначала проверяет токен восстановленной сессии и входит по паролю,
+                # только если токен недействителен
+                self.api = PyiCloudService(self.username, self.password or '',
+                                           cookie_directory=self._cookie_directory())
                 
                 if self.api.requires_2fa:
                     logger.error("Требуется двухфакторная аутентификация")
                     return False, "Требуется двухфакторная аутентификация"
                 
+                self.save_session()
                 return True, "Успешное подключение"
             
             return False, "Необходимы учетные данные для входа"
@@ -55,44 +158,191 @@ class ICloudSync:
             if not self.api:
                 return False
             result = self.api.validate_2fa_code(code)
+            if result:
+                # Доверенная сессия: следующий вход по сохраненной сессии пройдет без кода
+                if not self.api.is_trusted_session:
+                    self.api.trust_session()
+                self.save_session()
             return result
         except Exception as e:
             logger.error(f"Ошибка при проверке кода 2FA: {str(e)}")
             return False
 
-    def convert_heic_to_jpeg(self, heic_path):
-        """Конвертирует HEIC файл в JPEG формат"""
+    def _cookie_directory(self):
+        """Рабочая директория сессии pyicloud (доступна только текущему пользователю).
+
+        pyicloud пишет в нее токены и cookie при каждом запросе, поэтому она
+        живет, пока подключение используется, и удаляется close() или при
+        выходе из процесса; директории процессов, завершившихся аварийно,
+        удаляются при создании следующей.
+        """
+        if self._session_dir is None:
+            _remove_stale_session_dirs()
+            self._session_dir = tempfile.mkdtemp(prefix=f"{_SESSION_DIR_PREFIX}{os.getpid()}_")
+            atexit.register(shutil.rmtree, self._session_dir, ignore_errors=True)
+        return self._session_dir
+
+    def _restore_session(self):
+        """Расшифровывает сохраненную сессию в рабочую директорию; True, если сессия восстановлена"""
+        if self.session_key is None or not self.session_file.exists():
+            return False
         try:
-            # Получаем путь для нового JPEG файла
-            jpeg_path = os.path.splitext(str(heic_path))[0] + '.jpg'
-            
-            # Если JPEG файл уже существует, пропускаем конвертацию
-            if os.path.exists(jpeg_path):
-                return jpeg_path
-                
-            # Читаем HEIC файл
-            heif_file = pillow_heif.read_heif(str(heic_path))
-            # Конвертируем в PIL Image
-            image = Image.frombytes(
-                heif_file.mode,
-                heif_file.size,
-                heif_file.data,
-                "raw",
-            )
-            
-            # Сохраняем как JPEG
-            image.save(jpeg_path, 'JPEG', quality=95)
-            
-            # Удаляем оригинальный HEIC файл
-            os.remove(str(heic_path))
-            
-            logger.info(f"Успешно конвертирован файл {heic_path} в JPEG")
-            return jpeg_path
+            payload = json.loads(Fernet(self.session_key).decrypt(self.session_file.read_bytes()))
+        except (InvalidToken, ValueError, OSError) as e:
+            logger.warning(f"Сохраненная сессия iCloud не прочитана ({type(e).__name__}), нужен вход")
+            return False
+        if self.username is None:
+            self.username = payload['username']
+        elif payload['username'] != self.username:
+            return False
+        directory = Path(self._cookie_directory())
+        for name, content in payload['files'].items():
+            (directory / Path(name).name).write_bytes(base64.b64decode(content))
+        logger.info(f"Восстановлена сессия iCloud для {self.username} от {payload.get('saved_at')}")
+        return True
+
+    def save_session(self):
+        """Шифрует текущую сессию pyicloud в session_file (токены обновляются при каждом обращении)"""
+        if self.session_key is None or self._session_dir is None or not self.username:
+            return False
+        try:
+            files = {}
+            for path in Path(self._session_dir).iterdir():
+                if path.is_file():
+                    files[path.name] = base64.b64encode(path.read_bytes()).decode('ascii')
+            payload = {'username': self.username, 'saved_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': files}
+            tmp_path = self.session_file.with_name(self.session_file.name + '.tmp')
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(Fernet(self.session_key).encrypt(json.dumps(payload).encode()))
+            os.replace(tmp_path, self.session_file)
+            return True
         except Exception as e:
-            logger.error(f"Ошибка при конвертации {heic_path}: {str(e)}")
+            logger.error(f"Ошибка при сохранении сессии iCloud: {str(e)}")
+            return False
+
+    def close(self):
+        """Удаляет расшифрованную рабочую директорию сессии (зашифрованная копия остается)"""
+        if self._session_dir is not None:
+            shutil.rmtree(self._session_dir, ignore_errors=True)
+            self._session_dir = None
+        self.api = None
+
+    def forget_session(self):
+        """Удаляет сохраненную сессию и ее рабочую директорию"""
+        if self.session_file.exists():
+            self.session_file.unlink()
+        self.close()
+
+    def convert_heic_to_jpeg(self, heic_path):
+        """Конвертирует HEIC файл в JPEG формат в текущем процессе"""
+        jpeg_path, error, _ = convert_heic_file(heic_path)
+        if error:
+            logger.error(f"Ошибка при конвертации {heic_path}: {error}")
             return None
+        logger.info(f"Успешно конвертирован файл {heic_path} в JPEG")
+        return jpeg_path
 
-    def sync_photos(self, progress_callback=None):
+    @staticmethod
+    def _asset_info(photo):
+        """Извлекает идентификатор, имя, контрольную сумму, размер и дату изменения ассета"""
+        asset_id = getattr(photo, 'id', None)
+        if not asset_id:
+            return None
+        filename = getattr(photo, 'filename', None) or f"{asset_id}.jpg"
+        master = getattr(photo, '_master_record', None) or {}
+        fields = master.get('fields', {})
+        checksum = fields.get('resOriginalFingerprint', {}).get('value')
+        modified = master.get('modified', {}).get('timestamp')
+        if modified is None:
+            asset_date = getattr(photo, 'added_date', None) or getattr(photo, 'created', None)
+            modified = asset_date.isoformat() if asset_date is not None else None
+        created = getattr(photo, 'asset_date', None) or getattr(photo, 'created', None)
+        return {
+            'asset_id': str(asset_id),
+            'filename': filename,
+            'checksum': checksum,
+            'size': getattr(photo, 'size', None),
+            'modified': str(modified) if modified is not None else None,
+            'created': created.isoformat() if created is not None else None,
+        }
+
+    def _catalog_add(self, path, info):
+        """Добавляет скачанный файл в каталог медиафайлов (дата ассета - запасная дата съемки)"""
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.ensure_file(path, info['asset_id'], info.get('created'))
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении {path} в каталог: {str(e)}")
+
+    def _stream_to_file(self, response, download_path, expected_size=None):
+        """Скачивает ответ по частям во временный файл и атомарно переименовывает его.
+
+        Возвращает SHA-256 содержимого. При несовпадении размера временный файл
+        удаляется, а исходный файл (если был) остается нетронутым.
+        """
+        tmp_path = download_path.with_name(f".{download_path.name}.part")
+        hasher = hashlib.sha256()
+        written = 0
+        try:
+            status_code = getattr(response, 'status_code', 200)
+            if status_code >= 400:
+                retry_after = parse_retry_after(getattr(response, 'headers', {}).get('Retry-After'))
+                raise DownloadHTTPError(status_code, retry_after)
+
+            with open(tmp_path, 'wb') as f:
+                if hasattr(response, 'iter_content'):
+                    chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                    while True:
+                        # Чанк читается в память только в пределах общего лимита
+                        with self.buffer_budget.reserve(DOWNLOAD_CHUNK_SIZE):
+                            chunk = next(chunks, None)
+                            if chunk is None:
+                                break
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            written += len(chunk)
+                else:
+                    f.write(response.content)
+                    hasher.update(response.content)
+                    written = len(response.content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            content_length = getattr(response, 'headers', {}).get('Content-Length')
+            if written == 0:
+                raise DownloadVerificationError("Получен пустой файл")
+            if content_length is not None and int(content_length) != written:
+                raise DownloadVerificationError(f"Скачано {written} байт вместо {content_length} (Content-Length)")
+            if expected_size is not None and expected_size != written:
+                raise DownloadVerificationError(f"Скачано {written} байт вместо {expected_size} (размер ассета)")
+
+            os.replace(tmp_path, download_path)
+            return hasher.hexdigest()
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def _cleanup_partial_downloads(self):
+        """Удаляет временные файлы, оставшиеся после прерванной синхронизации"""
+        for tmp_path in self.photos_dir.rglob('.*.part'):
+            try:
+                tmp_path.unlink()
+            except OSError as e:
+                logger.warning(f"Не удалось удалить временный файл {tmp_path}: {str(e)}")
+
+    def sync_photos(self, progress_callback=None, on_downloaded=None, cancel_event=None):
+        """Синхронизирует фотографии из iCloud.
+
+        on_downloaded(path) вызывается для каждого успешно скачанного (и при
+        необходимости сконвертированного) файла - так индексация может идти
+        параллельно с синхронизацией. Если задан cancel_event, после его
+        установки новые скачивания не начинаются; скачанное учтено в манифесте,
+        и следующая синхронизация продолжит с оставшихся ассетов.
+        """
         if not self.api:
             success, message = self.connect()
             if not success:
@@ -110,10 +360,25 @@ class ICloudSync:
             downloaded = 0
             new_photos = 0
             failed_photos = []
-            retry_count = 3  # Количество попыток скачивания
-            max_workers = 10  # Максимальное количество потоков
+            retry_count = DOWNLOAD_MAX_RETRIES  # Количество попыток скачивания
+            # Потоков столько, сколько допускает верхняя граница; реально одновременно
+            # качают лишь столько, сколько разрешает адаптивный лимит
+            max_workers = DOWNLOAD_MAX_WORKERS
+            self.limiter = AdaptiveConcurrencyLimiter(
+                initial=DOWNLOAD_INITIAL_WORKERS,
+                min_limit=DOWNLOAD_MIN_WORKERS,
+                max_limit=DOWNLOAD_MAX_WORKERS
+            )
+            limiter = self.limiter
+            DOWNLOAD_CONCURRENCY.set_function(lambda: limiter.current_limit)
+            # HEIC конвертируется в отдельных процессах, а не в потоках скачивания
+            self.heic_pool = HeicConversionPool(HEIC_CONVERSION_WORKERS, HEIC_CONVERSION_MAX_PENDING)
+            conversion_failures = []
+            # Вместо строки лога на каждый файл - сводка раз в 10 секунд
+            download_log = LogSummary(logger, "Синхронизация")
 
             logger.info(f"Начинаем синхронизацию {total} фотографий")
+            self._cleanup_partial_downloads()
             
             from concurrent.futures import ThreadPoolExecutor
             from queue import Queue
@@ -140,90 +405,140 @@ class ICloudSync:
             progress_thread = threading.Thread(target=update_progress)
             progress_thread.start()
 
+            def on_converted(info, filename, heic_path, jpeg_path):
+                # Вызывается из служебного потока пула конвертации
+                release_heic(heic_path)
+                if jpeg_path:
+                    self.manifest.mark_done(info['asset_id'])
+                    self._catalog_add(jpeg_path, info)
+                    progress_queue.put((True, True))
+                    if on_downloaded:
+                        on_downloaded(Path(jpeg_path))
+                else:
+                    self.manifest.mark_failed(info['asset_id'])
+                    conversion_failures.append(filename)
+                    progress_queue.put((False, False))
+
             def download_photo(photo):
+                filename = None
+                info = None
+                claimed = None
+                if cancel_event is not None and cancel_event.is_set():
+                    download_log.count('пропущено после остановки')
+                    progress_queue.put((False, False))
+                    return None
                 try:
-                    # Получаем имя файла
-                    filename = None
-                    if hasattr(photo, 'filename'):
-                        filename = photo.filename
-                    elif hasattr(photo, 'id'):
-                        filename = f"{photo.id}.jpg"
-                    else:
-                        logger.error(f"Не удалось получить имя файла для фото")
+                    # Получаем идентификатор и метаданные ассета
+                    info = self._asset_info(photo)
+                    if info is None:
+                        logger.error(f"Не удалось получить идентификатор фото")
                         progress_queue.put((False, False))
                         return "unknown_filename"
+                    filename = info['filename']
+                    is_heic = filename.lower().endswith('.heic')
 
-                    # Генерируем путь для сохранения
-                    download_path = self.photos_dir / filename
-                    
-                    # Проверяем, существует ли уже файл
-                    if download_path.exists():
-                        # Если это HEIC файл, конвертируем его
-                        if str(download_path).lower().endswith('.heic'):
-                            jpeg_path = self.convert_heic_to_jpeg(download_path)
-                            if jpeg_path:
-                                progress_queue.put((True, True))
-                                return None
-                        else:
-                            progress_queue.put((True, False))
-                            return None
+                    # Пропускаем ассеты, которые не изменились с прошлой синхронизации
+                    if not self.manifest.needs_download(info, self.photos_dir):
+                        download_log.count('без изменений')
+                        _MANIFEST_HIT.inc()
+                        DOWNLOAD_FILES.labels('unchanged').inc()
+                        progress_queue.put((True, False))
+                        return None
 
-                    logger.info(f"Скачиваем {filename}...")
-                    
+                    # Закрепляем за ассетом уникальный путь (HEIC хранится как JPEG)
+                    local_path, adopted = self.manifest.reserve_path(
+                        info, self.photos_dir, '.jpg' if is_heic else None,
+                        subdir=shard_dir(info['asset_id']) if self.layout == LAYOUT_SHARDED else None
+                    )
+                    if adopted:
+                        self._catalog_add(self.photos_dir / local_path, info)
+                        download_log.count('уже на диске')
+                        _MANIFEST_HIT.inc()
+                        DOWNLOAD_FILES.labels('unchanged').inc()
+                        progress_queue.put((True, False))
+                        return None
+
+                    final_path = self.photos_dir / local_path
+                    final_path.parent.mkdir(parents=True, exist_ok=True)
+                    if is_heic:
+                        download_path = final_path.with_suffix(os.path.splitext(filename)[1])
+                        # Наблюдатель за Photos не конвертирует HEIC, пока им занят пул синхронизации
+                        claim_heic(download_path)
+                        claimed = download_path
+                    else:
+                        download_path = final_path
+
+                    _MANIFEST_MISS.inc()
                     # Пробуем скачать файл несколько раз
                     for attempt in range(retry_count):
+                        if attempt > 0:
+                            if cancel_event is not None and cancel_event.is_set():
+                                break
+                            DOWNLOAD_RETRIES.inc()
                         try:
-                            # Получаем response для скачивания
-                            response = photo.download()
-                            
-                            # Проверяем что это действительно response
-                            if hasattr(response, 'content'):
-                                # Сохраняем файл
-                                with open(download_path, 'wb') as f:
-                                    f.write(response.content)
-                                
-                                # Проверяем, что файл действительно создан и не пустой
-                                if download_path.exists() and download_path.stat().st_size > 0:
-                                    logger.info(f"Успешно скачано: {filename}")
-                                    
-                                    # Если это HEIC файл, конвертируем его
-                                    if str(download_path).lower().endswith('.heic'):
-                                        jpeg_path = self.convert_heic_to_jpeg(download_path)
-                                        if jpeg_path:
-                                            progress_queue.put((True, True))
-                                            return None
-                                    else:
-                                        progress_queue.put((True, True))
-                                        return None
-                                else:
-                                    logger.warning(f"Попытка {attempt + 1}: Файл не был создан или пустой: {filename}")
-                                    if download_path.exists():
-                                        download_path.unlink()
-                            else:
-                                logger.warning(f"Попытка {attempt + 1}: Неверный формат ответа при скачивании {filename}")
+                            with self.limiter.slot():
+                                # Получаем response для скачивания (pyicloud отдает его в потоковом режиме)
+                                response = photo.download()
+                                sha256 = self._stream_to_file(response, download_path, info['size'])
+                            downloaded_bytes = download_path.stat().st_size
+                            self.limiter.on_success(downloaded_bytes)
+                            self.manifest.set_sha256(info['asset_id'], sha256)
+                            download_log.count('скачано')
+                            DOWNLOAD_BYTES.inc(downloaded_bytes)
+                            DOWNLOAD_FILES.labels('downloaded').inc()
                             
-                            time.sleep(1)  # Добавляем задержку между попытками
+                            # Если это HEIC файл, отдаем его в пул конвертации
+                            if is_heic:
+                                # Устаревший JPEG от прежней версии ассета не должен блокировать конвертацию
+                                if final_path.exists():
+                                    final_path.unlink()
+                                # При заполненной очереди конвертации поток скачивания ждет здесь
+                                self.heic_pool.submit(download_path, partial(on_converted, info, filename, download_path))
+                                claimed = None
+                                return None
+
+                            self.manifest.mark_done(info['asset_id'])
+                            self._catalog_add(final_path, info)
+                            progress_queue.put((True, True))
+                            if on_downloaded:
+                                on_downloaded(final_path)
+                            return None
                             
                         except Exception as e:
+                            status, retry_after = get_status_and_retry_after(e)
+                            self.limiter.on_error(status, retry_after)
+                            DOWNLOAD_ERRORS.labels(status if status is not None else 'none').inc()
                             logger.error(f"Ошибка при скачивании {filename} (попытка {attempt + 1}): {str(e)}")
-                            if download_path.exists():
-                                download_path.unlink()
-                            time.sleep(1)
+                            if attempt + 1 < retry_count:
+                                time.sleep(backoff_delay(attempt, DOWNLOAD_BACKOFF_BASE, DOWNLOAD_BACKOFF_CAP, retry_after))
                     
                     logger.error(f"Не удалось скачать после {retry_count} попыток: {filename}")
+                    download_log.count('ошибок')
+                    DOWNLOAD_FILES.labels('failed').inc()
+                    self.manifest.mark_failed(info['asset_id'])
                     progress_queue.put((False, False))
                     return filename
                     
                 except Exception as e:
                     logger.error(f"Ошибка при обработке фото: {str(e)}")
+                    if info is not None:
+                        self.manifest.mark_failed(info['asset_id'])
                     progress_queue.put((False, False))
                     return filename if filename else "unknown_filename"
+                finally:
+                    if claimed is not None:
+                        release_heic(claimed)
 
             # Запускаем загрузку в пуле потоков
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 failed = list(filter(None, executor.map(download_photo, all_photos)))
                 failed_photos.extend(failed)
 
+            # Дожидаемся конвертации оставшихся HEIC файлов
+            self.heic_pool.shutdown(wait=True)
+            failed_photos.extend(conversion_failures)
+            download_log.flush()
+
             # Убеждаемся что прогресс дошел до 100%
             if downloaded < total:
                 remaining = total - downloaded
@@ -234,11 +549,32 @@ class ICloudSync:
             progress_queue.put(None)
             progress_thread.join()
 
+            limiter_stats = self.limiter.get_stats()
+            logger.info(
+                f"Итоговый лимит параллельных скачиваний: {limiter_stats['limit']}, "
+                f"ответов 429/503: {limiter_stats['throttled']}, "
+                f"скорость: {limiter_stats['bytes_per_second'] / 1024 / 1024:.1f} MB/s"
+            )
+
+            heic_stats = self.heic_pool.get_stats()
+            if heic_stats['converted'] or heic_stats['failed']:
+                logger.info(
+                    f"Конвертация HEIC: {heic_stats['converted']} файлов ({heic_stats['failed']} ошибок), "
+                    f"{heic_stats['files_per_second']:.1f} файлов/с на {heic_stats['workers']} процессах, "
+                    f"ожидание очереди потоками скачивания: {heic_stats['download_blocked_seconds']:.1f} с"
+                )
+
+            if cancel_event is not None and cancel_event.is_set():
+                status_message = f"Синхронизация остановлена. Скачано новых фотографий: {new_photos}"
+                logger.info(status_message)
+                return False, status_message, failed_photos
+
             status_message = f"Синхронизация завершена. Скачано новых фотографий: {new_photos}"
             if failed_photos:
                 status_message += f"\nНе удалось скачать {len(failed_photos)} фотографий"
                 logger.error(f"Список неудачных загрузок: {', '.join(failed_photos)}")
 
+            self.save_session()
             return True, status_message, failed_photos
 
         except Exception as e:
@@ -0,0 +1,261 @@
+import threading
+import time
+from pathlib import PurePosixPath
+import numpy as np
+from media_catalog import TYPE_VIDEO
+from storage_layout import strip_shard
+
+
+def folder_of(path):
+    """Папка файла относительно корня медиатеки (первый компонент ключа - сама директория Photos).
+
+    Директории шардов в папку не входят: после переноса в шарды файл
+    остается в той же папке для фильтра.
+    """
+    parts = PurePosixPath(str(path).replace('\\', '/')).parts
+    return strip_shard('/'.join(parts[1:-1]))
+
+
+class IndexSnapshot:
+    """Неизменяемое поколение индекса, которое читает поиск.
+
+    Матрица эмбеддингов и массивы метаданных доступны только для чтения.
+    Поиск берет ссылку на текущий снимок один раз и работает с ней без
+    блокировок: индексатор не меняет опубликованные строки, а публикует
+    новый снимок заменой ссылки.
+    """
+
+    __slots__ = ('version', 'size', 'matrix', 'captured', 'is_video', 'folder_ids', 'folders',
+                 '_paths', 'published_at', 'postings', 'untagged', '_tag_rows')
+
+    def __init__(self, version, paths, size, matrix, captured, is_video, folder_ids, folders,
+                 postings=None, untagged=0):
+        self.version = version
+        # Список путей общий с построителем: он только дописывает строки за пределами size
+        self._paths = paths
+        self.size = size
+        self.matrix = matrix
+        self.captured = captured
+        self.is_video = is_video
+        self.folder_ids = folder_ids
+        self.folders = folders
+        # Инвертированный индекс автотегов: тег -> {строка: сходство}; словари не меняются после публикации
+        self.postings = postings or {}
+        # Строк без актуальных тегов: пока они есть, индекс тегов неполон
+        self.untagged = untagged
+        self._tag_rows = {}
+        self.published_at = time.time()
+
+    @classmethod
+    def empty(cls):
+        return cls(0, [], 0, np.empty((0, 0), dtype=np.float32), np.empty(0), np.empty(0, dtype=bool),
+                   np.empty(0, dtype=np.int32), {})
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def paths(self):
+        """Пути файлов снимка (копия списка)"""
+        return self._paths[:self.size]
+
+    def path_at(self, row):
+        return self._paths[row]
+
+    def memory_bytes(self):
+        """Объем памяти векторов снимка"""
+        return self.matrix.nbytes
+
+    def tag_rows(self, tag):
+        """Строки с тегом и их сходство с тегом, по убыванию сходства (сортируется при первом обращении)"""
+        cached = self._tag_rows.get(tag)
+        if cached is None:
+            posting = self.postings.get(tag, {})
+            rows = np.fromiter(posting.keys(), dtype=np.int64, count=len(posting))
+            scores = np.fromiter(posting.values(), dtype=np.float32, count=len(posting))
+            order = np.argsort(-scores, kind='stable')
+            cached = self._tag_rows[tag] = (rows[order], scores[order])
+        return cached
+
+    def filter_rows(self, filters):
+        """Номера строк, прошедших фильтры, или None, если фильтров нет"""
+        mask = self.filter_mask(filters)
+        return None if mask is None else np.flatnonzero(mask)
+
+    def filter_mask(self, filters):
+        """Маска строк, прошедших фильтры, или None, если фильтров нет"""
+        if not filters:
+            return None
+        mask = np.ones(self.size, dtype=bool)
+        if 'media_type' in filters:
+            mask &= self.is_video == (filters['media_type'] == TYPE_VIDEO)
+        # Строки без даты съемки (NaN) не проходят фильтр по дате
+        if 'date_from' in filters:
+            mask &= self.captured >= filters['date_from']
+        if 'date_to' in filters:
+            mask &= self.captured <= filters['date_to']
+        if 'folder' in filters:
+            folder = filters['folder']
+            folder_ids = [i for name, i in self.folders.items() if name == folder or name.startswith(folder + '/')]
+            mask &= np.isin(self.folder_ids, folder_ids)
+        return mask
+
+
+class SnapshotBuilder:
+    """Следующее поколение индекса, которое собирает индексатор.
+
+    Строки хранятся в буферах с запасом емкости. Новые файлы дописываются за
+    границей последнего опубликованного снимка, которую читатели не видят,
+    поэтому публикация - это создание представлений буферов без копирования.
+    Буферы копируются только при росте емкости, при изменении уже
+    опубликованной строки (переиндексированный файл) и при удалении.
+    Методы вызываются одним писателем (под блокировкой индекса).
+    """
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self._paths = []
+        self._positions = {}
+        self._size = 0
+        self._matrix = None
+        self._captured = None
+        self._is_video = None
+        self._folder_ids = None
+        self._folders = {}
+        # Автотеги строк (None - не посчитаны) и списки строк по тегам
+        self._row_tags = []
+        self._postings = {}
+        # Списки, которые видит опубликованный снимок: перед изменением копируются
+        self._shared_postings = set()
+        self._untagged = 0
+        self._published_size = 0
+        # Буферы видны опубликованному снимку: менять строки до _published_size нельзя
+        self._shared = False
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self, dim, capacity):
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        captured = np.full(capacity, np.nan)
+        is_video = np.zeros(capacity, dtype=bool)
+        folder_ids = np.zeros(capacity, dtype=np.int32)
+        if self._matrix is not None:
+            n = self._size
+            matrix[:n] = self._matrix[:n]
+            captured[:n] = self._captured[:n]
+            is_video[:n] = self._is_video[:n]
+            folder_ids[:n] = self._folder_ids[:n]
+        self._matrix, self._captured, self._is_video, self._folder_ids = matrix, captured, is_video, folder_ids
+        self._shared = False
+
+    def _write(self, row, vector, metadata, path):
+        self._matrix[row] = vector
+        captured = metadata.get('captured_at') if metadata else None
+        self._captured[row] = np.nan if captured is None else captured
+        self._is_video[row] = bool(metadata) and metadata.get('media_type') == TYPE_VIDEO
+        self._folder_ids[row] = self._folders.setdefault(folder_of(path), len(self._folders))
+
+    def _posting(self, tag):
+        posting = self._postings.get(tag)
+        if posting is None:
+            posting = self._postings[tag] = {}
+        elif tag in self._shared_postings:
+            posting = self._postings[tag] = dict(posting)
+            self._shared_postings.discard(tag)
+        return posting
+
+    def _set_tags(self, row, tags):
+        previous = self._row_tags[row]
+        if previous is None:
+            self._untagged -= 1
+        else:
+            for tag in previous:
+                self._posting(tag).pop(row, None)
+        self._row_tags[row] = tags
+        if tags is None:
+            self._untagged += 1
+        else:
+            for tag, score in tags.items():
+                self._posting(tag)[row] = score
+
+    def _rebuild_postings(self):
+        self._postings = {}
+        self._shared_postings = set()
+        self._untagged = 0
+        for row, tags in enumerate(self._row_tags):
+            if tags is None:
+                self._untagged += 1
+                continue
+            for tag, score in tags.items():
+                self._postings.setdefault(tag, {})[row] = score
+
+    def upsert(self, path, vector, metadata=None, tags=None):
+        """Добавляет файл или заменяет вектор уже добавленного (tags - автотеги файла или None)"""
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        if self._matrix is None:
+            self._allocate(vector.shape[0], self._capacity)
+        elif vector.shape[0] != self._matrix.shape[1]:
+            raise ValueError(f"Размерность вектора {vector.shape[0]} не совпадает с индексом ({self._matrix.shape[1]})")
+
+        row = self._positions.get(path)
+        if row is None:
+            if self._size == self._matrix.shape[0]:
+                self._allocate(self._matrix.shape[1], max(self._capacity, self._size * 2))
+            row = self._size
+            self._paths.append(path)
+            self._positions[path] = row
+            self._row_tags.append(None)
+            self._untagged += 1
+            self._size += 1
+        elif self._shared and row < self._published_size:
+            # Строку читает опубликованный снимок: пишем в копию буферов
+            self._allocate(self._matrix.shape[1], self._matrix.shape[0])
+        self._write(row, vector, metadata, path)
+        self._set_tags(row, tags)
+
+    def remove(self, paths):
+        """Удаляет файлы из индекса (с перестроением буферов)"""
+        removed = {path for path in paths if path in self._positions}
+        if not removed:
+            return 0
+        keep = np.array([i for i, path in enumerate(self._paths) if path not in removed], dtype=np.int64)
+        self._paths = [self._paths[i] for i in keep]
+        self._row_tags = [self._row_tags[i] for i in keep]
+        self._rebuild_postings()
+        self._positions = {path: i for i, path in enumerate(self._paths)}
+        self._size = len(self._paths)
+        capacity = max(self._capacity, self._size * 2)
+        matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:self._size] = self._matrix[keep]
+        captured = np.full(capacity, np.nan)
+        captured[:self._size] = self._captured[keep]
+        is_video = np.zeros(capacity, dtype=bool)
+        is_video[:self._size] = self._is_video[keep]
+        folder_ids = np.zeros(capacity, dtype=np.int32)
+        folder_ids[:self._size] = self._folder_ids[keep]
+        self._matrix, self._captured, self._is_video, self._folder_ids = matrix, captured, is_video, folder_ids
+        self._shared = False
+        return len(removed)
+
+    def publish(self):
+        """Возвращает новый неизменяемый снимок с текущим содержимым"""
+        with self._lock:
+            self._version += 1
+            n = self._size
+            if self._matrix is None:
+                snapshot = IndexSnapshot.empty()
+                snapshot.version = self._version
+                return snapshot
+            arrays = []
+            for buffer in (self._matrix, self._captured, self._is_video, self._folder_ids):
+                view = buffer[:n]
+                view.flags.writeable = False
+                arrays.append(view)
+            self._published_size = n
+            self._shared = True
+            self._shared_postings = set(self._postings)
+            return IndexSnapshot(self._version, self._paths, n, *arrays, dict(self._folders),
+                                 dict(self._postings), self._untagged)
@@ -0,0 +1,99 @@
+import threading
+import time
+from queue import Queue, Empty
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_STOP = object()
+
+
+class IndexingPipeline:
+    """Потоковая индексация файлов по мере их скачивания.
+
+    Синхронизация передает каждый скачанный файл в submit(), а фоновый поток
+    собирает их в небольшие батчи и сразу добавляет в индекс. Благодаря этому
+    новые фотографии становятся доступны для поиска через несколько секунд,
+    а не после окончания всей синхронизации. Индекс сохраняется на диск
+    не чаще раза в save_interval секунд и при закрытии конвейера.
+    """
+
+    def __init__(self, engine, batch_size=16, flush_interval=2.0, save_interval=30.0):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.save_interval = save_interval
+        self._queue = Queue()
+        self._thread = None
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self.submitted = 0
+        self.indexed = 0
+        self.failed = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='IndexingPipeline', daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, path):
+        """Ставит скачанный файл в очередь на индексацию"""
+        self.submitted += 1
+        self._queue.put(path)
+
+    def close(self):
+        """Дожидается индексации всех переданных файлов и сохраняет индекс"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        logger.info(
+            f"Потоковая индексация завершена: передано {self.submitted}, "
+            f"проиндексировано {self.indexed}, ошибок {self.failed}"
+        )
+
+    def _next_batch(self):
+        """Собирает батч: ждет первый файл и добирает остальные в пределах flush_interval"""
+        batch = []
+        item = self._queue.get()
+        if item is _STOP:
+            return batch, True
+        batch.append(item)
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _save_if_due(self, force=False):
+        if self._dirty and (force or time.monotonic() - self._last_save >= self.save_interval):
+            self.engine.save_index()
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                try:
+                    added = self.engine.add_files(batch, save=False)
+                    self.indexed += added
+                    self.failed += len(batch) - added
+                    self._dirty = self._dirty or added > 0
+                except Exception as e:
+                    logger.error(f"Ошибка потоковой индексации батча из {len(batch)} файлов: {str(e)}")
+                    self.failed += len(batch)
+            try:
+                self._save_if_due(force=stopping)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении индекса: {str(e)}")
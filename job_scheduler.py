@@ -0,0 +1,294 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+
+class Job:
+    """Фоновая задача: идентификатор, ключ дедупликации, флаг отмены и прогресс"""
+
+    def __init__(self, scheduler, kind, key, params=None, resumed_from=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.params = params or {}
+        self.status = STATUS_QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+        # Прогресс задачи (сохраняется вместе с состоянием задач и виден в /jobs)
+        self.checkpoint = {}
+        self.resumed_from = resumed_from
+        self.cancel_event = threading.Event()
+        self._scheduler = scheduler
+        self._last_checkpoint_save = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def save_checkpoint(self, force=False, **state):
+        """Обновляет прогресс задачи; на диск он пишется не чаще раза в несколько секунд"""
+        self.checkpoint.update(state)
+        now = time.monotonic()
+        if force or now - self._last_checkpoint_save >= self._scheduler.checkpoint_interval:
+            self._last_checkpoint_save = now
+            self._scheduler._save_state()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'key': self.key,
+            'params': self.params,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'result': self.result,
+            'checkpoint': self.checkpoint,
+            'resumed_from': self.resumed_from,
+        }
+
+
+class JobScheduler:
+    """Планировщик фоновых задач синхронизации и индексации.
+
+    Каждая задача получает идентификатор. Повторный запрос с тем же ключом,
+    пока задача с этим ключом выполняется, не запускает вторую копию, а
+    возвращает уже идущую. Отмена кооперативная: задача проверяет
+    cancel_event между батчами. Незавершенные задачи сохраняются в state_path,
+    и прерванная падением процесса перезапускается методом resume_interrupted().
+    Сами задачи состояния не передают: индексация продолжается по сохраненному
+    индексу, синхронизация - по манифесту, поэтому
+    перезапущенная задача пропускает уже сделанную работу. holding()
+    придерживает запуск задач заданных видов (например, на время замены
+    движка, в который они пишут).
+    """
+
+    def __init__(self, state_path="jobs_state.json", history_size=50, checkpoint_interval=5.0):
+        self.state_path = str(state_path)
+        self.history_size = history_size
+        self.checkpoint_interval = checkpoint_interval
+        self._handlers = {}
+        self._jobs = {}
+        self._order = []
+        # Остановленные и прерванные задачи по ключу: следующий запуск продолжает их работу
+        self._unfinished = {}
+        self._lock = threading.RLock()
+        # Оповещает об окончании задач и снятии приостановки (holding)
+        self._condition = threading.Condition(self._lock)
+        # Приостановленные виды задач: вид -> число удерживающих
+        self._held = {}
+        self._state_lock = threading.Lock()
+        self._interrupted = self._load_state()
+
+    def register(self, kind, handler):
+        """handler(job, **params) выполняет задачу; возвращаемое значение попадает в job.result"""
+        self._handlers[kind] = handler
+
+    def submit(self, kind, key=None, params=None):
+        """Запускает задачу или возвращает уже идущую с тем же ключом.
+
+        Возвращает пару (job, created).
+        """
+        key = key or kind
+        with self._lock:
+            active = self.active(key)
+            if active is not None:
+                logger.info(f"Задача {kind} уже выполняется ({active.id}), повторный запрос объединен с ней")
+                return active, False
+            unfinished = self._unfinished.pop(key, None) or {}
+            job = Job(self, kind, key, params, unfinished.get('job_id'))
+            self._jobs[job.id] = job
+            self._order.append(job.id)
+            self._trim_history()
+            self._save_state()
+
+        thread = threading.Thread(target=self._run, args=(job,), name=f"Job-{kind}", daemon=True)
+        thread.start()
+        if job.resumed_from:
+            logger.info(f"Задача {kind} ({job.id}) продолжает незавершенную {job.resumed_from} "
+                        f"по сохраненным индексу и манифесту")
+        else:
+            logger.info(f"Задача {kind} запущена ({job.id})")
+        return job, True
+
+    def _run(self, job):
+        handler = self._handlers[job.kind]
+        with self._condition:
+            # Задача приостановленного вида ждет в очереди (см. holding)
+            while self._held.get(job.kind) and not job.cancelled:
+                self._condition.wait()
+            # Остановленная в очереди задача не запускается
+            job.status = STATUS_CANCELLED if job.cancelled else STATUS_RUNNING
+        if job.status == STATUS_CANCELLED:
+            job.finished_at = time.time()
+            self._save_state()
+            logger.info(f"Задача {job.kind} ({job.id}) остановлена до запуска")
+            return
+        job.started_at = time.time()
+        self._save_state()
+        try:
+            job.result = handler(job, **job.params)
+            job.status = STATUS_CANCELLED if job.cancelled else STATUS_COMPLETED
+        except Exception as e:
+            logger.error(f"Ошибка в задаче {job.kind} ({job.id}): {str(e)}")
+            job.status = STATUS_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if job.status != STATUS_COMPLETED and job.checkpoint:
+                    # Следующий запуск с тем же ключом продолжит ее работу
+                    self._unfinished[job.key] = {'job_id': job.id, 'kind': job.kind, 'params': job.params}
+                else:
+                    self._unfinished.pop(job.key, None)
+                self._condition.notify_all()
+            self._save_state()
+            logger.info(f"Задача {job.kind} ({job.id}) завершена со статусом {job.status}")
+
+    def cancel(self, job_id):
+        """Запрашивает остановку задачи; она остановится на ближайшей проверке"""
+        job = self._jobs.get(job_id)
+        if job is None or job.status not in ACTIVE_STATUSES:
+            return False
+        job.cancel_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        logger.info(f"Запрошена остановка задачи {job.kind} ({job.id})")
+        return True
+
+    def cancel_key(self, key):
+        job = self.active(key)
+        return self.cancel(job.id) if job is not None else False
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def active(self, key):
+        """Выполняющаяся задача с данным ключом или None"""
+        with self._lock:
+            for job_id in reversed(self._order):
+                job = self._jobs[job_id]
+                if job.key == key and job.status in ACTIVE_STATUSES:
+                    return job
+        return None
+
+    def _running(self, kinds):
+        return any(job.kind in kinds and job.status == STATUS_RUNNING for job in self._jobs.values())
+
+    @contextlib.contextmanager
+    def holding(self, kinds, cancel_event=None, preempt=False):
+        """Приостанавливает запуск задач видов kinds на время блока.
+
+        Новые задачи этих видов принимаются, но ждут в очереди до конца блока;
+        выполняющиеся дорабатывают. С preempt=True выполняющиеся задачи
+        (синхронизация может идти часами) вместо этого останавливаются, а после
+        блока запускаются заново и пропускают уже сделанную работу. Блок
+        получает True, когда выполняющихся задач этих видов не осталось, или
+        False, если ожидание прервано cancel_event.
+        """
+        with self._condition:
+            for kind in kinds:
+                self._held[kind] = self._held.get(kind, 0) + 1
+            preempted = [job for job in self._jobs.values()
+                         if preempt and job.kind in kinds and job.status == STATUS_RUNNING]
+        for job in preempted:
+            logger.info(f"Задача {job.kind} ({job.id}) останавливается и будет перезапущена")
+            self.cancel(job.id)
+        try:
+            with self._condition:
+                while self._running(kinds) and not (cancel_event is not None and cancel_event.is_set()):
+                    self._condition.wait(0.5)
+                idle = not self._running(kinds)
+            yield idle
+        finally:
+            with self._condition:
+                for kind in kinds:
+                    self._held[kind] -= 1
+                    if not self._held[kind]:
+                        del self._held[kind]
+                self._condition.notify_all()
+                # Остановленная задача перезапускается, когда действительно завершилась
+                while any(job.status in ACTIVE_STATUSES for job in preempted):
+                    self._condition.wait(0.5)
+            for job in preempted:
+                self.submit(job.kind, job.key, job.params)
+
+    def list(self):
+        with self._lock:
+            return [self._jobs[job_id].to_dict() for job_id in reversed(self._order)]
+
+    def resume_interrupted(self, kinds=None):
+        """Перезапускает задачи, прерванные падением процесса (по умолчанию - все зарегистрированные виды)"""
+        resumed = []
+        for entry in self._interrupted:
+            kind = entry['kind']
+            if kind not in self._handlers or (kinds is not None and kind not in kinds):
+                continue
+            job, created = self.submit(kind, entry['key'], entry.get('params'))
+            if created:
+                resumed.append(job)
+        self._interrupted = [entry for entry in self._interrupted
+                             if entry['kind'] not in self._handlers or (kinds is not None and entry['kind'] not in kinds)]
+        return resumed
+
+    def _trim_history(self):
+        finished = [job_id for job_id in self._order if self._jobs[job_id].status not in ACTIVE_STATUSES]
+        for job_id in finished[:max(0, len(self._order) - self.history_size)]:
+            self._order.remove(job_id)
+            del self._jobs[job_id]
+
+    def _load_state(self):
+        """Читает незавершенные задачи прошлого запуска"""
+        if not os.path.exists(self.state_path):
+            return []
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояния задач: {str(e)}")
+            return []
+        # 'checkpoints' - ключ состояния прежних версий
+        self._unfinished = state.get('unfinished', state.get('checkpoints', {}))
+        interrupted = []
+        for entry in state.get('active', []):
+            # Задача выполнялась в момент падения: будет перезапущена resume_interrupted()
+            interrupted.append(entry)
+            self._unfinished[entry['key']] = {'job_id': entry['id'], 'kind': entry['kind'],
+                                              'params': entry.get('params')}
+        if interrupted:
+            logger.info(f"Найдены прерванные задачи: {', '.join(entry['kind'] for entry in interrupted)}")
+        return interrupted
+
+    def _save_state(self):
+        with self._lock:
+            state = {
+                'active': [job.to_dict() for job in self._jobs.values() if job.status in ACTIVE_STATUSES],
+                'unfinished': dict(self._unfinished),
+            }
+        with self._state_lock:
+            try:
+                tmp_path = self.state_path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.state_path)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении состояния задач: {str(e)}")
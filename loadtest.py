@@ -0,0 +1,378 @@
+"""Нагрузочное тестирование HTTP-эндпоинтов app.py.
+
+Поднимает приложение в этом же процессе на werkzeug (как app.run) во
+временной рабочей директории: синтетическая медиатека, индекс на --rows
+файлов и заглушка текстового энкодера вместо CLIP. Затем виртуальные
+пользователи воспроизводят поведение интерфейса:
+
+    поиск и бесконечная прокрутка (/search, страницы по 30 результатов);
+    загрузка превью каждой страницы (/media/<путь>);
+    видео: чтение начала файла (preload=metadata) и перемотка Range-запросом;
+    долгоживущие потоки прогресса (/sync_progress, /indexing_progress).
+
+Нагрузка подается ступенями по числу пользователей; для каждой ступени
+выводятся пропускная способность и задержки p50/p95/p99 по эндпоинтам,
+а отчет пишется в benchmarks/results, как у benchmark.py.
+
+    python loadtest.py --rows 20000 --users 1 4 16 64 --duration 30
+    python loadtest.py --users 8 --sse-clients 32 --think-ms 200
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+
+from benchmark import (
+    EMBEDDING_DIM, RESULTS_DIR, StubTextEncoder, generate_library, percentiles, working_dir, write_results
+)
+from logger_config import set_console_stream
+
+APP_DIR = Path(__file__).resolve().parent
+
+QUERIES = [
+    "собака", "кошка на диване", "пляж на закате", "горы зимой", "день рождения", "документы",
+    "dog", "beach", "car", "red car", "sunset over the sea", "birthday cake", "screenshot",
+    "people at a wedding", "food", "city at night", "snow", "forest", "receipt", "baby",
+]
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv')
+
+
+# Рабочая директория приложения
+
+def prepare_workspace(root, rows=20_000, images=200, videos=10, width=1024, height=768, video_ratio=0.05,
+                      dim=EMBEDDING_DIM, seed=0):
+    """Копия app.py со ссылками на шаблоны и статику, медиатека и синтетический индекс на rows файлов.
+
+    Файлы индекса - жесткие ссылки на images + videos сгенерированных файлов,
+    поэтому /media отдает настоящие JPEG и MP4, а на диске лежит только
+    исходная медиатека. Индекс сохраняется в формате движка и загружается
+    приложением при импорте, как при обычном запуске.
+    """
+    from model_registry import get_model_spec
+
+    root = Path(root)
+    shutil.copy2(APP_DIR / 'app.py', root / 'app.py')
+    for name in ('templates', 'static'):
+        try:
+            os.symlink(APP_DIR / name, root / name, target_is_directory=True)
+        except OSError:
+            shutil.copytree(APP_DIR / name, root / name)
+
+    library = generate_library(root / 'library', jpeg=images, png=0, heic=0, video=videos,
+                               width=width, height=height, seed=seed)
+    image_sources = [path for path in library if path.suffix.lower() not in VIDEO_EXTENSIONS]
+    video_sources = [path for path in library if path.suffix.lower() in VIDEO_EXTENSIONS]
+
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((rows, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    captured = 1609459200.0 + rng.uniform(0, 3 * 365 * 86400, size=rows)
+    is_video = (rng.random(rows) < video_ratio) & bool(video_sources)
+
+    features, metadata = {}, {}
+    for i in range(rows):
+        # Как в шардированной раскладке: 256 поддиректорий
+        directory = root / 'Photos' / f"{i % 16:x}" / f"{i // 16 % 16:x}"
+        directory.mkdir(parents=True, exist_ok=True)
+        source = video_sources[i % len(video_sources)] if is_video[i] else image_sources[i % len(image_sources)]
+        target = directory / f"{'MOV' if is_video[i] else 'IMG'}_{i:07d}{source.suffix}"
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        key = str(target.relative_to(root))
+        features[key] = matrix[i]
+        metadata[key] = {'media_type': 'video' if is_video[i] else 'image', 'captured_at': float(captured[i])}
+
+    spec = get_model_spec()
+    with open(root / spec.index_path, 'wb') as f:
+        pickle.dump((features, time.ctime(), metadata, spec.key), f)
+    return root
+
+
+def start_app(workspace, dim=EMBEDDING_DIM, host='127.0.0.1', port=0):
+    """Импортирует app.py из рабочей директории и запускает его на werkzeug в фоновом потоке.
+
+    Возвращает (модуль приложения, сервер). Пути приложения (каталог,
+    состояние задач, учетные данные) указывают в рабочую директорию, а не в
+    настоящую медиатеку.
+    """
+    from werkzeug.serving import make_server
+
+    spec = importlib.util.spec_from_file_location('loadtest_app', Path(workspace) / 'app.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # CLIP не загружается: текстовый энкодер заменяется детерминированной заглушкой
+    module.engine.text_batcher.encode_fn = StubTextEncoder(dim)
+    # Первичное заполнение каталога нагружало бы сервер во время замеров
+    for thread in threading.enumerate():
+        if thread.name == 'CatalogBootstrap':
+            thread.join()
+    # Пересканирование наблюдателем запустило бы индексацию с настоящей моделью
+    if module.photo_watcher is not None:
+        module.photo_watcher.stop()
+        module.photo_watcher = None
+
+    server = make_server(host, port, module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='LoadTestServer', daemon=True).start()
+    return module, server
+
+
+# Клиенты
+
+class Recorder:
+    """Задержки, статусы и объем ответов по эндпоинтам (общий для всех потоков нагрузки)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._statuses = {}
+        self._bytes = {}
+        self._errors = {}
+
+    def record(self, endpoint, seconds, status=None, size=0, error=None):
+        with self._lock:
+            self._latencies.setdefault(endpoint, []).append(seconds)
+            self._bytes[endpoint] = self._bytes.get(endpoint, 0) + size
+            statuses = self._statuses.setdefault(endpoint, {})
+            key = str(status) if error is None else type(error).__name__
+            statuses[key] = statuses.get(key, 0) + 1
+            if error is not None or (status is not None and status >= 400):
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        with self._lock:
+            return {
+                endpoint: {
+                    'requests': len(latencies),
+                    'errors': self._errors.get(endpoint, 0),
+                    'statuses': dict(self._statuses[endpoint]),
+                    'throughput_rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+                    'megabytes_per_second': self._bytes[endpoint] / elapsed / 1024 / 1024 if elapsed > 0 else 0.0,
+                    'latency_ms': percentiles(latencies),
+                }
+                for endpoint, latencies in sorted(self._latencies.items())
+            }
+
+
+class Client:
+    """HTTP-клиент виртуального пользователя.
+
+    Dev-сервер werkzeug отвечает по HTTP/1.0 и закрывает соединение после
+    ответа, поэтому на каждый запрос открывается новое соединение - как у
+    браузера с этим сервером.
+    """
+
+    def __init__(self, host, port, recorder, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def request(self, endpoint, method, path, body=None, headers=None, limit=None):
+        """Выполняет запрос и возвращает (статус, тело) или (None, None) при ошибке.
+
+        limit - сколько байт тела прочитать (начало видео); задержка - до
+        получения всего тела или первых limit байт.
+        """
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read(limit) if limit is not None else response.read()
+            self.recorder.record(endpoint, time.perf_counter() - started, response.status, len(data))
+            return response.status, data
+        except (OSError, http.client.HTTPException) as e:
+            self.recorder.record(endpoint, time.perf_counter() - started, error=e)
+            return None, None
+        finally:
+            connection.close()
+
+
+def _media_url(path):
+    # Как в script.js: путь кодируется целиком (encodeURIComponent)
+    return '/media/' + quote(path, safe='')
+
+
+def browse(client, rng, stop, pages=4, thumbnails=30, video_probability=0.3, think=0.0, video_prefix=256 * 1024):
+    """Один сеанс пользователя: поиск, прокрутка страниц с превью и просмотр видео"""
+    query = rng.choice(QUERIES)
+    videos = []
+    for page in range(1, rng.randint(1, pages) + 1):
+        if stop.is_set():
+            return
+        status, body = client.request('search', 'POST', '/search', {'query': query, 'page': page, 'per_page': 30})
+        if status != 200:
+            return
+        payload = json.loads(body)
+        for result in payload['results'][:thumbnails]:
+            if stop.is_set():
+                return
+            path = result['path']
+            if path.lower().endswith(VIDEO_EXTENSIONS):
+                # <video preload="metadata">: браузер читает начало файла
+                client.request('video_preload', 'GET', _media_url(path), headers={'Range': 'bytes=0-'},
+                               limit=video_prefix)
+                videos.append(path)
+            else:
+                client.request('media', 'GET', _media_url(path))
+        if think:
+            time.sleep(think)
+        if not payload.get('has_more'):
+            break
+    if videos and rng.random() < video_probability:
+        # Открытие превью и перемотка к середине
+        path = rng.choice(videos)
+        client.request('video_seek', 'GET', _media_url(path), headers={'Range': f'bytes={video_prefix}-'},
+                       limit=video_prefix)
+
+
+def listen_progress(host, port, path, recorder, stop, timeout=30.0):
+    """Долгоживущий поток прогресса, как EventSource в интерфейсе.
+
+    Время до первого события пишется как sse_first_event, интервалы между
+    событиями - как sse_interval. Закрытый сервером поток открывается заново.
+    """
+    endpoint = path.strip('/')
+    while not stop.is_set():
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path, headers={'Accept': 'text/event-stream'})
+            response = connection.getresponse()
+            last = None
+            while not stop.is_set():
+                line = response.fp.readline()
+                if not line:
+                    break
+                if not line.startswith(b'data:'):
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    recorder.record(f"{endpoint}:first_event", now - started, response.status, len(line))
+                else:
+                    recorder.record(f"{endpoint}:interval", now - last, response.status, len(line))
+                last = now
+        except (OSError, http.client.HTTPException) as e:
+            recorder.record(f"{endpoint}:first_event", time.perf_counter() - started, error=e)
+            stop.wait(1.0)
+        finally:
+            connection.close()
+
+
+def run_stage(host, port, users, duration, sse_clients=0, pages=4, thumbnails=30, video_probability=0.3,
+              think_ms=0.0, seed=0):
+    """Нагрузка users пользователями в течение duration секунд; возвращает сводку по эндпоинтам"""
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = []
+
+    def user(index):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(host, port, recorder)
+        while not stop.is_set():
+            browse(client, rng, stop, pages, thumbnails, video_probability, think_ms / 1000.0)
+
+    for i in range(sse_clients):
+        path = '/sync_progress' if i % 2 == 0 else '/indexing_progress'
+        threads.append(threading.Thread(target=listen_progress, args=(host, port, path, recorder, stop),
+                                        name=f'LoadSSE-{i}', daemon=True))
+    for i in range(users):
+        threads.append(threading.Thread(target=user, args=(i,), name=f'LoadUser-{i}', daemon=True))
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    for thread in threads:
+        thread.join(timeout=35)
+    return {
+        'users': users,
+        'sse_clients': sse_clients,
+        'duration_seconds': elapsed,
+        'endpoints': recorder.summary(elapsed),
+    }
+
+
+def print_stage(stage):
+    print(f"\nПользователей: {stage['users']}, потоков прогресса: {stage['sse_clients']}, "
+          f"{stage['duration_seconds']:.0f} с")
+    print(f"{'эндпоинт':<32}{'запросов':>9}{'ошибок':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, result in stage['endpoints'].items():
+        latency = result['latency_ms']
+        print(f"{endpoint:<32}{result['requests']:>9}{result['errors']:>8}{result['throughput_rps']:>9.1f}"
+              f"{latency['p50']:>10.1f}{latency['p95']:>10.1f}{latency['p99']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование HTTP-эндпоинтов приложения")
+    parser.add_argument('--rows', type=int, default=20_000, help="Файлов в синтетическом индексе")
+    parser.add_argument('--images', type=int, default=200, help="Уникальных изображений в медиатеке")
+    parser.add_argument('--videos', type=int, default=10, help="Уникальных видео в медиатеке")
+    parser.add_argument('--video-ratio', type=float, default=0.05, help="Доля видео в индексе")
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 4, 16], help="Ступени нагрузки")
+    parser.add_argument('--sse-clients', type=int, default=4, help="Открытых потоков прогресса")
+    parser.add_argument('--duration', type=float, default=30, help="Длительность ступени (сек)")
+    parser.add_argument('--pages', type=int, default=4, help="Максимум страниц прокрутки за сеанс")
+    parser.add_argument('--thumbnails', type=int, default=30, help="Превью, загружаемых со страницы")
+    parser.add_argument('--video-probability', type=float, default=0.3, help="Доля сеансов с перемоткой видео")
+    parser.add_argument('--think-ms', type=float, default=0, help="Пауза пользователя между страницами")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workspace', default=None, help="Рабочая директория (по умолчанию временная)")
+    parser.add_argument('--output-dir', default=str(RESULTS_DIR))
+    args = parser.parse_args()
+
+    # stdout занят отчетом, логи приложения - в stderr
+    set_console_stream(sys.stderr)
+    workspace = args.workspace or tempfile.mkdtemp(prefix='icloudvision_loadtest_')
+    os.makedirs(workspace, exist_ok=True)
+    try:
+        with working_dir(workspace):
+            started = time.perf_counter()
+            prepare_workspace(workspace, args.rows, args.images, args.videos, args.width, args.height,
+                              args.video_ratio, seed=args.seed)
+            print(f"Рабочая директория {workspace} подготовлена за {time.perf_counter() - started:.1f} с")
+            module, server = start_app(workspace)
+            host, port = server.server_address[:2]
+            print(f"Приложение запущено на http://{host}:{port}, в индексе {len(module.engine.snapshot)} файлов")
+            try:
+                stages = []
+                for users in args.users:
+                    stage = run_stage(host, port, users, args.duration, args.sse_clients, args.pages,
+                                      args.thumbnails, args.video_probability, args.think_ms, args.seed)
+                    print_stage(stage)
+                    stages.append(stage)
+            finally:
+                server.shutdown()
+    finally:
+        if args.workspace is None:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    params = {key: value for key, value in vars(args).items() if key not in ('output_dir', 'workspace')}
+    write_results('loadtest', params, stages, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@ import logging
 import logging.handlers
 import os
 import sys
+import time
+import atexit
+import queue
 from datetime import datetime
 import colorama
 from colorama import Fore, Style, Back
@@ -79,13 +82,31 @@ console_formatter = ColoredFormatter(
     datefmt='%H:%M:%S'
 )
 
-def setup_logger(name):
-    """Настраивает и возвращает логгер с указанным именем"""
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке.
 
-    # Проверяем, не были ли уже добавлены хендлеры
-    if not logger.handlers:
+    Стандартный QueueHandler.prepare() форматирует сообщение перед постановкой
+    в очередь; здесь запись передается как есть, и все форматирование (включая
+    раскраску и трейсбеки) выполняется в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Общая очередь и слушатель: хендлеры файла и консоли работают в отдельном потоке
+_log_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+_console_handler = None
+
+
+def _start_listener():
+    """Создает хендлеры файла и консоли и запускает поток QueueListener (один на процесс)"""
+    global _listener, _console_handler
+    with _listener_lock:
+        if _listener is not None:
+            return
         # Хендлер для записи в файл
         current_date = datetime.now().strftime('%Y-%m-%d')
         file_handler = logging.handlers.RotatingFileHandler(
@@ -96,17 +117,85 @@ def setup_logger(name):
         )
         file_handler.setFormatter(file_formatter)
         file_handler.setLevel(logging.DEBUG)
-        
+
         # Хендлер для вывода в консоль
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(console_formatter)
         console_handler.setLevel(logging.INFO)
-        
-        # Добавляем хендлеры к логгеру
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+        _console_handler = console_handler
+
+        _listener = logging.handlers.QueueListener(
+            _log_queue, file_handler, console_handler, respect_handler_level=True
+        )
+        _listener.start()
+        # Дописываем оставшиеся в очереди записи при завершении процесса
+        atexit.register(_listener.stop)
+
+
+def set_console_stream(stream):
+    """Перенаправляет консольный вывод логов (например, в stderr, когда stdout занят данными)"""
+    _start_listener()
+    _console_handler.setStream(stream)
+
+
+def setup_logger(name):
+    """Настраивает и возвращает логгер с указанным именем"""
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+
+    # Проверяем, не были ли уже добавлены хендлеры
+    if not logger.handlers:
+        _start_listener()
+        # Вызывающий поток только кладет запись в очередь
+        logger.addHandler(DeferredQueueHandler(_log_queue))
+        logger.propagate = False
         
         # Устанавливаем имя потока по умолчанию
         threading.current_thread().name = 'MainThread'
     
-    return logger 
\ No newline at end of file
+    return logger
+
+
+class LogSummary:
+    """Заменяет сообщения о каждом файле периодической сводкой.
+
+    В циклах по тысячам файлов вызывается count('скачано') вместо logger.info
+    на каждый файл; раз в interval секунд (и при flush) в лог пишется одна строка
+    со счетчиками за прошедший период и итогом с начала работы.
+    """
+
+    def __init__(self, logger, title, interval=10.0, level=logging.INFO):
+        self.logger = logger
+        self.title = title
+        self.interval = interval
+        self.level = level
+        self._lock = threading.Lock()
+        self._window = {}
+        self._totals = {}
+        self._window_started = time.monotonic()
+
+    def count(self, key, n=1):
+        """Учитывает событие и при необходимости пишет сводку"""
+        with self._lock:
+            self._window[key] = self._window.get(key, 0) + n
+            self._totals[key] = self._totals.get(key, 0) + n
+            if time.monotonic() - self._window_started < self.interval:
+                return
+            message = self._take_summary()
+        self.logger.log(self.level, message)
+
+    def _take_summary(self):
+        elapsed = time.monotonic() - self._window_started
+        window = ", ".join(f"{key}: {value}" for key, value in self._window.items())
+        totals = ", ".join(f"{key}: {value}" for key, value in self._totals.items())
+        self._window = {}
+        self._window_started = time.monotonic()
+        return f"{self.title} за {elapsed:.0f} с - {window} (всего {totals})"
+
+    def flush(self):
+        """Пишет сводку за неполный последний период"""
+        with self._lock:
+            if not self._window:
+                return
+            message = self._take_summary()
+        self.logger.log(self.level, message)
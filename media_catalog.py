@@ -0,0 +1,266 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from PIL import Image
+import cv2
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.heic'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv'}
+
+TYPE_IMAGE = 'image'
+TYPE_VIDEO = 'video'
+
+# Теги EXIF с датой съемки
+_EXIF_IFD = 0x8769
+_EXIF_DATETIME_ORIGINAL = 36867
+_EXIF_DATETIME = 306
+
+
+def media_type(path):
+    """Тип файла по расширению: image, video или None"""
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return TYPE_IMAGE
+    if ext in VIDEO_EXTENSIONS:
+        return TYPE_VIDEO
+    return None
+
+
+def _parse_exif_datetime(value):
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), "%Y:%m:%d %H:%M:%S").isoformat()
+    except ValueError:
+        return None
+
+
+def exif_captured_at(image):
+    """Дата съемки из EXIF открытого изображения PIL в ISO-формате или None"""
+    try:
+        exif = image.getexif()
+        value = exif.get_ifd(_EXIF_IFD).get(_EXIF_DATETIME_ORIGINAL) or exif.get(_EXIF_DATETIME)
+    except Exception:
+        return None
+    return _parse_exif_datetime(value) if value else None
+
+
+def probe_media(path):
+    """Читает размеры и дату съемки файла, не декодируя изображение целиком.
+
+    Возвращает (width, height, captured_at); неизвестные значения - None.
+    """
+    width = height = captured_at = None
+    try:
+        if media_type(path) == TYPE_VIDEO:
+            capture = cv2.VideoCapture(str(path))
+            try:
+                width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)) or None
+                height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None
+            finally:
+                capture.release()
+        else:
+            # Image.open читает только заголовок, пиксели не декодируются
+            with Image.open(path) as image:
+                width, height = image.size
+                captured_at = exif_captured_at(image)
+    except Exception as e:
+        logger.debug(f"Не удалось прочитать метаданные {path}: {str(e)}")
+    return width, height, captured_at
+
+
+class MediaCatalog:
+    """Каталог медиафайлов в SQLite: тип, размер, разрешение, дата съемки и ассет iCloud.
+
+    Пополняется синхронизацией и индексацией по мере появления файлов, поэтому
+    статистика берется из каталога, а не из обхода директории. Счетчики по типам
+    кэшируются в памяти и пересчитываются только после изменений.
+    Пути хранятся относительно директории с фотографиями.
+    """
+
+    def __init__(self, db_path="media_catalog.db", photos_dir="Photos"):
+        self.db_path = str(db_path)
+        self.photos_dir = Path(photos_dir).resolve()
+        self._lock = threading.Lock()
+        self._counts = None
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    path TEXT PRIMARY KEY,
+                    asset_id TEXT,
+                    media_type TEXT NOT NULL,
+                    size INTEGER,
+                    width INTEGER,
+                    height INTEGER,
+                    captured_at TEXT,
+                    mtime REAL,
+                    indexed INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_media_type ON media(media_type)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_media_asset ON media(asset_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_media_captured ON media(captured_at)")
+
+    def relative(self, path):
+        """Путь относительно директории с фотографиями в формате posix"""
+        path = Path(path)
+        if not path.is_absolute():
+            path = path.resolve()
+        try:
+            return path.relative_to(self.photos_dir).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+    def add_file(self, path, asset_id=None, captured_at=None, indexed=None):
+        """Добавляет или обновляет файл в каталоге.
+
+        Дата съемки берется из EXIF, а если ее нет - из переданного captured_at
+        (например, даты ассета в iCloud). Возвращает False для неподдерживаемых файлов.
+        """
+        kind = media_type(path)
+        if kind is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        width, height, exif_captured = probe_media(path)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO media (path, asset_id, media_type, size, width, height, captured_at, mtime, indexed, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    asset_id = COALESCE(excluded.asset_id, media.asset_id),
+                    media_type = excluded.media_type,
+                    size = excluded.size,
+                    width = excluded.width,
+                    height = excluded.height,
+                    captured_at = excluded.captured_at,
+                    mtime = excluded.mtime,
+                    indexed = CASE WHEN ? IS NULL THEN media.indexed ELSE excluded.indexed END,
+                    updated_at = excluded.updated_at
+            """, (
+                self.relative(path), asset_id, kind, stat.st_size, width, height,
+                exif_captured or captured_at, stat.st_mtime, int(bool(indexed)), time.time(), indexed
+            ))
+            self._counts = None
+        return True
+
+    def is_current(self, path):
+        """Есть ли файл в каталоге с теми же размером и временем изменения, что на диске"""
+        row = self.get(path)
+        if row is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return row['size'] == stat.st_size and row['mtime'] == stat.st_mtime
+
+    def ensure_file(self, path, asset_id=None, captured_at=None):
+        """Добавляет файл, только если его еще нет в каталоге или он изменился на диске"""
+        row = self.get(path)
+        if row is not None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+                if asset_id and row['asset_id'] != asset_id:
+                    with self._lock, self._conn:
+                        self._conn.execute("UPDATE media SET asset_id = ? WHERE path = ?", (asset_id, row['path']))
+                return True
+        return self.add_file(path, asset_id, captured_at)
+
+    def get(self, path):
+        """Возвращает запись каталога для файла или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM media WHERE path = ?", (self.relative(path),)).fetchone()
+        return dict(row) if row else None
+
+    def remove(self, paths):
+        """Удаляет файлы из каталога"""
+        keys = [(self.relative(path),) for path in paths]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM media WHERE path = ?", keys)
+            self._counts = None
+
+    def rename(self, renames):
+        """Переносит записи на новые пути (файлы перемещены на диске), сохраняя метаданные"""
+        keys = [(self.relative(new), time.time(), self.relative(old)) for old, new in renames.items()]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE OR REPLACE media SET path = ?, updated_at = ? WHERE path = ?", keys)
+            self._counts = None
+
+    def mark_indexed(self, paths):
+        """Отмечает файлы как проиндексированные"""
+        keys = [(time.time(), self.relative(path)) for path in paths]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE media SET indexed = 1, updated_at = ? WHERE path = ?", keys)
+            self._counts = None
+
+    def reconcile(self, paths, prune=True):
+        """Сверяет каталог со списком файлов на диске (например, из обхода при индексации).
+
+        Новые файлы добавляются; если prune, удаляются записи файлов, которых
+        нет в списке (список должен охватывать всю директорию).
+        Возвращает пару (добавлено, удалено).
+        """
+        on_disk = {self.relative(path): path for path in paths if media_type(path) is not None}
+        with self._lock:
+            known = {row['path'] for row in self._conn.execute("SELECT path FROM media")}
+        missing = [path for key, path in on_disk.items() if key not in known]
+        vanished = [key for key in known if key not in on_disk] if prune else []
+        for path in missing:
+            self.add_file(path)
+        if vanished:
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM media WHERE path = ?", [(key,) for key in vanished])
+                self._counts = None
+        return len(missing), len(vanished)
+
+    def scan(self):
+        """Полная сверка каталога с директорией фотографий"""
+        paths = [path for path in self.photos_dir.rglob('*')
+                 if path.is_file() and not path.name.startswith('.')]
+        added, removed = self.reconcile(paths)
+        if added or removed:
+            logger.info(f"Каталог медиафайлов обновлен: добавлено {added}, удалено {removed}")
+        return added, removed
+
+    def counts(self):
+        """Количество файлов по типам, общий объем и число проиндексированных (кэшируется)"""
+        counts = self._counts
+        if counts is not None:
+            return counts
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT media_type, COUNT(*) AS n, COALESCE(SUM(size), 0) AS bytes, SUM(indexed) AS indexed
+                FROM media GROUP BY media_type
+            """).fetchall()
+            counts = {'images': 0, 'videos': 0, 'total': 0, 'bytes': 0, 'indexed': 0}
+            for row in rows:
+                counts['images' if row['media_type'] == TYPE_IMAGE else 'videos'] += row['n']
+                counts['total'] += row['n']
+                counts['bytes'] += row['bytes']
+                counts['indexed'] += row['indexed'] or 0
+            self._counts = counts
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,321 @@
+"""Метрики приложения в текстовом формате Prometheus (эндпоинт /metrics).
+
+Минимальная реализация счетчиков, gauge и гистограмм без внешних зависимостей.
+Запись метрики - это захват незанятой блокировки и пара сложений, поэтому ее
+можно вызывать в горячих циклах. Все метрики приложения объявлены ниже,
+модули импортируют нужные им объекты.
+"""
+import abc
+import bisect
+import math
+import os
+import threading
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        """Возвращает дочернюю метрику для набора значений меток"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        # Метрика без меток ведет себя как единственный дочерний экземпляр
+        return self.labels()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Новый дочерний экземпляр для набора значений меток"""
+
+    @abc.abstractmethod
+    def _samples(self):
+        """Строки значений метрики в формате Prometheus"""
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}'
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом чтении /metrics"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            try:
+                value = child.get()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(float(value))}'
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.upper_bounds = tuple(sorted(float(b) for b in buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total_sum = child.sum
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total_sum)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Возвращает все метрики в текстовом формате Prometheus 0.0.4"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def process_resident_memory():
+    """Текущий RSS процесса в байтах (Linux), иначе пиковый RSS"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # В macOS ru_maxrss в байтах, в Linux - в килобайтах
+            return rss if os.uname().sysname == 'Darwin' else rss * 1024
+        except Exception:
+            return None
+
+
+REGISTRY = Registry()
+
+# Поиск
+SEARCH_PHASE_SECONDS = REGISTRY.histogram(
+    'icloudvision_search_phase_seconds',
+    'Время фаз поискового запроса: кодирование текста, расчет сходства, отбор top-k',
+    ['phase']
+)
+TEXT_ENCODE_BATCH_SIZE = REGISTRY.histogram(
+    'icloudvision_text_encode_batch_size',
+    'Размер батча текстового энкодера',
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+TEXT_ENCODE_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'icloudvision_text_encode_queue_wait_seconds',
+    'Время ожидания запроса в очереди текстового энкодера',
+    buckets=(.0005, .001, .002, .005, .01, .02, .05, .1, .25)
+)
+
+# Индексация
+INDEXING_STAGE_SECONDS = REGISTRY.counter(
+    'icloudvision_indexing_stage_seconds_total',
+    'Суммарное время стадий индексации (discover, decode, embed, persist)',
+    ['stage']
+)
+INDEXING_STAGE_ITEMS = REGISTRY.counter(
+    'icloudvision_indexing_stage_items_total',
+    'Количество элементов, прошедших стадию индексации',
+    ['stage']
+)
+INDEX_IMAGES = REGISTRY.gauge(
+    'icloudvision_index_images',
+    'Количество файлов в индексе'
+)
+INDEX_MEMORY_BYTES = REGISTRY.gauge(
+    'icloudvision_index_memory_bytes',
+    'Объем памяти, занимаемый векторами индекса'
+)
+PROCESS_MEMORY_BYTES = REGISTRY.gauge(
+    'icloudvision_process_resident_memory_bytes',
+    'Резидентная память процесса'
+)
+PROCESS_MEMORY_BYTES.set_function(process_resident_memory)
+
+# Синхронизация iCloud
+DOWNLOAD_BYTES = REGISTRY.counter(
+    'icloudvision_download_bytes_total',
+    'Байт скачано из iCloud'
+)
+DOWNLOAD_FILES = REGISTRY.counter(
+    'icloudvision_download_files_total',
+    'Результаты скачивания файлов из iCloud',
+    ['result']
+)
+DOWNLOAD_RETRIES = REGISTRY.counter(
+    'icloudvision_download_retries_total',
+    'Повторные попытки скачивания'
+)
+DOWNLOAD_ERRORS = REGISTRY.counter(
+    'icloudvision_download_errors_total',
+    'Ошибки скачивания по HTTP-коду (none - без кода)',
+    ['status']
+)
+DOWNLOAD_CONCURRENCY = REGISTRY.gauge(
+    'icloudvision_download_concurrency_limit',
+    'Текущий адаптивный лимит параллельных скачиваний'
+)
+HEIC_CONVERSIONS = REGISTRY.counter(
+    'icloudvision_heic_conversions_total',
+    'Результаты конвертации HEIC в JPEG',
+    ['result']
+)
+HEIC_CONVERSION_SECONDS = REGISTRY.counter(
+    'icloudvision_heic_conversion_seconds_total',
+    'Суммарное время конвертации HEIC в дочерних процессах'
+)
+
+# Кэши
+CACHE_REQUESTS = REGISTRY.counter(
+    'icloudvision_cache_requests_total',
+    'Обращения к кэшам (hit/miss)',
+    ['cache', 'result']
+)
@@ -0,0 +1,70 @@
+import json
+import os
+from config import EMBEDDING_MODEL, MODEL_STATE_PATH
+
+
+class ModelSpec:
+    """Модель эмбеддингов изображений и текста (совместимая с CLIPModel из transformers)"""
+
+    def __init__(self, key, name, dim, description):
+        self.key = key
+        self.name = name
+        self.dim = dim
+        self.description = description
+
+    @property
+    def index_path(self):
+        """Файл индекса модели; у модели по умолчанию - прежнее имя, чтобы старые индексы подхватывались"""
+        return "image_index.pkl" if self.key == DEFAULT_MODEL else f"image_index.{self.key}.pkl"
+
+    @property
+    def progress_path(self):
+        return "indexing_progress.json" if self.key == DEFAULT_MODEL else f"indexing_progress.{self.key}.json"
+
+    def to_dict(self):
+        return {'key': self.key, 'name': self.name, 'dim': self.dim, 'description': self.description,
+                'index_path': self.index_path}
+
+
+DEFAULT_MODEL = 'clip-b32'
+
+MODELS = {spec.key: spec for spec in (
+    ModelSpec('clip-b32', "openai/clip-vit-base-patch32", 512,
+              "Базовая модель: быстрая, подходит для слабых машин"),
+    ModelSpec('clip-b32-laion', "laion/CLIP-ViT-B-32-laion2B-s34B-b79K", 512,
+              "Та же скорость, точнее на бытовых фотографиях"),
+    ModelSpec('clip-b16', "openai/clip-vit-base-patch16", 512,
+              "Точнее базовой, примерно в 4 раза медленнее при индексации"),
+    ModelSpec('clip-l14', "openai/clip-vit-large-patch14", 768,
+              "Самая точная, нужна видеокарта или много времени на индексацию"),
+)}
+
+
+def get_model_spec(key=None):
+    """Описание модели по ключу; без ключа - активная модель"""
+    key = key or active_model_key()
+    if key not in MODELS:
+        raise ValueError(f"Неизвестная модель: {key}. Доступны: {', '.join(MODELS)}")
+    return MODELS[key]
+
+
+def active_model_key(state_path=MODEL_STATE_PATH):
+    """Модель, на которую переведен индекс (после миграции), иначе модель из конфигурации"""
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                key = json.load(f).get('model')
+            if key in MODELS:
+                return key
+        except (OSError, ValueError):
+            pass
+    return EMBEDDING_MODEL
+
+
+def set_active_model(key, state_path=MODEL_STATE_PATH):
+    """Запоминает активную модель, чтобы после перезапуска использовался ее индекс"""
+    get_model_spec(key)
+    tmp_path = str(state_path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'model': key}, f)
+    os.replace(tmp_path, state_path)
@@ -0,0 +1,308 @@
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from heic_converter import convert_heic_file, is_heic_claimed
+from logger_config import setup_logger
+from media_catalog import media_type
+
+logger = setup_logger(__name__)
+
+# Флаги событий из <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; за ним имя длиной len
+_READ_SIZE = 64 * 1024
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+
+class Inotify:
+    """Тонкая обертка над inotify(7) через ctypes (только Linux)"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, f"inotify_init1: {os.strerror(code)}")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, f"inotify_add_watch {path}: {os.strerror(code)}")
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """События за время ожидания (секунды): список (wd, mask, cookie, name)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(buffer):
+            wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+            start = offset + _EVENT.size
+            name = buffer[start:start + length].split(b'\0', 1)[0]
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+            offset = start + length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PhotoWatcher:
+    """Непрерывная инкрементальная индексация директории с фотографиями.
+
+    Следит за деревом через inotify (рекурсивно: на каждую поддиректорию свое
+    наблюдение) и копит события создания, изменения, перемещения и удаления.
+    Путь попадает в индексацию, когда по нему debounce секунд не было новых
+    событий, поэтому файл, который еще копируется, не индексируется
+    наполовину. Готовые пути уходят в движок батчами по batch_size:
+    новые и измененные файлы - в add_files, удаленные - в remove_files.
+    Перемещенный файл стоит одного хэширования благодаря кэшу эмбеддингов.
+
+    При переполнении очереди событий ядра часть изменений потеряна, поэтому
+    вызывается rescan() (полная индексация). Если inotify недоступен (не Linux
+    или исчерпан лимит наблюдений), rescan() вызывается раз в scan_interval секунд.
+
+    Пока действует paused(), события копятся, но в индекс не передаются:
+    так файлы, которые переносит миграция хранилища, не индексируются
+    заново. Файлы, которые уже есть в индексе и не изменились с момента
+    внесения в каталог, пропускаются.
+    """
+
+    def __init__(self, get_engine, root="Photos", rescan=None, debounce=2.0, batch_size=16,
+                 scan_interval=600.0):
+        # Движок берется при каждом сбросе: его могут заменить (миграция модели, перезагрузка)
+        self.get_engine = get_engine
+        self.root = str(root)
+        self.rescan = rescan
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.scan_interval = scan_interval
+        self._inotify = None
+        self._watches = {}
+        self._pending = {}
+        self._rescan_needed = False
+        # Сброс в индекс и приостановка (paused) исключают друг друга
+        self._flush_lock = threading.Lock()
+        self._paused = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'indexed': 0, 'removed': 0, 'overflows': 0, 'rescans': 0}
+
+    def start(self):
+        if sys.platform.startswith('linux'):
+            try:
+                self._inotify = Inotify()
+                self._watch_tree(self.root)
+                logger.info(f"Наблюдение за {self.root}: {len(self._watches)} директорий")
+            except OSError as e:
+                logger.error(f"inotify недоступен ({str(e)}), используется периодическая проверка")
+                self._close_inotify()
+        else:
+            logger.info(f"inotify доступен только в Linux, {self.root} проверяется раз в {self.scan_interval:.0f} с")
+        target = self._run_events if self._inotify is not None else self._run_periodic
+        self._thread = threading.Thread(target=target, name='PhotoWatcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close_inotify()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Приостанавливает передачу изменений в индекс (дожидается уже идущей передачи)"""
+        with self._flush_lock:
+            self._paused += 1
+        try:
+            yield
+        finally:
+            with self._flush_lock:
+                self._paused -= 1
+
+    def _close_inotify(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches = {}
+
+    def _watch_tree(self, top):
+        """Добавляет наблюдения на директорию и все вложенные; возвращает найденные в них файлы"""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            try:
+                wd = self._inotify.add_watch(dirpath)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # Исчерпан fs.inotify.max_user_watches: изменения в остальных директориях увидит rescan
+                    logger.error(f"Достигнут лимит наблюдений inotify на {dirpath}")
+                    self._rescan_needed = True
+                    return files
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            self._watches[wd] = dirpath
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+        return files
+
+    def _unwatch_tree(self, top):
+        prefix = top + os.sep
+        for wd, path in list(self._watches.items()):
+            if path == top or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+    def _mark(self, path, kind, is_dir=False):
+        self._pending[path] = (kind, time.monotonic(), is_dir)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("Очередь событий inotify переполнена, будет выполнена полная проверка")
+            self.stats['overflows'] += 1
+            self._rescan_needed = True
+            return
+        directory = self._watches.get(wd)
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if name.startswith('.'):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Файлы могли появиться до того, как наблюдение было добавлено
+                for file_path in self._watch_tree(path):
+                    self._mark(file_path, UPSERT)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self._unwatch_tree(path)
+                self._mark(path, DELETE, is_dir=True)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._mark(path, UPSERT)
+        elif mask & (IN_MOVED_FROM | IN_DELETE):
+            self._mark(path, DELETE)
+
+    def _run_events(self):
+        while not self._stop.is_set():
+            try:
+                for wd, mask, _, name in self._inotify.read(timeout=min(0.5, self.debounce)):
+                    self._handle(wd, mask, name)
+                self._flush()
+            except Exception as e:
+                logger.error(f"Ошибка наблюдения за {self.root}: {str(e)}")
+                time.sleep(1)
+        self._flush(force=True)
+
+    def _run_periodic(self):
+        while not self._stop.wait(self.scan_interval):
+            self._rescan_needed = True
+            self._flush()
+
+    def _flush(self, force=False):
+        """Передает в индекс пути, по которым не было событий debounce секунд"""
+        with self._flush_lock:
+            if not self._paused:
+                self._flush_due(force)
+
+    def _flush_due(self, force):
+        if self._rescan_needed:
+            self._rescan_needed = False
+            self._pending.clear()
+            if self.rescan is not None:
+                self.stats['rescans'] += 1
+                self.rescan()
+            return
+        now = time.monotonic()
+        due = [(path, entry) for path, entry in self._pending.items()
+               if force or now - entry[1] >= self.debounce]
+        if not due:
+            return
+        for path, _ in due:
+            del self._pending[path]
+
+        engine = self.get_engine()
+        upserts, deletes, deleted_dirs = [], [], []
+        for path, (kind, _, is_dir) in due:
+            if kind == DELETE:
+                (deleted_dirs if is_dir else deletes).append(path)
+            elif os.path.isfile(path) and not os.path.basename(path).startswith('.') and media_type(path):
+                upserts.append(path)
+        if deleted_dirs:
+            # Удаленная или перемещенная директория: из индекса убираются все файлы под ней
+            prefixes = tuple(path + os.sep for path in deleted_dirs)
+            deletes.extend(path for path in engine.snapshot.paths if path.startswith(prefixes))
+        self._apply(engine, upserts, deletes)
+
+    def _apply(self, engine, upserts, deletes):
+        catalog = engine.catalog
+        if deletes:
+            removed = engine.remove_files(deletes)
+            self.stats['removed'] += removed
+            if catalog is not None:
+                catalog.remove(deletes)
+            logger.info(f"Из индекса удалено {removed} файлов ({self.root})")
+        if catalog is not None:
+            # Перенесенный миграцией или уже проиндексированный синхронизацией файл заново не хэшируется
+            upserts = [path for path in upserts
+                       if not (str(Path(path)) in engine.image_features and catalog.is_current(path))]
+            for path in upserts:
+                catalog.ensure_file(path)
+        indexable = []
+        for path in upserts:
+            if path.lower().endswith('.heic'):
+                # HEIC из синхронизации конвертирует ее пул; остальные - здесь же, с заменой на JPEG.
+                # Индексируется JPEG-копия; событие о ее создании придет следом
+                if is_heic_claimed(path) or not os.path.exists(path):
+                    continue
+                _, error, _ = convert_heic_file(path)
+                if error:
+                    logger.error(f"Ошибка при конвертации {path}: {error}")
+            else:
+                indexable.append(path)
+        added = 0
+        for start in range(0, len(indexable), self.batch_size):
+            added += engine.add_files(indexable[start:start + self.batch_size], save=False)
+        if added:
+            engine.save_index()
+            self.stats['indexed'] += added
+            logger.info(f"Проиндексировано {added} новых или измененных файлов ({self.root})")
@@ -0,0 +1,194 @@
+"""Профилирование по запросу: трассировка стадий и сэмплирующий профайлер.
+
+Tracer записывает интервалы (spans) в формате Chrome trace-event, файл
+открывается в https://ui.perfetto.dev или chrome://tracing. Пока трассировка
+выключена, span() возвращает один и тот же пустой контекстный менеджер,
+поэтому инструментированный код ничего не аллоцирует и не пишет.
+
+SamplingProfiler раз в interval секунд снимает стеки выбранных потоков
+через sys._current_frames() и считает, где они проводят время. Используется
+для профилирования отдельных запросов /search.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'started')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        finished = time.perf_counter()
+        if exc_type is not None:
+            self.args = dict(self.args, error=exc_type.__name__)
+        self.tracer._record(self.name, self.started, finished, self.args)
+        return False
+
+
+class Tracer:
+    """Сборщик интервалов в формате Chrome trace-event"""
+
+    def __init__(self, max_events=1_000_000):
+        self.enabled = False
+        self._events = deque(maxlen=max_events)
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        """Контекстный менеджер интервала; при выключенной трассировке ничего не делает"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def _record(self, name, started, finished, args):
+        thread = threading.current_thread()
+        self._thread_names[thread.ident] = thread.name
+        # deque.append потокобезопасен, блокировка не нужна
+        self._events.append((name, started, finished, thread.ident, args))
+
+    def start(self):
+        """Очищает буфер и включает запись"""
+        with self._lock:
+            self._events.clear()
+            self._thread_names.clear()
+            self._origin = time.perf_counter()
+            self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def to_chrome_trace(self):
+        """Возвращает записанные интервалы как объект Chrome trace-event JSON"""
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'iCloudVision'}}]
+        for tid, thread_name in list(self._thread_names.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        for name, started, finished, tid, args in list(self._events):
+            event = {
+                'name': name,
+                'cat': name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': (started - self._origin) * 1e6,
+                'dur': (finished - started) * 1e6,
+                'pid': pid,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = {key: str(value) for key, value in args.items()}
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        """Сохраняет трассировку в файл и возвращает число интервалов"""
+        trace = self.to_chrome_trace()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, path)
+        return sum(1 for event in trace['traceEvents'] if event['ph'] == 'X')
+
+
+# Общий трассировщик приложения
+TRACER = Tracer()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер для выбранных потоков.
+
+    Потоки задаются идентификаторами и/или именами (например, рабочий поток
+    текстового энкодера 'TextBatcher'). Используется как контекстный менеджер.
+    """
+
+    def __init__(self, interval=0.001, thread_ids=(), thread_names=(), max_depth=64):
+        self.interval = interval
+        self.thread_ids = set(thread_ids)
+        self.thread_names = set(thread_names)
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _targets(self):
+        targets = {tid: None for tid in self.thread_ids}
+        for thread in threading.enumerate():
+            if thread.ident in targets or thread.name in self.thread_names:
+                targets[thread.ident] = thread.name
+        return targets
+
+    def _run(self):
+        own_id = threading.get_ident()
+        targets = self._targets()
+        started = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for tid, thread_name in targets.items():
+                frame = frames.get(tid)
+                if frame is None or tid == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(thread_name or str(tid))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            # Поток энкодера может появиться уже после старта профайлера
+            if self.thread_names and len(targets) < len(self.thread_ids) + len(self.thread_names):
+                targets = self._targets()
+        self.duration = time.perf_counter() - started
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def summary(self, top=20):
+        """Самые частые функции (собственное и полное время) и свернутые стеки для flamegraph"""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                total[label] += count
+        sample_ms = self.interval * 1000.0
+        return {
+            'interval_ms': sample_ms,
+            'samples': self.samples,
+            'duration_ms': self.duration * 1000.0,
+            'top_self': [{'frame': label, 'samples': count, 'ms': count * sample_ms}
+                         for label, count in own.most_common(top)],
+            'top_total': [{'frame': label, 'samples': count, 'ms': count * sample_ms}
+                          for label, count in total.most_common(top)],
+            # Формат collapsed stacks (flamegraph.pl, speedscope)
+            'collapsed': '\n'.join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()),
+        }
@@ -11,22 +11,142 @@ from functools import partial
 import time
 import pickle
 import pillow_heif
-import logging
 import cv2
+import threading
+import sys
+import argparse
+from datetime import datetime, timedelta
+from text_batcher import TextEncodeBatcher
+from profiling import TRACER
+from media_catalog import media_type, exif_captured_at, TYPE_IMAGE, TYPE_VIDEO
+from index_snapshot import IndexSnapshot, SnapshotBuilder
+from embedding_cache import EmbeddingCache
+from clip_preprocess import BatchPreprocessor, verify, EQUIVALENCE_TOLERANCE
+from autotune import load_profile
+from model_registry import MODELS, get_model_spec
+from auto_tagger import AutoTagger, load_vocabulary
+from logger_config import setup_logger, set_console_stream
+from metrics import SEARCH_PHASE_SECONDS, INDEXING_STAGE_SECONDS, INDEXING_STAGE_ITEMS, CACHE_REQUESTS
+from config import (
+    TEXT_BATCH_MAX_SIZE, TEXT_BATCH_WAIT_MS, SNAPSHOT_PUBLISH_INTERVAL, EMBEDDING_CACHE_PATH,
+    INDEX_BATCH_SIZE, DECODE_WORKERS, TUNING_PROFILE_PATH, AUTO_TAGS_ENABLED, AUTO_TAG_VOCABULARY_PATH,
+    AUTO_TAG_PROMPT, AUTO_TAG_THRESHOLD, AUTO_TAG_MAX_PER_IMAGE
+)
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+logger = setup_logger(__name__)
+
+# Дочерние метрики создаются заранее, чтобы не искать их по меткам в горячем цикле
+_SEARCH_ENCODE = SEARCH_PHASE_SECONDS.labels('text_encode')
+_SEARCH_SCORING = SEARCH_PHASE_SECONDS.labels('scoring')
+_SEARCH_TOPK = SEARCH_PHASE_SECONDS.labels('topk')
+_SEARCH_TAG_LOOKUP = SEARCH_PHASE_SECONDS.labels('tag_lookup')
+_TAG_INDEX_HIT = CACHE_REQUESTS.labels('tag_index', 'hit')
+_TAG_INDEX_MISS = CACHE_REQUESTS.labels('tag_index', 'miss')
+_STAGE_SECONDS = {stage: INDEXING_STAGE_SECONDS.labels(stage) for stage in ('discover', 'decode', 'embed', 'persist')}
+_STAGE_ITEMS = {stage: INDEXING_STAGE_ITEMS.labels(stage) for stage in ('discover', 'decode', 'embed', 'persist')}
+
+
+def _record_stage(stage, started, items=1):
+    _STAGE_SECONDS[stage].inc(time.perf_counter() - started)
+    _STAGE_ITEMS[stage].inc(items)
+
+
+def _parse_date(value, end_of_day=False):
+    """Дата фильтра (ISO-строка или unix-время) в unix-время.
+
+    Для даты без времени в конце диапазона берется конец дня.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"Некорректная дата: {value}")
+    if end_of_day and len(text) <= 10:
+        parsed += timedelta(days=1) - timedelta(microseconds=1)
+    return parsed.timestamp()
+
+
+def normalize_filters(filters):
+    """Проверяет фильтры поиска и приводит их к виду, который понимает search_images.
+
+    Поддерживаются date_from/date_to (ISO-дата или unix-время), media_type
+    ('image' или 'video') и folder (папка относительно директории с фотографиями,
+    включая вложенные). Пустые значения игнорируются. При ошибке - ValueError.
+    """
+    if not filters:
+        return None
+    normalized = {}
+    if filters.get('date_from') not in (None, ''):
+        normalized['date_from'] = _parse_date(filters['date_from'])
+    if filters.get('date_to') not in (None, ''):
+        normalized['date_to'] = _parse_date(filters['date_to'], end_of_day=True)
+    kind = filters.get('media_type')
+    if kind not in (None, '', 'all'):
+        if kind not in (TYPE_IMAGE, TYPE_VIDEO):
+            raise ValueError(f"Некорректный тип файлов: {kind}")
+        normalized['media_type'] = kind
+    folder = str(filters.get('folder') or '').replace('\\', '/').strip('/')
+    if folder:
+        normalized['folder'] = folder
+    return normalized or None
+
 
 class ImageSearchEngine:
-    def __init__(self):
+    def __init__(self, model_key=None):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Модель из реестра (по умолчанию - активная); у каждой модели свой файл индекса
+        self.model_spec = get_model_spec(model_key)
+        self.model_name = self.model_spec.name
         self.model = None
         self.processor = None
+        # Пакетная предобработка вместо CLIPProcessor (None - если она расходится с CLIPProcessor)
+        self.preprocessor = None
+        # Файлы индексируются батчами: декодирование в пуле потоков, модель - один проход на батч
+        self.batch_size = INDEX_BATCH_SIZE
+        self.decode_workers = DECODE_WORKERS
+        self._decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix='IndexDecode')
+        self._embed_lock = threading.Lock()
+        # Профиль автонастройки (autotune.py) перечитывается, когда файл меняется
+        self._tuning_profile_mtime = None
+        self._apply_tuning_profile()
+        # Рабочая копия индекса, которую меняет и сохраняет только индексатор
         self.image_features = {}
-        self.index_path = "image_index.pkl"
-        self.progress_path = "indexing_progress.json"
+        # Метаданные для фильтров поиска: путь -> {'media_type', 'captured_at' (unix-время)}
+        self.image_metadata = {}
+        # Поиск читает только опубликованный снимок; индексатор собирает следующее
+        # поколение в построителе и публикует его заменой ссылки
+        self._builder = SnapshotBuilder()
+        self.snapshot = IndexSnapshot.empty()
+        self.index_path = self.model_spec.index_path
+        self.progress_path = self.model_spec.progress_path
         self.last_update = None
+        # Каталог медиафайлов (MediaCatalog), задается приложением
+        self.catalog = None
+        # Эмбеддинги по хэшу содержимого: перемещенный или продублированный файл не гоняется через CLIP
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, self.model_name)
+        # Автотеги: при индексации файлу достаются теги словаря, запрос-тег отвечается без CLIP
+        self.tagger = None
+        if AUTO_TAGS_ENABLED:
+            self.tagger = AutoTagger(
+                self.model_spec.key, load_vocabulary(AUTO_TAG_VOCABULARY_PATH), prompt=AUTO_TAG_PROMPT,
+                threshold=AUTO_TAG_THRESHOLD, max_tags=AUTO_TAG_MAX_PER_IMAGE
+            )
+        # Сериализует запись в индекс (update_index и потоковая индексация при синхронизации)
+        self._index_lock = threading.RLock()
+        self.text_batcher = TextEncodeBatcher(
+            self.encode_texts,
+            max_batch_size=TEXT_BATCH_MAX_SIZE,
+            max_wait_ms=TEXT_BATCH_WAIT_MS
+        )
+        # Использующие движок запросы и задачи (acquire/release): замененное
+        # поколение закрывается, когда его отпустит последний из них
+        self._users = 0
+        self._retired = False
+        self._closed = False
+        self._users_lock = threading.Lock()
         
         # Загружаем существующий индекс, если он есть
         if os.path.exists(self.index_path):
@@ -36,22 +156,129 @@ class ImageSearchEngine:
                 if isinstance(data, dict):
                     self.image_features = data
                     self.last_update = time.ctime(os.path.getmtime(self.index_path))
+                elif isinstance(data, tuple) and len(data) == 4:
+                    features, last_update, metadata, model_key = data
+                    if model_key == self.model_spec.key:
+                        self.image_features, self.last_update, self.image_metadata = features, last_update, metadata
+                    else:
+                        # Векторы другой модели несовместимы с ее текстовыми эмбеддингами
+                        logger.error(f"Индекс {self.index_path} построен моделью {model_key}, "
+                                     f"а не {self.model_spec.key}; он не загружен")
+                elif isinstance(data, tuple) and len(data) == 3:
+                    # Индекс без записи о модели строился моделью по умолчанию
+                    self.image_features, self.last_update, self.image_metadata = data
                 elif isinstance(data, tuple):
+                    # Индекс старого формата без метаданных: они восполнятся при первом поиске
                     self.image_features, self.last_update = data
                 logger.info(f"({len(self.image_features)} изображений)")
+            self.rebuild_snapshot()
         
         # Загружаем прогресс индексации, если он есть
         self._load_progress()
     
+    def configure(self, batch_size=None, decode_workers=None, intra_op_threads=None, inter_op_threads=None):
+        """Задает параметры индексации (из профиля автонастройки или вручную)"""
+        if batch_size:
+            self.batch_size = batch_size
+        if decode_workers and decode_workers != self.decode_workers:
+            previous_pool = self._decode_pool
+            self.decode_workers = decode_workers
+            self._decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix='IndexDecode')
+            previous_pool.shutdown(wait=False)
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads and inter_op_threads != torch.get_num_interop_threads():
+            try:
+                torch.set_interop_threads(inter_op_threads)
+            except RuntimeError:
+                # torch позволяет задать его только до начала параллельной работы
+                logger.warning(f"Число inter-op потоков ({inter_op_threads}) применится после перезапуска")
+
+    def _apply_tuning_profile(self):
+        """Применяет профиль автонастройки, если он появился или изменился"""
+        try:
+            mtime = os.path.getmtime(TUNING_PROFILE_PATH)
+        except OSError:
+            return
+        if mtime == self._tuning_profile_mtime:
+            return
+        self._tuning_profile_mtime = mtime
+        settings = load_profile(TUNING_PROFILE_PATH, self.model_spec.key)
+        if settings:
+            self.configure(**settings)
+            logger.info(f"Применен профиль автонастройки: {settings}")
+
     def load_model(self):
         if self.model is None:
-            logger.info("Загрузка модели CLIP...")
-            self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(self.device)
-            self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+            logger.info(f"Загрузка модели {self.model_name}...")
+            self.model = CLIPModel.from_pretrained(self.model_name).to(self.device)
+            self.processor = CLIPProcessor.from_pretrained(self.model_name)
             if self.device == "cpu":
                 self.model.float()  # Используем float32 для CPU
+            self.preprocessor = BatchPreprocessor.from_processor(self.processor, max_batch=self.batch_size)
+            try:
+                difference = verify(self.preprocessor, self.processor)
+            except Exception as e:
+                logger.error(f"Ошибка при проверке пакетной предобработки: {str(e)}")
+                difference = None
+            if difference is None or difference > EQUIVALENCE_TOLERANCE:
+                logger.warning(f"Пакетная предобработка расходится с CLIPProcessor ({difference}), используется CLIPProcessor")
+                self.preprocessor = None
             logger.info(f"Модель загружена (используется {self.device}, {torch.get_num_threads()} потоков)")
+            if self.tagger is not None:
+                try:
+                    self.tagger.prepare(self.encode_texts)
+                except Exception as e:
+                    logger.error(f"Ошибка при подготовке автотегов, файлы индексируются без тегов: {str(e)}")
     
+    def adopt_model(self, other):
+        """Берет уже загруженную модель у другого движка той же модели (новое поколение при перезагрузке)"""
+        if other.model is None or other.model_name != self.model_name or self.model is not None:
+            return False
+        self.model, self.processor, self.preprocessor = other.model, other.processor, other.preprocessor
+        if self.tagger is not None:
+            if (other.tagger is not None and other.tagger.ready and other.tagger.signature == self.tagger.signature
+                    and other.tagger.aliases == self.tagger.aliases):
+                self.tagger.embeddings = other.tagger.embeddings
+                self.tagger.query_embeddings = other.tagger.query_embeddings
+            else:
+                try:
+                    self.tagger.prepare(self.encode_texts)
+                except Exception as e:
+                    logger.error(f"Ошибка при подготовке автотегов, файлы индексируются без тегов: {str(e)}")
+        return True
+
+    def close(self):
+        """Освобождает потоки движка (после замены его новым поколением)"""
+        self.text_batcher.close()
+        self._decode_pool.shutdown(wait=False)
+        self.embedding_cache.close()
+
+    def acquire(self):
+        """Отмечает, что движок используется (запрос или задача); парный вызов - release()"""
+        with self._users_lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._users_lock:
+            self._users -= 1
+        self._close_if_unused()
+
+    def retire(self):
+        """Закрывает движок, замененный новым поколением, когда его отпустит последний пользователь"""
+        with self._users_lock:
+            self._retired = True
+        self._close_if_unused()
+
+    def _close_if_unused(self):
+        with self._users_lock:
+            if not self._retired or self._users or self._closed:
+                return
+            self._closed = True
+        self.close()
+        logger.info(f"Прежнее поколение движка ({self.model_spec.key}) закрыто")
+
     def convert_heic_to_jpeg(self, heic_path):
         try:
             # Создаем jpeg путь, заменяя расширение
@@ -76,7 +303,7 @@ class ImageSearchEngine:
             
             # Сохраняем как JPEG
             image.save(jpeg_path, 'JPEG', quality=95)
-            logger.info(f"Конвертирован {heic_path} -> {jpeg_path}")
+            logger.debug(f"Конвертирован {heic_path} -> {jpeg_path}")
             return jpeg_path
         except Exception as e:
             logger.error(f"Ошибка при конвертации {heic_path}: {str(e)}")
@@ -112,36 +339,160 @@ class ImageSearchEngine:
             logger.error(f"Ошибка при извлечении кадра из видео {video_path}: {str(e)}")
             return None
 
-    def process_image(self, image_path):
+    def _extract_metadata(self, image_path, image=None):
+        """Метаданные файла для фильтров: тип и дата съемки.
+
+        Дата берется из EXIF, затем из каталога (дата ассета iCloud), затем из mtime файла.
+        """
+        captured_at = exif_captured_at(image) if image is not None else None
+        if captured_at is None and self.catalog is not None:
+            try:
+                row = self.catalog.get(image_path)
+                captured_at = row['captured_at'] if row else None
+            except Exception:
+                captured_at = None
         try:
-            # Проверяем расширение файла
-            ext = str(image_path).lower()
-            if ext.endswith(('.mp4', '.mov', '.avi', '.mkv')):
-                # Для видео файлов извлекаем первый кадр
-                image = self.extract_video_frame(image_path)
+            captured = datetime.fromisoformat(captured_at).timestamp() if captured_at else os.path.getmtime(image_path)
+        except (OSError, ValueError):
+            captured = None
+        return {'media_type': media_type(image_path) or TYPE_IMAGE, 'captured_at': captured}
+
+    def _load_image(self, image_path, metadata=None):
+        """Открывает файл как RGB-изображение PIL (для видео - первый кадр) или возвращает None.
+
+        Если передан словарь metadata, в него записываются метаданные для фильтров поиска.
+        """
+        ext = str(image_path).lower()
+        if ext.endswith(('.mp4', '.mov', '.avi', '.mkv')):
+            # Для видео файлов извлекаем первый кадр
+            image = self.extract_video_frame(image_path)
+            if image is None:
+                return None
+        else:
+            image = Image.open(image_path)
+        
+        if metadata is not None:
+            metadata.update(self._extract_metadata(image_path, image))
+        
+        # Конвертируем в RGB если нужно
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image
+
+    def _decode(self, image_path):
+        """Декодирует файл и готовит его к батчу (выполняется в потоках декодирования).
+
+        Возвращает пару (изображение, метаданные) или None.
+        """
+        decode_started = time.perf_counter()
+        try:
+            with TRACER.span('index.decode'):
+                metadata = {}
+                image = self._load_image(image_path, metadata)
                 if image is None:
                     return None
+                if self.preprocessor is not None:
+                    # Масштабирование и обрезка тоже здесь, параллельно с другими файлами
+                    image = self.preprocessor.prepare(image)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке {image_path}: {str(e)}")
+            return None
+        _record_stage('decode', decode_started)
+        return image, metadata
+
+    def embed_images(self, images):
+        """Нормализованные эмбеддинги (N, dim) батча изображений PIL или результатов _decode"""
+        embed_started = time.perf_counter()
+        with self._embed_lock, TRACER.span('index.embed', images=len(images)), torch.no_grad():
+            if self.preprocessor is not None:
+                # Представление буфера предобработки, без копирования на CPU
+                pixel_values = torch.from_numpy(self.preprocessor(images)).to(self.device)
             else:
-                # Для обычных изображений используем существующую логику
-                image = Image.open(image_path)
-            
-            # Конвертируем в RGB если нужно
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Предобработка и получение эмбеддингов
-            inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
-                image_features = image_features.cpu().numpy()
-                # Нормализуем вектор
-                image_features = image_features / np.linalg.norm(image_features)
-                # Преобразуем в одномерный массив
-                return image_features.flatten()
+                pixel_values = self.processor(images=images, return_tensors="pt")['pixel_values'].to(self.device)
+            image_features = self.model.get_image_features(pixel_values=pixel_values).cpu().numpy()
+        # Нормализуем векторы
+        image_features = image_features / np.linalg.norm(image_features, axis=1, keepdims=True)
+        _record_stage('embed', embed_started, len(images))
+        return image_features
+
+    def process_image(self, image_path, metadata=None):
+        """Возвращает нормализованный эмбеддинг файла или None.
+
+        Если передан словарь metadata, в него записываются метаданные для фильтров поиска.
+        """
+        try:
+            decoded = self._decode(image_path)
+            if decoded is None:
+                return None
+            image, file_metadata = decoded
+            if metadata is not None:
+                metadata.update(file_metadata)
+            return self.embed_images([image])[0]
         except Exception as e:
             logger.error(f"Ошибка при обработке {image_path}: {str(e)}")
             return None
 
+    def _digest(self, path):
+        try:
+            return self.embedding_cache.digest(path)
+        except OSError as e:
+            logger.error(f"Ошибка при чтении {path}: {str(e)}")
+            return None
+
+    def _header_metadata(self, path):
+        """Метаданные файла без декодирования: для изображений читается только заголовок с EXIF"""
+        image = None
+        if media_type(path) != TYPE_VIDEO:
+            try:
+                image = Image.open(path)
+            except Exception:
+                image = None
+        return self._extract_metadata(path, image)
+
+    def _embed_files(self, paths):
+        """Эмбеддинги пачки файлов через кэш по содержимому.
+
+        Файлы хэшируются и декодируются в пуле потоков, промахи кэша проходят
+        через модель батчами по batch_size. При попадании в кэш CLIP не
+        запускается. Каждый путь связывается с содержимым, чтобы кэш знал,
+        какие векторы еще используются.
+        Возвращает список (путь, вектор, метаданные) успешно обработанных файлов.
+        """
+        keys = [str(Path(path)) for path in paths]
+        digests = list(self._decode_pool.map(self._digest, keys))
+        hits, misses = [], []
+        for path, key, digest in zip(paths, keys, digests):
+            if digest is None:
+                continue
+            features = self.embedding_cache.get(digest[0])
+            if features is not None:
+                hits.append((path, key, digest, features))
+            else:
+                misses.append((path, key, digest))
+        CACHE_REQUESTS.labels('embedding', 'hit').inc(len(hits))
+        CACHE_REQUESTS.labels('embedding', 'miss').inc(len(misses))
+
+        results = []
+        hit_metadata = self._decode_pool.map(self._header_metadata, [key for _, key, _, _ in hits])
+        for (path, key, (digest, stat), features), metadata in zip(hits, hit_metadata):
+            self.embedding_cache.link(key, digest, stat)
+            results.append((path, features, metadata))
+
+        decoded = self._decode_pool.map(self._decode, [key for _, key, _ in misses])
+        ready = [(miss, item) for miss, item in zip(misses, decoded) if item is not None]
+        for start in range(0, len(ready), self.batch_size):
+            batch = ready[start:start + self.batch_size]
+            try:
+                features = self.embed_images([image for _, (image, _) in batch])
+            except Exception as e:
+                logger.error(f"Ошибка при получении эмбеддингов батча из {len(batch)} файлов: {str(e)}")
+                continue
+            for ((path, key, (digest, stat)), (_, metadata)), vector in zip(batch, features):
+                self.embedding_cache.put(digest, vector)
+                self.embedding_cache.link(key, digest, stat)
+                results.append((path, vector, metadata))
+        return results
+
     def check_index_exists(self):
         """Проверяет существование индекса"""
         return os.path.exists(self.index_path) and len(self.image_features) > 0
@@ -186,25 +537,201 @@ class ImageSearchEngine:
         for heic_path in tqdm(heic_files, desc="Конвертация HEIC в JPEG"):
             self.convert_heic_to_jpeg(heic_path)
 
-    def update_index(self, images_dir="Photos", progress_callback=None):
-        """Обновляет индекс изображений"""
+    def save_index(self):
+        """Сохраняет индекс на диск (через временный файл, чтобы не повредить его при сбое)"""
+        with self._index_lock, TRACER.span('index.persist', images=len(self.image_features)):
+            persist_started = time.perf_counter()
+            self.last_update = time.ctime()
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((self.image_features, self.last_update, self.image_metadata, self.model_spec.key), f)
+            os.replace(tmp_path, self.index_path)
+            _record_stage('persist', persist_started)
+
+    def index_memory_bytes(self):
+        """Объем памяти векторов опубликованного снимка индекса"""
+        return self.snapshot.memory_bytes()
+
+    def _current_tags(self, metadata):
+        """Автотеги файла, если они посчитаны с текущим словарем и порогом, иначе None"""
+        if self.tagger is None or not metadata or metadata.get('tag_signature') != self.tagger.signature:
+            return None
+        return metadata.get('tags')
+
+    def _stage(self, path, features, metadata):
+        """Добавляет файл в рабочую копию и в следующее поколение снимка (под блокировкой индекса)"""
+        if self.tagger is not None and self.tagger.ready and self._current_tags(metadata) is None:
+            metadata = dict(metadata or {}, tags=self.tagger.score(features)[0], tag_signature=self.tagger.signature)
+        self.image_features[path] = features
+        self.image_metadata[path] = metadata
+        self._builder.upsert(path, features, metadata, self._current_tags(metadata))
+
+    def publish_snapshot(self):
+        """Делает накопленные изменения видимыми поиску (атомарная замена ссылки на снимок)"""
+        with self._index_lock:
+            self.snapshot = self._builder.publish()
+        return self.snapshot
+
+    def rebuild_snapshot(self):
+        """Собирает снимок заново из рабочей копии индекса (после загрузки или замены image_features)"""
+        with self._index_lock:
+            builder = SnapshotBuilder(capacity=max(1024, len(self.image_features)))
+            for path, features in self.image_features.items():
+                metadata = self.image_metadata.get(path)
+                if metadata is None:
+                    # Индекс старого формата: тип по расширению, дата по mtime файла
+                    metadata = self.image_metadata[path] = self._extract_metadata(path)
+                builder.upsert(path, features, metadata, self._current_tags(metadata))
+            self._builder = builder
+            return self.publish_snapshot()
+
+    def add_files(self, paths, save=True):
+        """Индексирует переданные файлы без обхода всей директории.
+
+        Используется потоковой индексацией: файлы попадают сюда сразу после
+        скачивания. Уже проиндексированные пути пересчитываются (файл мог измениться).
+        Возвращает количество успешно добавленных файлов.
+        """
+        self.load_model()
+        added = []
+        with self._index_lock, TRACER.span('index.add_files', files=len(paths)):
+            for path, features, metadata in self._embed_files(paths):
+                self._stage(str(Path(path)), features, metadata)
+                added.append(path)
+            if added:
+                self.publish_snapshot()
+            if added and save:
+                self.save_index()
+        self._mark_indexed(added)
+        return len(added)
+
+    def remove_files(self, paths, save=True):
+        """Удаляет файлы из индекса; их векторы в кэше освободит gc, если на них больше нет ссылок"""
+        keys = [str(Path(path)) for path in paths]
+        with self._index_lock:
+            removed = [key for key in keys if key in self.image_features]
+            for key in removed:
+                del self.image_features[key]
+                self.image_metadata.pop(key, None)
+            if removed:
+                self._builder.remove(removed)
+                self.publish_snapshot()
+                if save:
+                    self.save_index()
+        self.embedding_cache.unlink(keys)
+        return len(removed)
+
+    def rename_files(self, renames, save=True):
+        """Переносит записи индекса на новые пути без пересчета эмбеддингов.
+
+        renames - словарь старый путь -> новый путь для файлов, перемещенных на диске.
+        Возвращает количество перенесенных записей.
+        """
+        moves = {str(Path(old)): str(Path(new)) for old, new in renames.items()}
+        with self._index_lock:
+            moved = [(old, new) for old, new in moves.items() if old in self.image_features]
+            if moved:
+                self._builder.remove([old for old, _ in moved])
+                for old, new in moved:
+                    features = self.image_features.pop(old)
+                    metadata = self.image_metadata.pop(old, None) or self._extract_metadata(new)
+                    self._stage(new, features, metadata)
+                self.publish_snapshot()
+                if save:
+                    self.save_index()
+        self.embedding_cache.rename(moves)
+        return len(moved)
+
+    def retag(self, chunk_size=4096):
+        """Считает автотеги файлам, у которых их нет или они посчитаны с другим словарем.
+
+        Теги считаются по уже сохраненным векторам, без декодирования файлов.
+        Возвращает количество обновленных файлов.
+        """
+        if self.tagger is None or not self.tagger.ready:
+            return 0
+        with self._index_lock:
+            stale = [path for path in self.image_features if self._current_tags(self.image_metadata.get(path)) is None]
+            if not stale:
+                return 0
+            logger.info(f"Расстановка автотегов для {len(stale)} файлов...")
+            for start in range(0, len(stale), chunk_size):
+                chunk = stale[start:start + chunk_size]
+                vectors = np.stack([np.asarray(self.image_features[path], dtype=np.float32).ravel() for path in chunk])
+                for path, tags in zip(chunk, self.tagger.score(vectors)):
+                    metadata = dict(self.image_metadata.get(path) or {}, tags=tags, tag_signature=self.tagger.signature)
+                    self._stage(path, self.image_features[path], metadata)
+            self.publish_snapshot()
+        return len(stale)
+
+    def _mark_indexed(self, paths):
+        if self.catalog is not None and paths:
+            try:
+                self.catalog.mark_indexed(paths)
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении каталога: {str(e)}")
+
+    def update_index(self, images_dir="Photos", progress_callback=None, cancel_event=None):
+        """Обновляет индекс изображений.
+
+        Если задан cancel_event, он проверяется между файлами: при остановке
+        уже посчитанные эмбеддинги сохраняются, и следующий запуск продолжит
+        с необработанных файлов.
+        """
+        with self._index_lock, TRACER.span('index.update', images_dir=images_dir):
+            return self._update_index(images_dir, progress_callback, cancel_event)
+
+    def _update_index(self, images_dir, progress_callback, cancel_event=None):
+        self._apply_tuning_profile()
         self.load_model()
         images_dir = Path(images_dir)
         
         # Сначала конвертируем все HEIC файлы
-        self.convert_all_heic_files(images_dir)
+        with TRACER.span('index.convert_heic'):
+            self.convert_all_heic_files(images_dir)
         
         # Получаем список всех изображений и видео
-        image_files = []
-        for ext in ['*.jpg', '*.jpeg', '*.png', '*.mp4', '*.mov', '*.avi', '*.mkv']:
-            image_files.extend(list(images_dir.rglob(ext)))
-        
-        # Проверяем, какие файлы уже проиндексированы
-        existing_files = set(str(Path(path)) for path in self.image_features.keys())
-        new_files = [f for f in image_files if str(f) not in existing_files]
+        discover_started = time.perf_counter()
+        with TRACER.span('index.discover'):
+            image_files = []
+            for ext in ['*.jpg', '*.jpeg', '*.png', '*.mp4', '*.mov', '*.avi', '*.mkv']:
+                image_files.extend(list(images_dir.rglob(ext)))
+            
+            # Проверяем, какие файлы уже проиндексированы
+            existing_files = set(str(Path(path)) for path in self.image_features.keys())
+            new_files = [f for f in image_files if str(f) not in existing_files]
+            # Пропавшие с диска файлы (удалены, перемещены, переименованы) убираем из индекса.
+            # Если самой директории нет (не смонтирована), индекс не трогаем
+            vanished = []
+            if images_dir.exists():
+                vanished = [path for path in existing_files
+                            if Path(path).is_relative_to(images_dir) and not os.path.exists(path)]
+            if vanished:
+                logger.info(f"Удалено из индекса {len(vanished)} файлов, которых больше нет на диске")
+                self.remove_files(vanished, save=False)
+            # Индекс, созданный до появления кэша эмбеддингов: заносим в кэш готовые векторы
+            linked = self.embedding_cache.linked_paths()
+            unlinked = {path: features for path, features in self.image_features.items() if path not in linked}
+            if unlinked:
+                logger.info(f"Заполнение кэша эмбеддингов для {len(unlinked)} файлов...")
+                self.embedding_cache.backfill(unlinked)
+            # Файлы, проиндексированные до автотегов или с другим словарем
+            retagged = self.retag()
+            # Каталог обновляется по результатам этого обхода: новые файлы добавляются, пропавшие
+            # удаляются. Полная сверка с диском выполняется только при первичном заполнении каталога
+            if self.catalog is not None:
+                try:
+                    self.catalog.remove(vanished)
+                    self.catalog.reconcile(new_files, prune=False)
+                except Exception as e:
+                    logger.error(f"Ошибка при сверке каталога: {str(e)}")
+        _record_stage('discover', discover_started, len(image_files))
         
         if not new_files:
             logger.info("Новых файлов для индексации не найдено")
+            if vanished or retagged:
+                self.save_index()
+            self._collect_embedding_garbage()
             if progress_callback:
                 progress_callback(0, 0)  # Сообщаем, что новых файлов нет
             return True  # Возвращаем True, чтобы показать, что новых файлов нет
@@ -213,45 +740,55 @@ class ImageSearchEngine:
         processed = 0
         logger.info(f"Найдено {total_images} новых файлов для индексации")
         
-        # Загружаем сохраненный прогресс
-        saved_progress = self._load_progress()
-        if saved_progress:
-            # Пропускаем уже обработанные файлы
-            processed_paths = set(str(Path(path)) for path in self.image_features.keys())
-            new_files = [f for f in new_files if str(f) not in processed_paths]
-            processed = saved_progress.get("processed_files", 0)
-            logger.info(f"Восстановление индексации с {processed} обработанных файлов")
-        
         if progress_callback:
             progress_callback(processed, total_images)
         
-        for image_path in tqdm(new_files, desc="Индексация новых файлов"):
+        indexed_paths = []
+        last_publish = time.monotonic()
+        batches = [new_files[i:i + self.batch_size] for i in range(0, len(new_files), self.batch_size)]
+        for batch in tqdm(batches, desc="Индексация новых файлов"):
+            if cancel_event is not None and cancel_event.is_set():
+                # Сохраняем сделанное: эти файлы не придется индексировать заново
+                self._save_progress(processed, total_images)
+                self.publish_snapshot()
+                self.save_index()
+                self._mark_indexed(indexed_paths)
+                logger.info(f"Индексация остановлена: обработано {processed} из {total_images}")
+                return False
             try:
-                features = self.process_image(image_path)
-                if features is not None:
-                    self.image_features[str(image_path)] = features
-                
-                processed += 1
-                
-                # Сохраняем прогресс каждые 100 изображений
-                if processed % 100 == 0:
-                    self._save_progress(processed, total_images)
-                    # Сохраняем текущий индекс
-                    self.last_update = time.ctime()
-                    with open(self.index_path, 'wb') as f:
-                        pickle.dump((self.image_features, self.last_update), f)
-                    logger.info(f"Сохранен промежуточный прогресс: {processed} из {total_images}")
-                
-                if progress_callback:
-                    progress_callback(processed, total_images)
-                
+                with TRACER.span('index.batch', files=len(batch)):
+                    embedded = self._embed_files(batch)
+                for image_path, features, metadata in embedded:
+                    self._stage(str(image_path), features, metadata)
+                    indexed_paths.append(image_path)
             except Exception as e:
-                logger.error(f"Ошибка при обработке {image_path}: {e}")
+                logger.error(f"Ошибка при обработке батча ({batch[0]} и еще {len(batch) - 1}): {e}")
+            
+            previous = processed
+            processed += len(batch)
+            
+            # Новые файлы становятся видны поиску при каждой публикации снимка
+            if time.monotonic() - last_publish >= SNAPSHOT_PUBLISH_INTERVAL:
+                self.publish_snapshot()
+                last_publish = time.monotonic()
+            
+            # Сохраняем прогресс каждые 100 изображений
+            if processed // 100 != previous // 100:
+                self._save_progress(processed, total_images)
+                # Сохраняем текущий индекс
+                self.save_index()
+                self._mark_indexed(indexed_paths)
+                indexed_paths = []
+                logger.info(f"Сохранен промежуточный прогресс: {processed} из {total_images}")
+            
+            if progress_callback:
+                progress_callback(processed, total_images)
         
-        # Сохраняем окончательный индекс
-        self.last_update = time.ctime()
-        with open(self.index_path, 'wb') as f:
-            pickle.dump((self.image_features, self.last_update), f)
+        # Публикуем и сохраняем окончательный индекс
+        self.publish_snapshot()
+        self.save_index()
+        self._mark_indexed(indexed_paths)
+        self._collect_embedding_garbage()
         
         # Удаляем файл прогресса после успешного завершения
         if os.path.exists(self.progress_path):
@@ -260,64 +797,254 @@ class ImageSearchEngine:
         logger.info(f"Индекс обновлен (всего {len(self.image_features)} файлов, добавлено {len(new_files)} новых)")
         return False  # Возвращаем False, чтобы показать, что были обработаны новые файлы
 
-    def search_images(self, query, top_k=30):
+    def _collect_embedding_garbage(self):
+        """Удаляет из кэша векторы, на которые не ссылается ни один файл"""
+        try:
+            collected = self.embedding_cache.gc()
+            if collected:
+                logger.info(f"Из кэша эмбеддингов удалено {collected} неиспользуемых векторов")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке кэша эмбеддингов: {str(e)}")
+
+    def encode_texts(self, queries):
+        """Кодирует список текстовых запросов одним прямым проходом модели"""
         self.load_model()
-        
-        # Кодируем текстовый запрос
         with torch.no_grad():
-            inputs = self.processor(text=query, return_tensors="pt", padding=True).to(self.device)
+            inputs = self.processor(text=list(queries), return_tensors="pt", padding=True).to(self.device)
             text_features = self.model.get_text_features(**inputs)
             text_features = text_features.cpu().numpy()
-            # Нормализуем вектор запроса и преобразуем в одномерный массив
-            text_features = text_features.flatten()
-            text_features = text_features / np.linalg.norm(text_features)
-        
-        # Считаем косинусное сходство со всеми изображениями
-        results = []
-        for path, features in self.image_features.items():
-            similarity = float(np.dot(text_features, features))
-            # Преобразуем сходство в проценты (0-100)
-            similarity = max(0, min(100, (similarity + 1) * 50))
-            results.append((path, similarity))
-        
-        # Сортируем по убыванию сходства и возвращаем top_k результатов
-        results.sort(key=lambda x: x[1], reverse=True)
-        return [{'path': path, 'score': score} for path, score in results[:top_k]]
-
-def main():
-    # Предварительно загружаем модель в кэш, если её там нет
-    if not os.path.exists(os.path.expanduser('~/.cache/huggingface/hub')):
-        print("Первичная загрузка и кэширование модели CLIP...")
-        CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        print("Модель загружена в кэш")
-    
-    engine = ImageSearchEngine()
-    
-    # Проверяем наличие индекса перед обновлением
-    if not os.path.exists('image_index.json'):
-        print("Создание индекса...")
-        engine.update_index("Photos")
-    
-    while True:
-        print("\nВведите поисковый запрос (или 'exit' для выхода, 'update' для обновления индекса):")
-        query = input().strip()
-        
-        if query.lower() == 'exit':
-            break
-        elif query.lower() == 'update':
-            engine.update_index("Photos")
-            continue
-        
-        results = engine.search_images(query)
+        # Нормализуем каждый вектор запроса
+        return text_features / np.linalg.norm(text_features, axis=1, keepdims=True)
+
+    @staticmethod
+    def _rank(snapshot, rows, scores, top_k):
+        """Результаты поиска для top_k лучших строк (scores посчитаны для rows или всего снимка)"""
+        # Отбираем top_k без полной сортировки
+        k = min(top_k, scores.size)
+        if k > 0:
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+        else:
+            top = np.empty(0, dtype=np.int64)
+        # Преобразуем сходство в проценты (0-100)
+        similarity = np.clip((scores[top] + 1) * 50, 0, 100)
+        top_rows = top if rows is None else rows[top]
+        return [{'path': snapshot.path_at(row), 'score': float(score)}
+                for row, score in zip(top_rows, similarity)]
+
+    def _tag_search(self, snapshot, query, top_k, filters):
+        """Результаты из инвертированного индекса автотегов или None, если нужен векторный поиск.
+
+        Запрос, в точности совпадающий с тегом словаря (или его синонимом),
+        отвечается файлами тега, упорядоченными по сходству с эмбеддингом
+        самого запроса (посчитан заранее), как в векторном поиске. Если таких
+        файлов меньше top_k (или часть индекса еще без тегов), запрос
+        выполняется обычным векторным поиском.
+        """
+        if self.tagger is None or snapshot.untagged:
+            return None
+        tag = self.tagger.match(query)
+        query_vector = self.tagger.query_embedding(query)
+        if tag is None or query_vector is None:
+            return None
+        rows, _ = snapshot.tag_rows(tag)
+        mask = snapshot.filter_mask(filters)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if rows.size < top_k:
+            _TAG_INDEX_MISS.inc()
+            return None
+        _TAG_INDEX_HIT.inc()
+        scores = snapshot.matrix[rows] @ query_vector.astype(snapshot.matrix.dtype, copy=False)
+        return self._rank(snapshot, rows, scores, top_k)
+
+    def search_batch(self, queries, top_k=30, filters=None):
+        """Поиск сразу по многим запросам (без объединения в text_batcher).
+
+        Запросы-теги отвечаются по индексу тегов, остальные тексты кодируются
+        одним проходом модели, и сходство с ними считается одним умножением
+        матриц. Возвращает списки результатов в порядке запросов.
+        """
+        snapshot = self.snapshot
+        results = [self._tag_search(snapshot, query, top_k, filters) for query in queries]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        rows = snapshot.filter_rows(filters)
+        if snapshot.size == 0 or (rows is not None and rows.size == 0):
+            return [result if result is not None else [] for result in results]
+        matrix = snapshot.matrix if rows is None else snapshot.matrix[rows]
+        text_features = np.asarray(self.encode_texts([queries[i] for i in pending]), dtype=matrix.dtype)
+        # Столбец на запрос: после транспонирования строки непрерывны в памяти
+        scores = np.ascontiguousarray((matrix @ text_features.T).T)
+        for i, column in zip(pending, scores):
+            results[i] = self._rank(snapshot, rows, column, top_k)
+        return results
+
+    def search_images(self, query, top_k=30, timings=None, filters=None):
+        """Ищет изображения по тексту; в timings (если передан словарь) пишется время фаз в секундах.
+
+        filters - результат normalize_filters(): строки, не прошедшие фильтры,
+        отбрасываются масками до расчета сходства, поэтому узкие фильтры ускоряют поиск.
+        Запрос, совпадающий с автотегом, отвечается по индексу тегов без текстового энкодера.
+        """
+        started = time.perf_counter()
+        tagged = self._tag_search(self.snapshot, query, top_k, filters)
+        if tagged is not None:
+            elapsed = time.perf_counter() - started
+            _SEARCH_TAG_LOOKUP.observe(elapsed)
+            if timings is not None:
+                timings.update(tag_lookup=elapsed)
+            return tagged
+
+        # Кодируем текстовый запрос (одновременные запросы объединяются в батч)
+        started = time.perf_counter()
+        text_features = self.text_batcher.encode(query)
+        encoded = time.perf_counter()
+        _SEARCH_ENCODE.observe(encoded - started)
         
-        if results:
-            print(f"\nНайдено {len(results)} изображений:")
-            for i, result in enumerate(results, 1):
-                print(f"\n{i}. Файл: {result['path']}")
-                print(f"   Уверенность: {result['score']:.2%}")
+        # Считаем косинусное сходство только с прошедшими фильтры строками.
+        # Ссылка на снимок берется один раз: индексатор может опубликовать новый,
+        # но этот остается неизменным до конца запроса
+        snapshot = self.snapshot
+        rows = snapshot.filter_rows(filters)
+        if snapshot.size == 0 or (rows is not None and rows.size == 0):
+            scores = np.empty(0, dtype=np.float32)
         else:
-            print("\nИзображений по запросу не найдено")
+            query_vector = np.asarray(text_features, dtype=snapshot.matrix.dtype).ravel()
+            if rows is None:
+                scores = snapshot.matrix @ query_vector
+            elif rows.size * 2 > snapshot.size:
+                # Копирование большей части матрицы дороже, чем счет по всей матрице
+                scores = (snapshot.matrix @ query_vector)[rows]
+            else:
+                scores = snapshot.matrix[rows] @ query_vector
+        scored = time.perf_counter()
+        _SEARCH_SCORING.observe(scored - encoded)
+        
+        top_results = self._rank(snapshot, rows, scores, top_k)
+        finished = time.perf_counter()
+        _SEARCH_TOPK.observe(finished - scored)
+        if timings is not None:
+            timings.update(text_encode=encoded - started, scoring=scored - encoded, topk=finished - scored)
+        return top_results
+
+def _read_queries(args):
+    """Запросы из аргументов, файла или stdin (по одному на строку, пустые строки пропускаются)"""
+    if args.queries:
+        lines = args.queries
+    elif args.input and args.input != '-':
+        with open(args.input, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    else:
+        lines = sys.stdin.read().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def _command_index(engine, args):
+    started = time.perf_counter()
+    no_new_files = engine.update_index(args.photos)
+    print(json.dumps({
+        'model': engine.model_spec.key,
+        'indexed': len(engine.snapshot),
+        'new_files': not no_new_files,
+        'seconds': round(time.perf_counter() - started, 3),
+    }, ensure_ascii=False))
+
+
+def _positive_int(value):
+    """Тип аргумента argparse: целое число больше нуля"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается целое число: {value!r}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"ожидается число больше нуля: {value}")
+    return number
+
+
+def _command_search(engine, args):
+    try:
+        filters = normalize_filters({
+            'date_from': args.date_from,
+            'date_to': args.date_to,
+            'media_type': args.media_type,
+            'folder': args.folder,
+        })
+    except ValueError as e:
+        raise SystemExit(f"Некорректный фильтр: {e}")
+    queries = _read_queries(args)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    started = time.perf_counter()
+    try:
+        for start in range(0, len(queries), args.batch_size):
+            batch = queries[start:start + args.batch_size]
+            for query, results in zip(batch, engine.search_batch(batch, args.top_k, filters)):
+                output.write(json.dumps({'query': query, 'results': results}, ensure_ascii=False) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - started
+    logger.info(f"Выполнено {len(queries)} запросов за {elapsed:.2f} с "
+                f"({len(queries) / elapsed if elapsed > 0 else 0:.1f} запросов/с)")
+
+
+def _command_stats(engine, args):
+    media_types = {}
+    for metadata in engine.image_metadata.values():
+        kind = (metadata or {}).get('media_type') or TYPE_IMAGE
+        media_types[kind] = media_types.get(kind, 0) + 1
+    print(json.dumps({
+        'model': engine.model_spec.key,
+        'model_name': engine.model_name,
+        'index_path': engine.index_path,
+        'indexed': len(engine.snapshot),
+        'media_types': media_types,
+        'last_update': engine.get_last_update_time(),
+        'index_memory_bytes': engine.index_memory_bytes(),
+        'embedding_cache': engine.embedding_cache.stats(),
+        'tags': {tag: len(posting) for tag, posting in sorted(engine.snapshot.postings.items()) if posting},
+        'untagged': engine.snapshot.untagged,
+    }, ensure_ascii=False, indent=2))
+
+
+def main(argv=None):
+    """Консольный интерфейс: индексация, пакетный поиск и статистика без веб-сервера.
+
+        python search_images.py index --photos Photos
+        python search_images.py search "собака" "пляж на закате"
+        python search_images.py search --input queries.txt --output results.jsonl --top-k 10
+        cat queries.txt | python search_images.py search --media-type image > results.jsonl
+        python search_images.py stats
+    """
+    parser = argparse.ArgumentParser(description="Поиск по медиатеке без веб-интерфейса")
+    parser.add_argument('--model', choices=sorted(MODELS), default=None,
+                        help="Модель эмбеддингов (по умолчанию активная)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="Обновить индекс")
+    index_parser.add_argument('--photos', default="Photos", help="Директория с фотографиями")
+
+    search_parser = subparsers.add_parser('search', help="Поиск по запросам, результаты в JSON Lines")
+    search_parser.add_argument('queries', nargs='*', help="Запросы; без них читаются из --input или stdin")
+    search_parser.add_argument('--input', help="Файл с запросами, по одному на строку ('-' - stdin)")
+    search_parser.add_argument('--output', help="Файл для результатов (по умолчанию stdout)")
+    search_parser.add_argument('--top-k', type=_positive_int, default=30)
+    search_parser.add_argument('--batch-size', type=_positive_int, default=64, help="Запросов в одном проходе модели")
+    search_parser.add_argument('--date-from')
+    search_parser.add_argument('--date-to')
+    search_parser.add_argument('--media-type', choices=[TYPE_IMAGE, TYPE_VIDEO])
+    search_parser.add_argument('--folder')
+
+    subparsers.add_parser('stats', help="Статистика индекса")
+
+    args = parser.parse_args(argv)
+    # stdout занят результатами, логи уходят в stderr
+    set_console_stream(sys.stderr)
+    engine = ImageSearchEngine(model_key=args.model)
+    commands = {'index': _command_index, 'search': _command_search, 'stats': _command_stats}
+    commands[args.command](engine, args)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -335,32 +335,14 @@ async function updateIndex() {
                     return; // Прерываем выполнение, не перезапускаем сервер
                 }
                 
-                // Если были проиндексированы новые файлы, перезапускаем сервер
-                showNotification('success', 'Индексация завершена. Перезапуск сервера...');
+                // Если были проиндексированы новые файлы, сервер подменяет индекс новым
+                showNotification('success', 'Индексация завершена. Обновление индекса...');
                 
                 try {
-                    // Перезапускаем сервер
-                    await fetch('/restart_server', { method: 'POST' });
-                    
-                    // Ждем пока сервер перезапустится
-                    setTimeout(async function checkServer() {
-                        try {
-                            const response = await fetch('/');
-                            if (response.ok) {
-                                // Сервер снова доступен, перезагружаем страницу
-                                window.location.reload();
-                            } else {
-                                // Пробуем снова через секунду
-                                setTimeout(checkServer, 1000);
-                            }
-                        } catch {
-                            // Если сервер еще не доступен, пробуем снова
-                            setTimeout(checkServer, 1000);
-                        }
-                    }, 2000); // Даем серверу 2 секунды на начальный перезапуск
+                    await reloadServer();
                 } catch (error) {
-                    console.error('Ошибка при перезапуске сервера:', error);
-                    showNotification('error', 'Ошибка при перезапуске сервера');
+                    console.error('Ошибка при перезагрузке индекса:', error);
+                    showNotification('error', 'Ошибка при перезагрузке индекса');
                 }
             }
         };
@@ -425,31 +407,13 @@ document.getElementById('syncButton').addEventListener('click', async function()
             
             if (data.progress >= 100) {
                 eventSource.close();
-                showNotification('success', 'Синхронизация завершена. Перезапуск сервера...');
+                showNotification('success', 'Синхронизация завершена. Обновление индекса...');
                 
                 try {
-                    // Перезапускаем сервер
-                    await fetch('/restart_server', { method: 'POST' });
-                    
-                    // Ждем пока сервер перезапустится
-                    setTimeout(async function checkServer() {
-                        try {
-                            const response = await fetch('/');
-                            if (response.ok) {
-                                // Сервер снова доступен, перезагружаем страницу
-                                window.location.reload();
-                            } else {
-                                // Пробуем снова через секунду
-                                setTimeout(checkServer, 1000);
-                            }
-                        } catch {
-                            // Если сервер еще не доступен, пробуем снова
-                            setTimeout(checkServer, 1000);
-                        }
-                    }, 2000); // Даем серверу 2 секунды на начальный перезапуск
+                    await reloadServer();
                 } catch (error) {
-                    console.error('Ошибка при перезапуске сервера:', error);
-                    showNotification('error', 'Ошибка при перезапуске сервера');
+                    console.error('Ошибка при перезагрузке индекса:', error);
+                    showNotification('error', 'Ошибка при перезагрузке индекса');
                     showProgress(false);
                     setButtonsState('sync', false);
                 }
@@ -612,23 +576,13 @@ async function submitICloudLogin() {
             
             if (data.progress >= 100) {
                 eventSource.close();
-                showNotification('success', 'Синхронизация завершена. Перезапуск сервера...');
+                showNotification('success', 'Синхронизация завершена. Обновление индекса...');
                 
-                // Перезапускаем сервер после завершения
-                fetch('/restart_server', { method: 'POST' })
-                    .then(() => {
-                        setTimeout(function checkServer() {
-                            fetch('/')
-                                .then(response => {
-                                    if (response.ok) {
-                                        window.location.reload();
-                                    } else {
-                                        setTimeout(checkServer, 1000);
-                                    }
-                                })
-                                .catch(() => setTimeout(checkServer, 1000));
-                        }, 2000);
-                    });
+                // Подменяем индекс новым после завершения
+                reloadServer().catch(error => {
+                    console.error('Ошибка при перезагрузке индекса:', error);
+                    showNotification('error', 'Ошибка при перезагрузке индекса');
+                });
             }
         };
         
@@ -1018,29 +972,14 @@ function startIndexing() {
                 indexButton.disabled = false;
                 progressIndicator.style.display = 'none';
                 
-                // Перезапускаем сервер только если были проиндексированы новые файлы
+                // Обновляем индекс на сервере только если были проиндексированы новые файлы
                 if (data.state === "completed") {
-                    console.log('Перезапуск сервера после успешной индексации');
-                    showNotification('success', 'Индексация завершена. Перезапуск сервера...');
-                    fetch('/restart_server', { method: 'POST' })
-                        .then(() => {
-                            setTimeout(function checkServer() {
-                                fetch('/')
-                                    .then(response => {
-                                        if (response.ok) {
-                                            console.log('Сервер перезапущен успешно, перезагружаем страницу');
-                                            window.location.reload();
-                                        } else {
-                                            console.log('Сервер ещё не готов, ждём...');
-                                            setTimeout(checkServer, 1000);
-                                        }
-                                    })
-                                    .catch(() => {
-                                        console.log('Ошибка подключения к серверу, пробуем снова...');
-                                        setTimeout(checkServer, 1000);
-                                    });
-                            }, 2000);
-                        });
+                    console.log('Перезагрузка индекса после успешной индексации');
+                    showNotification('success', 'Индексация завершена. Обновление индекса...');
+                    reloadServer().catch(error => {
+                        console.error('Ошибка при перезагрузке индекса:', error);
+                        showNotification('error', 'Ошибка при перезагрузке индекса');
+                    });
                 }
             }
         };
@@ -1061,6 +1000,24 @@ function startIndexing() {
     });
 }
 
+// Перечитывает настройки и индекс на сервере без перезапуска процесса и обновляет страницу
+async function reloadServer() {
+    const response = await fetch('/reload', { method: 'POST' });
+    const data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error || 'Не удалось перезагрузить индекс');
+    }
+    // Ждем, пока новое поколение индекса заменит прежнее (прежнее все это время обслуживает поиск)
+    while (true) {
+        const job = await (await fetch(`/jobs/${data.job_id}`)).json();
+        if (job.status !== 'queued' && job.status !== 'running') {
+            break;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500));
+    }
+    window.location.reload();
+}
+
 // Функция для загрузки сохраненных учетных данных
 async function loadSavedCredentials() {
     try {
@@ -0,0 +1,135 @@
+import hashlib
+import os
+from pathlib import Path
+from logger_config import setup_logger, LogSummary
+from sync_manifest import STATUS_DONE
+
+logger = setup_logger(__name__)
+
+LAYOUT_FLAT = 'flat'
+LAYOUT_SHARDED = 'sharded'
+
+# Два уровня по одной hex-цифре: 256 директорий. На 200 тысячах файлов это
+# около 800 файлов на директорию, а наблюдателю inotify хватает 257 наблюдений
+SHARD_DEPTH = 2
+SHARD_WIDTH = 1
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def shard_dir(asset_id):
+    """Поддиректория шарда для ассета, например 'a/3' (стабильна для идентификатора)"""
+    digest = hashlib.blake2b(str(asset_id).encode('utf-8'), digest_size=8).hexdigest()
+    return '/'.join(digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH))
+
+
+def strip_shard(folder):
+    """Папка без директорий шардов в начале: 'a/3' -> ''.
+
+    Шарды - деталь хранения: синхронизированные файлы для фильтра по папке
+    по-прежнему лежат в корне медиатеки.
+    """
+    parts = folder.split('/') if folder else []
+    shard = parts[:SHARD_DEPTH]
+    if len(shard) == SHARD_DEPTH and all(len(part) == SHARD_WIDTH and set(part) <= _HEX_DIGITS for part in shard):
+        parts = parts[SHARD_DEPTH:]
+    return '/'.join(parts)
+
+
+def in_shard(local_path, asset_id):
+    """Лежит ли файл уже в своем шарде"""
+    parent = Path(str(local_path).replace('\\', '/')).parent.as_posix()
+    return parent == shard_dir(asset_id)
+
+
+class StorageMigration:
+    """Перенос медиатеки из плоской директории Photos в шарды.
+
+    Работает онлайн: файлы переносятся переименованием по batch_size штук,
+    после каждого батча манифест, каталог, индекс и кэш эмбеддингов
+    переводятся на новые пути, поэтому поиск и выдача медиа продолжают
+    работать, а эмбеддинги не пересчитываются. Прерванная миграция
+    продолжается с оставшихся файлов. Переносятся только файлы из манифеста
+    синхронизации; файлы, скопированные в Photos вручную, остаются на месте.
+
+    Ключи индекса по-прежнему пути вида 'Photos/a/3/IMG_0001.jpg', а не
+    идентификаторы ассетов: перенос переименовывает их, а не перестраивает индекс.
+    """
+
+    def __init__(self, manifest, photos_dir="Photos", engine=None, catalog=None, batch_size=500):
+        self.manifest = manifest
+        self.photos_dir = Path(photos_dir)
+        self.engine = engine
+        self.catalog = catalog
+        self.batch_size = batch_size
+
+    def pending(self):
+        """Записи манифеста, которые еще не в своем шарде"""
+        return [row for row in self.manifest.rows() if not in_shard(row['local_path'], row['asset_id'])]
+
+    def _target(self, row):
+        """Свободный путь в шарде (имена внутри шарда тоже могут совпасть)"""
+        name = Path(row['local_path']).name
+        stem, ext = os.path.splitext(name)
+        shard = shard_dir(row['asset_id'])
+        for candidate in [name] + [f"{stem}_{row['asset_id'][:8]}_{n}{ext}" for n in range(100)]:
+            local_path = f"{shard}/{candidate}"
+            if not self.manifest.path_taken(local_path) and not (self.photos_dir / local_path).exists():
+                return local_path
+        raise RuntimeError(f"Не удалось подобрать свободное имя в шарде для {name}")
+
+    def run(self, cancel_event=None, progress_callback=None):
+        """Переносит файлы; возвращает словарь со счетчиками (moved, relinked, remaining)"""
+        rows = self.pending()
+        total = len(rows)
+        if not total:
+            return {'moved': 0, 'relinked': 0, 'remaining': 0}
+        logger.info(f"Перенос {total} файлов в шарды {self.photos_dir}")
+        summary = LogSummary(logger, "Перенос в шарды")
+        moved = relinked = processed = 0
+        for start in range(0, total, self.batch_size):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            renames = {}
+            for row in rows[start:start + self.batch_size]:
+                target = self._target(row)
+                source_path = self.photos_dir / row['local_path']
+                target_path = self.photos_dir / target
+                if row['status'] == STATUS_DONE and source_path.exists():
+                    target_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(source_path, target_path)
+                    renames[source_path] = target_path
+                    moved += 1
+                    summary.count('перенесено')
+                else:
+                    # Файла нет (не скачан или удален): следующая синхронизация скачает его сразу в шард
+                    relinked += 1
+                    summary.count('без файла')
+                self.manifest.set_local_path(row['asset_id'], target)
+            self._apply(renames)
+            processed = min(total, start + self.batch_size)
+            if progress_callback:
+                progress_callback(processed, total)
+        summary.flush()
+        remaining = total - processed
+        logger.info(f"Перенос в шарды: перенесено {moved}, без файла {relinked}, осталось {remaining}")
+        return {'moved': moved, 'relinked': relinked, 'remaining': remaining}
+
+    def _apply(self, renames):
+        """Переводит каталог, индекс и кэш эмбеддингов на новые пути"""
+        if not renames:
+            return
+        if self.catalog is not None:
+            self.catalog.rename(renames)
+        if self.engine is not None:
+            # Ключи индекса - пути относительно рабочей директории ('Photos/...')
+            self.engine.rename_files({_index_key(old): _index_key(new) for old, new in renames.items()})
+
+
+def _index_key(path):
+    path = Path(path)
+    if path.is_absolute():
+        try:
+            return str(path.relative_to(Path.cwd()))
+        except ValueError:
+            return str(path)
+    return str(path)
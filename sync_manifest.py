@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class SyncManifest:
+    """Локальный манифест синхронизации iCloud, хранящийся в SQLite.
+
+    Ключ записи - идентификатор ассета в iCloud, поэтому разные фотографии
+    с одинаковым именем (IMG_0001.JPG) больше не перетирают друг друга.
+    Пути хранятся относительно директории с фотографиями.
+    """
+
+    def __init__(self, db_path="sync_manifest.db"):
+        self.db_path = str(db_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS assets (
+                    asset_id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    local_path TEXT NOT NULL,
+                    path_key TEXT NOT NULL UNIQUE,
+                    checksum TEXT,
+                    size INTEGER,
+                    modified TEXT,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_status ON assets(status)")
+            # SHA-256 скачанного содержимого (добавлено позже, старые манифесты мигрируются)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(assets)")}
+            if 'sha256' not in columns:
+                self._conn.execute("ALTER TABLE assets ADD COLUMN sha256 TEXT")
+
+    @staticmethod
+    def _path_key(local_path):
+        # Сравниваем пути без учета регистра: файловые системы macOS и Windows его не различают
+        return str(local_path).replace(os.sep, '/').lower()
+
+    def get(self, asset_id):
+        """Возвращает запись манифеста для ассета или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM assets WHERE asset_id = ?", (asset_id,)).fetchone()
+        return dict(row) if row else None
+
+    def needs_download(self, info, photos_dir):
+        """Проверяет, нужно ли скачивать ассет (новый, измененный или недокачанный)"""
+        row = self.get(info['asset_id'])
+        if row is None or row['status'] != STATUS_DONE:
+            return True
+        if (row['checksum'], row['size'], row['modified']) != (info['checksum'], info['size'], info['modified']):
+            return True
+        return not (Path(photos_dir) / row['local_path']).exists()
+
+    def reserve_path(self, info, photos_dir, final_suffix=None, subdir=None):
+        """Закрепляет за ассетом уникальный локальный путь.
+
+        subdir - поддиректория шарда (storage_layout), в которой создается файл.
+        Возвращает пару (относительный путь, adopted). adopted=True означает, что
+        файл уже лежит на диске после синхронизации без манифеста и был принят
+        как есть, скачивать его заново не нужно.
+        """
+        photos_dir = Path(photos_dir)
+        filename = info['filename']
+        stem, ext = os.path.splitext(filename)
+        final_ext = final_suffix or ext
+
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT local_path FROM assets WHERE asset_id = ?", (info['asset_id'],)
+            ).fetchone()
+            if row is not None:
+                self._upsert(info, row['local_path'], STATUS_PENDING)
+                return row['local_path'], False
+
+            candidates = [stem + final_ext, f"{stem}_{info['asset_id'][:8]}{final_ext}"]
+            candidates += [f"{stem}_{info['asset_id'][:8]}_{n}{final_ext}" for n in range(1, 100)]
+            if subdir:
+                # Файл прежней плоской раскладки принимается на месте, его перенесет миграция
+                legacy = photos_dir / candidates[0]
+                owner = self._conn.execute(
+                    "SELECT asset_id FROM assets WHERE path_key = ?", (self._path_key(candidates[0]),)
+                ).fetchone()
+                if owner is None and legacy.exists() and (final_ext != ext or legacy.stat().st_size == info['size']):
+                    self._upsert(info, candidates[0], STATUS_DONE)
+                    return candidates[0], True
+                candidates = [f"{subdir}/{candidate}" for candidate in candidates]
+            for candidate in candidates:
+                owner = self._conn.execute(
+                    "SELECT asset_id FROM assets WHERE path_key = ?", (self._path_key(candidate),)
+                ).fetchone()
+                if owner is not None:
+                    continue
+                on_disk = photos_dir / candidate
+                if on_disk.exists():
+                    # Файл от прежней синхронизации без манифеста: принимаем его,
+                    # если это исходное имя и размер совпадает (или файл уже сконвертирован)
+                    if candidate == candidates[0] and (final_ext != ext or on_disk.stat().st_size == info['size']):
+                        self._upsert(info, candidate, STATUS_DONE)
+                        return candidate, True
+                    continue
+                self._upsert(info, candidate, STATUS_PENDING)
+                return candidate, False
+
+        raise RuntimeError(f"Не удалось подобрать свободное имя файла для {filename}")
+
+    def _upsert(self, info, local_path, status):
+        self._conn.execute("""
+            INSERT INTO assets (asset_id, filename, local_path, path_key, checksum, size, modified, status, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(asset_id) DO UPDATE SET
+                filename = excluded.filename,
+                local_path = excluded.local_path,
+                path_key = excluded.path_key,
+                checksum = excluded.checksum,
+                size = excluded.size,
+                modified = excluded.modified,
+                status = excluded.status,
+                updated_at = excluded.updated_at
+        """, (
+            info['asset_id'], info['filename'], str(local_path), self._path_key(local_path),
+            info['checksum'], info['size'], info['modified'], status, time.time()
+        ))
+
+    def _set_status(self, asset_id, status):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE assets SET status = ?, updated_at = ? WHERE asset_id = ?",
+                (status, time.time(), asset_id)
+            )
+
+    def mark_done(self, asset_id):
+        """Отмечает ассет как успешно скачанный"""
+        self._set_status(asset_id, STATUS_DONE)
+
+    def set_sha256(self, asset_id, sha256):
+        """Запоминает SHA-256 скачанного содержимого ассета"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE assets SET sha256 = ? WHERE asset_id = ?", (sha256, asset_id))
+
+    def set_local_path(self, asset_id, local_path):
+        """Переносит ассет на новый относительный путь (файл уже перемещен)"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE assets SET local_path = ?, path_key = ?, updated_at = ? WHERE asset_id = ?",
+                (str(local_path), self._path_key(local_path), time.time(), asset_id)
+            )
+
+    def path_taken(self, local_path):
+        """Закреплен ли путь за каким-либо ассетом"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM assets WHERE path_key = ?", (self._path_key(local_path),)
+            ).fetchone()
+        return row is not None
+
+    def rows(self):
+        """Все записи манифеста (asset_id, local_path, status)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT asset_id, local_path, status FROM assets").fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_failed(self, asset_id):
+        """Отмечает ассет как не скачанный (будет повторен при следующей синхронизации)"""
+        self._set_status(asset_id, STATUS_FAILED)
+
+    def counts(self):
+        """Возвращает количество записей по статусам"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM assets GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
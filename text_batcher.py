@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import Counter, deque
+from logger_config import setup_logger
+from metrics import TEXT_ENCODE_BATCH_SIZE, TEXT_ENCODE_QUEUE_WAIT_SECONDS
+
+logger = setup_logger(__name__)
+
+
+class _PendingQuery:
+    """Запрос, ожидающий своей очереди в батче"""
+
+    __slots__ = ('text', 'enqueued_at', 'done', 'result', 'error')
+
+    def __init__(self, text):
+        self.text = text
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TextEncodeBatcher:
+    """Объединяет одновременные запросы к текстовому энкодеру в один батч.
+
+    Запросы, пришедшие в пределах окна ожидания, собираются в батч размером
+    не больше max_batch_size и кодируются одним прямым проходом модели.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=16, max_wait_ms=5.0, stats_window=1000):
+        # encode_fn принимает список строк и возвращает массив (N, D)
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._worker = None
+        self._closed = False
+
+        # Метрики для настройки окна ожидания
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.queue_waits = deque(maxlen=stats_window)
+        self.total_batches = 0
+        self.total_queries = 0
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='TextBatcher', daemon=True)
+            self._worker.start()
+
+    def close(self):
+        """Останавливает поток после того, как будут закодированы уже поставленные запросы"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def encode(self, text):
+        """Кодирует один запрос, дожидаясь своего батча"""
+        pending = _PendingQuery(text)
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append(pending)
+            self._cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect_batch(self):
+        """Ждет первый запрос и добирает батч в пределах окна ожидания"""
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            deadline = self._pending[0].enqueued_at + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(len(self._pending), self.max_batch_size)
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            try:
+                vectors = self.encode_fn([item.text for item in batch])
+                for item, vector in zip(batch, vectors):
+                    item.result = vector
+            except Exception as e:
+                logger.error(f"Ошибка при кодировании батча запросов: {str(e)}")
+                for item in batch:
+                    item.error = e
+            finally:
+                with self._stats_lock:
+                    self.total_batches += 1
+                    self.total_queries += len(batch)
+                    self.batch_sizes[len(batch)] += 1
+                    for item in batch:
+                        self.queue_waits.append((started - item.enqueued_at) * 1000.0)
+                TEXT_ENCODE_BATCH_SIZE.observe(len(batch))
+                for item in batch:
+                    TEXT_ENCODE_QUEUE_WAIT_SECONDS.observe(started - item.enqueued_at)
+                for item in batch:
+                    item.done.set()
+
+    def get_stats(self):
+        """Возвращает метрики размера батчей и времени ожидания в очереди (мс)"""
+        with self._stats_lock:
+            waits = sorted(self.queue_waits)
+            stats = {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'total_batches': self.total_batches,
+                'total_queries': self.total_queries,
+                'avg_batch_size': (self.total_queries / self.total_batches) if self.total_batches else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            }
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(round(p / 100.0 * (len(waits) - 1))))]
+
+        stats['queue_wait_ms'] = {
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'max': waits[-1] if waits else 0.0,
+        }
+        return stats